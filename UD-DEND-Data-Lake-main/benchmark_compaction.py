@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+from time import perf_counter
+from pyspark.sql.functions import col, count, hash as hash_, sum as sum_
+from compaction import compact_source, sources
+from etl import create_spark_session
+from schemas import corrupt_column
+from sample_data import write_sample
+from tools import print_status
+
+
+# globs of the json-files like etl.py reads them
+json_globs = {'song_data': 'song_data/*/*/*/*.json', 'log_data': 'log_data/*/*/*.json'}
+
+
+def list_and_read(spark, path, name, layer):
+    """
+    Description: This function lists the files of a source, when Spark builds
+                 the index of the files of the DataFrame, and reads all of
+                 them, summing a hash of every record
+
+    Arguments:
+        spark: Spark session
+        path: Path to the folder of the input data or of the compacted data
+        name: Name of the source, a key of sources
+        layer: json or compacted
+
+    Returns:
+        dict with the files, valid records, their checksum, list and read seconds
+    """
+    schema = sources[name]
+    columns = [field.name for field in schema.fields if field.name != corrupt_column]
+
+    t0 = perf_counter()
+    if layer == 'json':
+        df = spark.read.json(os.path.join(path, json_globs[name]), schema=schema)
+        df = df.filter(col(corrupt_column).isNull())
+    else:
+        df = spark.read.parquet(os.path.join(path, name))
+    list_seconds = perf_counter() - t0
+
+    t0 = perf_counter()
+    row = df.select(count('*').alias('records'), sum_(hash_(*[col(c) for c in columns])).alias('checksum')).first()
+    read_seconds = perf_counter() - t0
+
+    return {'source': name, 'layer': layer, 'files': len(df.inputFiles()), 'records': row['records'],
+            'checksum': row['checksum'], 'list_seconds': list_seconds, 'read_seconds': read_seconds}
+
+
+def main():
+    """
+    Description: This main function compares the list and read time of the
+                 json-files of a local sample of many small files with the
+                 Parquet files compaction.py writes of them, and writes the
+                 result as JSON
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark reading the json-files against the compacted data')
+    parser.add_argument('--input', help='folder of the input data (default: a sample written by sample_data.py)')
+    parser.add_argument('--songs', type=int, default=20000, help='song files of the sample')
+    parser.add_argument('--events', type=int, default=500000, help='log records of the sample')
+    parser.add_argument('--target-mb', type=int, default=512, help='MB of json per Parquet file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--master', default='local[*]')
+    parser.add_argument('--output', default='benchmark_compaction.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_compaction_')
+    input_data = args.input
+    if input_data is None:
+        input_data = os.path.join(work_dir, 'input')
+        print_status('benchmark_compaction', '{} song files and {} log files written'.format(
+            *write_sample(input_data, args.songs, args.events)))
+    compacted_data = os.path.join(work_dir, 'compacted')
+
+    spark = create_spark_session(args.master)
+    compactions, results = [], []
+    try:
+        for name in sources:
+            t0 = perf_counter()
+            stats = compact_source(spark, input_data, compacted_data, name, args.target_mb * 1024 * 1024)
+            stats['seconds'] = perf_counter() - t0
+            compactions.append(stats)
+
+        for run in range(args.repeat):
+            for name in sources:
+                for layer, path in [('json', input_data), ('compacted', compacted_data)]:
+                    result = list_and_read(spark, path, name, layer)
+                    result['run'] = run
+                    results.append(result)
+                    print_status('benchmark_compaction', '{} {}: {} files, list {:.2f}s, read {:.2f}s'.format(
+                        name, layer, result['files'], result['list_seconds'], result['read_seconds']))
+    finally:
+        spark.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = []
+    for name in sources:
+        for layer in ['json', 'compacted']:
+            runs = [r for r in results if r['source'] == name and r['layer'] == layer]
+            summary.append({'source': name, 'layer': layer, 'files': runs[0]['files'],
+                            'records': runs[0]['records'],
+                            'same_result': runs[0]['checksum'] == next(
+                                r['checksum'] for r in results if r['source'] == name and r['layer'] == 'json'),
+                            'median_list_seconds': statistics.median(r['list_seconds'] for r in runs),
+                            'median_read_seconds': statistics.median(r['read_seconds'] for r in runs)})
+    with open(args.output, 'w') as f:
+        json.dump({'input': args.input or 'sample', 'songs': args.songs, 'events': args.events,
+                   'compactions': compactions, 'runs': results, 'summary': summary}, f, indent=2)
+
+    print('{:<11}{:<11}{:>8}{:>10}{:>10}{:>13}'.format('source', 'layer', 'files', 'list s', 'read s', 'same result'))
+    for s in summary:
+        print('{source:<11}{layer:<11}{files:>8}{median_list_seconds:>10.2f}{median_read_seconds:>10.2f}'
+              '{same_result!s:>13}'.format(**s))
+    print('report written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+from time import perf_counter
+from etl import create_spark_session, run_etl
+from sample_data import write_sample
+from tools import print_status
+
+
+def run_job(spark, input_data, output_data, infer_schema, group):
+    """
+    Description: This function runs run_etl once and counts the Spark jobs
+                 it started
+
+    Arguments:
+        spark: Spark session
+        input_data: Path to the folder of the input data
+        output_data: Path to the folder of the output data
+        infer_schema: infer the schema of the json-files
+        group: name of the job group of the run
+
+    Returns:
+        seconds: wall time of the run
+        jobs: number of Spark jobs of the run
+        source_scans: scans of song data and log data counted by run_etl
+    """
+    spark.sparkContext.setJobGroup(group, group)
+    t0 = perf_counter()
+    metrics = run_etl(spark, input_data, output_data, infer_schema)
+    seconds = perf_counter() - t0
+    spark.sparkContext.setLocalProperty('spark.jobGroup.id', None)
+
+    return seconds, len(spark.sparkContext.statusTracker().getJobIdsForGroup(group)), metrics['source_scans']
+
+
+def main():
+    """
+    Description: This main function compares the job time of the ETL with
+                 schema inference and with the declared schemas of schemas.py
+                 on a local sample of many small json-files, and writes the
+                 result as JSON
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the ETL with inferred against declared schemas')
+    parser.add_argument('--input', help='folder of the input data (default: a sample written by sample_data.py)')
+    parser.add_argument('--songs', type=int, default=10000, help='song files of the sample')
+    parser.add_argument('--events', type=int, default=500000, help='log records of the sample')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--master', default='local[*]')
+    parser.add_argument('--output', default='benchmark_schemas.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_schemas_')
+    input_data = args.input
+    if input_data is None:
+        input_data = os.path.join(work_dir, 'input')
+        print_status('benchmark_schemas', '{} song files and {} log files written'.format(
+            *write_sample(input_data, args.songs, args.events)))
+
+    spark = create_spark_session(args.master)
+    results = []
+    try:
+        for run in range(args.repeat):
+            for infer_schema in [True, False]:
+                mode = 'inferred' if infer_schema else 'declared'
+                seconds, jobs, source_scans = run_job(spark, input_data, os.path.join(work_dir, 'output'), infer_schema,
+                                        '{}-{}'.format(mode, run))
+                results.append({'mode': mode, 'run': run, 'seconds': seconds, 'jobs': jobs,
+                                'source_scans': source_scans})
+                print_status('benchmark_schemas', '{} schema: {:.2f}s, {} jobs, source scans {}'.format(
+                    mode, seconds, jobs, source_scans))
+    finally:
+        spark.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary = {mode: {'median_seconds': statistics.median(r['seconds'] for r in results if r['mode'] == mode),
+                      'jobs': max(r['jobs'] for r in results if r['mode'] == mode)}
+               for mode in ['inferred', 'declared']}
+    with open(args.output, 'w') as f:
+        json.dump({'input': args.input or 'sample', 'songs': args.songs, 'events': args.events,
+                   'runs': results, 'summary': summary}, f, indent=2)
+
+    for mode, s in summary.items():
+        print('{:<10}{:>10.2f}s{:>6} jobs'.format(mode, s['median_seconds'], s['jobs']))
+    print('report written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
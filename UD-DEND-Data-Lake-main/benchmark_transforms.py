@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import statistics
+from datetime import datetime
+from time import perf_counter
+from pyspark import StorageLevel
+from pyspark.sql.functions import udf, col, lit, count, hash as hash_, sum as sum_
+from etl import create_spark_session
+from sample_data import start_ts
+from schemas import log_schema
+from transforms import with_time_columns, time_columns
+from tools import print_status
+
+
+def python_udf_time_columns(df):
+    """
+    Description: This function adds the start time like process_log_data did
+                 before transforms.py: two Python UDFs and a string round trip
+                 in the time zone of the Python worker
+
+    Arguments:
+        df: DataFrame with the column ts in milliseconds
+
+    Returns:
+        DataFrame with the columns start_time, hour, day, week, month, year and weekday
+    """
+    get_timestamp_udf = udf(lambda x: int(x / 1000))
+    df = df.withColumn('timestamp', get_timestamp_udf('ts').cast('Integer'))
+    get_datetime_udf = udf(lambda x: str(datetime.fromtimestamp(x)))
+    df = df.withColumn('start_time', get_datetime_udf('timestamp').cast('Timestamp'))
+    return df.select('*', *time_columns('start_time'))
+
+
+implementations = {'python_udf': python_udf_time_columns,
+                   'pandas_udf': lambda df: with_time_columns(df, vectorized=True),
+                   'native': with_time_columns}
+
+
+def process_tree_cpu(pid):
+    """
+    Description: This function returns the CPU seconds of a process and of all
+                 its descendants, with the finished children they waited for,
+                 read from /proc. The Python workers of a local Spark session
+                 are descendants of its JVM.
+
+    Arguments:
+        pid: process id of the root of the tree
+
+    Returns:
+        CPU seconds, user and system
+    """
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    # the fields after the command name, which may contain spaces
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            stats[int(entry)] = (int(fields[1]), sum(int(ticks) for ticks in fields[11:15]))
+
+    ticks, tree = 0, [pid]
+    while tree:
+        parent = tree.pop()
+        ticks += stats.get(parent, (0, 0))[1]
+        tree.extend(child for child, (ppid, _) in stats.items() if ppid == parent)
+
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def scaled_log_data(spark, input_data, events, scale):
+    """
+    Description: This function returns the ts of NextSong events, persisted,
+                 so that the runs only measure the transforms. The ts of the
+                 log data of input_data are repeated scale times, each copy a
+                 day later, without input_data events ts 10 seconds apart
+                 starting with the log data are generated.
+
+    Arguments:
+        spark: Spark session
+        input_data: Path to the folder of the input data, None to generate the ts
+        events: number of generated ts
+        scale: copies of the ts of input_data
+
+    Returns:
+        DataFrame with the column ts
+    """
+    if input_data is None:
+        df = spark.range(events).select((lit(start_ts) + col('id') * 10000).alias('ts'))
+    else:
+        df = spark.read.json(os.path.join(input_data, 'log_data/*/*/*.json'), schema=log_schema) \
+                  .filter(col('page') == 'NextSong') \
+                  .crossJoin(spark.range(scale).withColumnRenamed('id', 'copy')) \
+                  .select((col('ts') + col('copy') * 86400000).alias('ts'))
+    df = df.persist(StorageLevel.MEMORY_ONLY)
+    df.count()
+
+    return df
+
+
+def run_transform(spark, df, implementation):
+    """
+    Description: This function derives the time columns of every ts and sums
+                 a hash of them, so that all of them are computed and the
+                 implementations can be compared
+
+    Arguments:
+        spark: Spark session
+        df: DataFrame returned by scaled_log_data
+        implementation: key of implementations
+
+    Returns:
+        seconds: wall time
+        cpu_seconds: CPU time of the JVM and the Python workers
+        checksum: sum of the hashes of the time columns
+    """
+    jvm_pid = int(spark.sparkContext._jvm.java.lang.management.ManagementFactory.getRuntimeMXBean()
+                  .getName().split('@')[0])
+    columns = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+
+    cpu0, t0 = process_tree_cpu(jvm_pid), perf_counter()
+    row = implementations[implementation](df).select(count('*').alias('rows'),
+                                                     sum_(hash_(*columns)).alias('checksum')).first()
+    seconds, cpu_seconds = perf_counter() - t0, process_tree_cpu(jvm_pid) - cpu0
+
+    return seconds, cpu_seconds, row['checksum']
+
+
+def main():
+    """
+    Description: This main function compares the wall and CPU time of the
+                 time columns derived with Python UDFs, with the pandas UDF
+                 and with the built-in expressions of transforms.py on a
+                 local Spark session, and writes the result as JSON
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the time transforms of the ETL')
+    parser.add_argument('--input', help='folder of the input data, its log data is scaled (default: generated ts)')
+    parser.add_argument('--events', type=int, default=10000000, help='generated ts without --input')
+    parser.add_argument('--scale', type=int, default=100, help='copies of the log data of --input')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--master', default='local[*]')
+    parser.add_argument('--output', default='benchmark_transforms.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    spark = create_spark_session(args.master)
+    results = []
+    try:
+        df = scaled_log_data(spark, args.input, args.events, args.scale)
+        rows = df.count()
+        print_status('benchmark_transforms', '{} ts persisted'.format(rows))
+        for run in range(args.repeat):
+            for implementation in implementations:
+                seconds, cpu_seconds, checksum = run_transform(spark, df, implementation)
+                results.append({'implementation': implementation, 'run': run, 'seconds': seconds,
+                                'cpu_seconds': cpu_seconds, 'checksum': checksum})
+                print_status('benchmark_transforms', '{}: {:.2f}s, {:.2f} CPU seconds'.format(
+                    implementation, seconds, cpu_seconds))
+    finally:
+        spark.stop()
+
+    # compared with the built-in expressions of the last run, the Python UDFs
+    # only match when the Python workers run in UTC
+    summary = {implementation: {'median_seconds': statistics.median(
+                                    r['seconds'] for r in results if r['implementation'] == implementation),
+                                'median_cpu_seconds': statistics.median(
+                                    r['cpu_seconds'] for r in results if r['implementation'] == implementation),
+                                'same_result': all(r['checksum'] == results[-1]['checksum']
+                                                   for r in results if r['implementation'] == implementation)}
+               for implementation in implementations}
+    with open(args.output, 'w') as f:
+        json.dump({'input': args.input or 'generated', 'rows': rows, 'runs': results, 'summary': summary},
+                  f, indent=2)
+
+    print('{:<12}{:>10}{:>14}{:>13}'.format('transform', 'seconds', 'CPU seconds', 'same result'))
+    for implementation, s in summary.items():
+        print('{:<12}{median_seconds:>10.2f}{median_cpu_seconds:>14.2f}{same_result!s:>13}'.format(implementation, **s))
+    print('report written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import math
+import os
+import uuid
+from datetime import datetime, timezone
+from pyspark import StorageLevel
+from pyspark.sql.functions import col, input_file_name
+from etl import create_spark_session
+from schemas import song_schema, log_schema, corrupt_column
+from tools import read_config, print_status
+
+
+# source prefix -> declared schema of its json-files
+sources = {'song_data': song_schema, 'log_data': log_schema}
+
+
+def hadoop_fs(spark, path):
+    """
+    Description: This function returns the Hadoop FileSystem of a path, the
+                 one Spark reads it with, eg. S3A for s3a:// paths
+
+    Arguments:
+        spark: Spark session
+        path: Path of a file or folder
+
+    Returns:
+        fs: Hadoop FileSystem
+        path: Hadoop Path
+    """
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
+
+
+def list_objects(spark, path, suffix):
+    """
+    Description: This function lists the files below a folder recursively.
+                 On S3 this is a flat listing of the prefix instead of one
+                 listing per folder level like the globs of etl.py.
+
+    Arguments:
+        spark: Spark session
+        path: Path of the folder
+        suffix: suffix of the files, eg. .json
+
+    Returns:
+        dict of path -> (size, modification time in milliseconds)
+    """
+    fs, hadoop_path = hadoop_fs(spark, path)
+    objects = {}
+    if not fs.exists(hadoop_path):
+        return objects
+
+    files = fs.listFiles(hadoop_path, True)
+    while files.hasNext():
+        status = files.next()
+        name = status.getPath().toString()
+        if name.endswith(suffix) and '/_' not in name:
+            objects[name] = (status.getLen(), status.getModificationTime())
+
+    return objects
+
+
+def read_manifest(spark, compacted_data, name):
+    """
+    Description: This function reads the manifest of the objects compacted
+                 from a source and removes the batches of a compaction that
+                 failed before its manifest was written, so that their
+                 objects are compacted again without duplicates
+
+    Arguments:
+        spark: Spark session
+        compacted_data: Path to the folder of the compacted data
+        name: Name of the source, eg. song_data
+
+    Returns:
+        dict of path -> (size, modification time) of the compacted objects
+    """
+    manifest_path = os.path.join(compacted_data, '_manifests', name)
+    fs, hadoop_path = hadoop_fs(spark, manifest_path)
+    manifest, batches = {}, set()
+    if fs.exists(hadoop_path):
+        for row in spark.read.json(manifest_path).collect():
+            manifest[row['object']] = (row['size'], row['modified'])
+            batches.add('batch={}'.format(row['batch']))
+
+    for folder in [os.path.join(compacted_data, name), os.path.join(compacted_data, '_corrupt_records', name)]:
+        fs, hadoop_path = hadoop_fs(spark, folder)
+        if fs.exists(hadoop_path):
+            for status in fs.listStatus(hadoop_path):
+                if status.isDirectory() and status.getPath().getName() not in batches:
+                    print_status('compaction', 'removing {} of a failed compaction'.format(status.getPath().toString()))
+                    fs.delete(status.getPath(), True)
+
+    return manifest
+
+
+def compact_source(spark, input_data, compacted_data, name, target_bytes=512 * 1024 * 1024):
+    """
+    Description: This function compacts the json-files of a source that are
+                 not in its manifest yet into a new batch of Parquet files
+                 typed by the declared schema, about one file per target_bytes
+                 of json. The corrupt records are written with their file name
+                 to _corrupt_records/<name>, the compacted objects are added
+                 to the manifest _manifests/<name> after the batch is written.
+                 Objects that changed after they were compacted are reported,
+                 not compacted again.
+
+    Arguments:
+        spark: Spark session
+        input_data: Path to the folder of the input data
+        compacted_data: Path to the folder of the compacted data
+        name: Name of the source, a key of sources
+        target_bytes: bytes of json per Parquet file
+
+    Returns:
+        dict with the listed, new and changed objects, the bytes and files of the batch
+    """
+    objects = list_objects(spark, os.path.join(input_data, name), '.json')
+    manifest = read_manifest(spark, compacted_data, name)
+    new = sorted(path for path in objects if path not in manifest)
+    changed = sorted(path for path in objects if path in manifest and objects[path] != manifest[path])
+    for path in changed:
+        print_status('compaction', '{} changed after it was compacted'.format(path))
+
+    stats = {'source': name, 'objects': len(objects), 'new': len(new), 'changed': len(changed), 'bytes': 0, 'files': 0}
+    if not new:
+        print_status('compaction', '{}: no new objects'.format(name))
+        return stats
+
+    # microseconds and a random suffix, two compactions in the same second write their own batch
+    batch = '{}-{}'.format(datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f'), uuid.uuid4().hex[:8])
+    stats['bytes'] = sum(objects[path][0] for path in new)
+    stats['files'] = max(math.ceil(stats['bytes'] / target_bytes), 1)
+
+    df = spark.read.json(new, schema=sources[name], mode='PERMISSIVE', columnNameOfCorruptRecord=corrupt_column) \
+              .persist(StorageLevel.MEMORY_AND_DISK)
+    try:
+        df.filter(col(corrupt_column).isNotNull()) \
+          .select(input_file_name().alias('file'), df.columns[0], corrupt_column) \
+          .write.json(os.path.join(compacted_data, '_corrupt_records', name, 'batch={}'.format(batch)))
+        df.filter(col(corrupt_column).isNull()).drop(corrupt_column) \
+          .repartition(stats['files']) \
+          .write.parquet(os.path.join(compacted_data, name, 'batch={}'.format(batch)))
+    finally:
+        df.unpersist()
+
+    spark.createDataFrame([(path, objects[path][0], objects[path][1], batch) for path in new],
+                          'object string, size long, modified long, batch string') \
+         .coalesce(1).write.mode('append').json(os.path.join(compacted_data, '_manifests', name))
+    print_status('compaction', '{}: {} objects, {} bytes compacted into {} files of batch {}'.format(
+        name, len(new), stats['bytes'], stats['files'], batch))
+
+    return stats
+
+
+def main():
+    """
+    Description: This main function compacts the new json-files of song data
+                 and log data
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Compact the json-files of the input data into Parquet files')
+    parser.add_argument('--input', default='s3a://udacity-dend', help='folder of the input data')
+    parser.add_argument('--output', help='folder of the compacted data (default: compacted in OUTPUT_PATH of dl.cfg)')
+    parser.add_argument('--sources', nargs='+', default=list(sources), choices=list(sources))
+    parser.add_argument('--target-mb', type=int, default=512, help='MB of json per Parquet file')
+    parser.add_argument('--master', help='eg. local[*] for local files')
+    args = parser.parse_args()
+
+    compacted_data = args.output
+    if os.path.exists('dl.cfg'):
+        output_data = read_config('dl.cfg')
+        compacted_data = compacted_data or os.path.join(output_data, 'compacted')
+    if compacted_data is None:
+        parser.error('--output is needed without dl.cfg')
+
+    spark = create_spark_session(args.master)
+    try:
+        for name in args.sources:
+            compact_source(spark, args.input, compacted_data, name, args.target_mb * 1024 * 1024)
+    finally:
+        spark.stop()
+
+
+if __name__ == "__main__":
+    main()
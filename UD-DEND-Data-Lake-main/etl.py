@@ -1,54 +1,169 @@
 import configparser
-from datetime import datetime
+import json
 import os
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, monotonically_increasing_id
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
-from tools import read_config, print_status
+from pyspark.sql.functions import monotonically_increasing_id, col, input_file_name
+from schemas import song_schema, log_schema, corrupt_column
+from joins import songplays_join, job_ids, task_skew
+from transforms import start_time, time_columns
+from tools import read_config, read_options, print_status
 
 
-def create_spark_session():
+def create_spark_session(master=None):
     """
     Description: This function creates a Spark session
 
     Arguments:
-        None
+        master: eg. local[*] for a local session reading local files,
+                None for the cluster
 
     Returns:
         spark: Spark session
     """
 
-    spark = SparkSession \
-        .builder \
-        .config('spark.jars.packages', 'org.apache.hadoop:hadoop-aws:2.7.0') \
+    builder = SparkSession.builder if master is None else SparkSession.builder.master(master)
+    if master is None:
+        builder = builder.config('spark.jars.packages', 'org.apache.hadoop:hadoop-aws:2.7.0')
+    spark = builder \
         .config('mapreduce.fileoutputcommitter.algorithm.version', '2') \
         .config('spark.sql.parquet.fs.optimized.committer.optimization-enabled', 'true') \
         .config('spark.sql.broadcastTimeout', '-1') \
+        .config('spark.sql.session.timeZone', 'UTC') \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def read_json(spark, path, schema, output_data, name, storage_level=None, condition=None, metrics=None):
     """
-    Description: This function reads the json-files from song data,
-                 processes them, and writes song table and artist table to AWS S3
+    Description: This function reads json-files with a declared schema, so
+                 that Spark does not read all files once more to infer it.
+                 Records that are malformed or do not match the schema are
+                 written with their file name to corrupt_records/<name> in
+                 the output data instead of being read as rows of nulls.
+                 With a storage level the records are persisted, the write of
+                 the corrupt records reads the files and fills the cache, and
+                 every later table write reads the cache instead of the files.
 
     Arguments:
         spark: Spark session
-        input_data: Path to the folder of the input data
+        path: Path of the json-files
+        schema: StructType of the records, with the corrupt record column,
+                None to infer the schema
         output_data: Path to the folder of the output data
+        name: Name of the source, eg. song_data
+        storage_level: StorageLevel of the records, None to read the files for every write
+        condition: Column of the valid records to keep, eg. only NextSong events
+        metrics: dict of the job metrics, see count_scans
+
+    Returns:
+        df: DataFrame of the valid records, without the corrupt record column
+        source: DataFrame the records are persisted with, to unpersist after the last write
+    """
+    if schema is None:
+        source = spark.read.json(path=path, columnNameOfCorruptRecord=corrupt_column)
+    else:
+        source = spark.read.json(path=path, schema=schema, mode='PERMISSIVE', columnNameOfCorruptRecord=corrupt_column)
+    has_corrupt_column = corrupt_column in source.columns
+    if condition is not None:
+        source = source.filter(condition | col(corrupt_column).isNotNull()) if has_corrupt_column else source.filter(condition)
+    if storage_level is not None:
+        source = source.persist(storage_level)
+    if metrics is not None:
+        metrics['source_scans'][name] = int(schema is None) + int(storage_level is not None)
+    if not has_corrupt_column:
+        return source, source
+
+    # Spark refuses queries on json-files that only read the corrupt record
+    # column, the file name and the first field are read with it
+    corrupt_records_outpath = os.path.join(output_data, 'corrupt_records', name)
+    corrupt_records = source.filter(col(corrupt_column).isNotNull()) \
+                            .select(input_file_name().alias('file'), source.columns[0], corrupt_column)
+    count_scans(corrupt_records, 'corrupt_records/' + name, metrics)
+    corrupt_records.write.json(corrupt_records_outpath, 'overwrite')
+    print_status('read_json', '{} corrupt records written to {}'.format(name, corrupt_records_outpath))
+
+    return source.filter(col(corrupt_column).isNull()).drop(corrupt_column), source
+
+
+def read_compacted(spark, path, name, storage_level=None, condition=None, metrics=None):
+    """
+    Description: This function reads the Parquet files compaction.py wrote
+                 for a source instead of its json-files. They are typed by
+                 the declared schema and hold no corrupt records.
+
+    Arguments:
+        spark: Spark session
+        path: Path of the compacted source, eg. <compacted>/song_data
+        name: Name of the source, eg. song_data
+        storage_level: StorageLevel of the records, None to read the files for every write
+        condition: Column of the records to keep, eg. only NextSong events
+        metrics: dict of the job metrics, see count_scans
+
+    Returns:
+        df: DataFrame of the records
+        source: DataFrame the records are persisted with, to unpersist after the last write
+    """
+    source = spark.read.parquet(path)
+    if condition is not None:
+        source = source.filter(condition)
+    if storage_level is not None:
+        source = source.persist(storage_level)
+    if metrics is not None:
+        metrics['source_scans'][name] = int(storage_level is not None)
+
+    return source, source
+
+
+def count_scans(df, name, metrics):
+    """
+    Description: This function counts the scans of the json-files and of
+                 persisted DataFrames in the physical plan of a write, and
+                 adds the file scans to the source scans of the metrics. A
+                 persisted source is read once by the first write that scans
+                 it, read_json counts that scan.
+
+    Arguments:
+        df: DataFrame that is written
+        name: Name of the written table
+        metrics: dict of the job metrics, with the source_scans by source
+                 name and the list of writes, None to count nothing
 
     Returns:
         None
     """
+    if metrics is None:
+        return
 
-    # get filepath to song data file
-    song_data_inpath = os.path.join(input_data, 'song_data/*/*/*/*.json')
-    #song_data_inpath = os.path.join(input_data, 'song_data/A/A/A/*.json')
-    
-    # read song data file
-    df = spark.read.json(path=song_data_inpath)
-    print_status('process_song_data', 'song data loaded')
+    leaves = df._jdf.queryExecution().executedPlan().collectLeaves()
+    file_scans, cache_scans = 0, 0
+    for i in range(leaves.size()):
+        leaf = leaves.apply(i)
+        if leaf.getClass().getSimpleName() == 'InMemoryTableScanExec':
+            cache_scans += 1
+        elif leaf.getClass().getSimpleName() == 'FileSourceScanExec':
+            file_scans += 1
+            for source in metrics['source_scans']:
+                if source in leaf.toString():
+                    metrics['source_scans'][source] += 1
+    metrics['writes'].append({'table': name, 'file_scans': file_scans, 'cache_scans': cache_scans})
+    print_status('count_scans', '{}: {} file scans, {} cache scans'.format(name, file_scans, cache_scans))
+
+
+def process_song_data(spark, df, output_data, metrics=None):
+    """
+    Description: This function processes the records of song data,
+                 and writes song table and artist table to AWS S3
+
+    Arguments:
+        spark: Spark session
+        df: DataFrame of the song records returned by read_json
+        output_data: Path to the folder of the output data
+        metrics: dict of the job metrics, see count_scans
+
+    Returns:
+        None
+    """
 
     # extract columns to create songs table
     songs_table = df.select('song_id', 'title', 'artist_id', 'year', 'duration').distinct()
@@ -56,6 +171,7 @@ def process_song_data(spark, input_data, output_data):
     
     # write songs table to parquet files partitioned by year and artist
     songs_table_outpath = os.path.join(output_data, 'song_table.parquet')
+    count_scans(songs_table, 'songs_table', metrics)
     songs_table.write.partitionBy('year','artist_id').parquet(songs_table_outpath, 'overwrite')
     print_status('process_song_data', 'songs_table written to S3')
 
@@ -65,38 +181,32 @@ def process_song_data(spark, input_data, output_data):
 
     # write artists table to parquet files
     artists_table_outpath = os.path.join(output_data, 'artists_table.parquet')
+    count_scans(artists_table, 'artists_table', metrics)
     artists_table.write.parquet(artists_table_outpath, 'overwrite')
     print_status('process_song_data', 'artists_table written to S3')
 
-    # Create a view and cache this DataFrame to be able to access to this later
-    df.createOrReplaceTempView('song_df')
-    spark.table('song_df')
-    spark.table('song_df').cache
-    spark.table('song_df').count
-
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, df, song_df, output_data, metrics=None, join_strategy='auto',
+                     broadcast_threshold=64 * 1024 * 1024):
     """
-    Description: This function reads the json-files from log data,
-                 processes them, and writes users table,
-                 time table and songplays table to AWS S3
+    Description: This function processes the NextSong records of log data,
+                 and writes users table, time table and songplays table
+                 to AWS S3
 
     Arguments:
         spark: Spark session
-        input_data: Path to the folder of the input data
+        df: DataFrame of the log records returned by read_json
+        song_df: DataFrame of the song records returned by read_json
         output_data: Path to the folder of the output data
+        metrics: dict of the job metrics, see count_scans, the join strategy
+                 and the task times of the songplays write are added
+        join_strategy: strategy of the songplays join, see joins.songplays_join
+        broadcast_threshold: maximal size of the songs in bytes to broadcast them
 
     Returns:
         None
     """
 
-    # get filepath to log data file
-    log_data = os.path.join(input_data, 'log_data/*/*/*.json')
-
-    # read log data file
-    df = spark.read.json(path=log_data)
-    print_status('process_log_data', 'log data loaded')
-    
     # filter by actions for song plays
     df = df.filter(df.page == 'NextSong')
 
@@ -106,38 +216,25 @@ def process_log_data(spark, input_data, output_data):
 
     # write users table to parquet files
     users_table_outpath = os.path.join(output_data, 'users_table.parquet')
+    count_scans(users_table, 'users_table', metrics)
     users_table.write.parquet(users_table_outpath, 'overwrite')
     print_status('process_log_data', 'users_table written to S3')
 
-    # create timestamp column from original timestamp column
-    get_timestamp_udf = udf(lambda x: int(x / 1000))
-    df = df.withColumn('timestamp', get_timestamp_udf('ts').cast('Integer'))
-    
-    # create datetime column from original timestamp column
-    get_datetime_udf = udf(lambda x: str(datetime.fromtimestamp(x)))
-    df = df.withColumn('start_time', get_datetime_udf('timestamp').cast('Timestamp'))
-    
+    # create start_time column from original timestamp column in milliseconds
+    df = df.withColumn('start_time', start_time('ts'))
+
     # extract columns to create time table
-    time_table = df.select('start_time') \
-                   .withColumn('hour', hour('start_time').cast('Integer')) \
-                   .withColumn('day', dayofmonth('start_time').cast('Integer')) \
-                   .withColumn('week', weekofyear('start_time').cast('Integer')) \
-                   .withColumn('month', month('start_time').cast('Integer')) \
-                   .withColumn('year', year('start_time').cast('Integer')) \
-                   .withColumn('weekday', date_format('start_time', 'u').cast('Integer')) \
-                   .distinct()
+    time_table = df.select('start_time', *time_columns('start_time')).distinct()
     print_status('process_log_data', 'time_table select completed')
 
     # write time table to parquet files partitioned by year and month
     time_table_outpath = os.path.join(output_data, 'time_table.parquet')
+    count_scans(time_table, 'time_table', metrics)
     time_table.write.partitionBy('year','month').parquet(time_table_outpath, 'overwrite')
     print_status('process_log_data', 'time_table written to S3')
 
-    # read in song data to use for songplays table
-    song_df = spark.sql('SELECT DISTINCT song_id, title, artist_id, artist_name FROM song_df')
-
     # extract columns from joined song and log datasets to create songplays table
-    songplays_table_join = df.join(song_df, (df.song==song_df.title) & (df.artist==song_df.artist_name), how='left')
+    songplays_table_join = songplays_join(spark, df, song_df, metrics, join_strategy, broadcast_threshold)
     songplays_table = songplays_table_join.select(monotonically_increasing_id().alias('songplay_id'),
                                                   'start_time',
                                                   'userId',
@@ -150,13 +247,84 @@ def process_log_data(spark, input_data, output_data):
 
     # write songplays table to parquet files
     songplays_table_outpath = os.path.join(output_data, 'songplays_table.parquet')
+    count_scans(songplays_table, 'songplays_table', metrics)
+    before = job_ids(spark)
     songplays_table.write.parquet(songplays_table_outpath, 'overwrite')
+    print_status('process_log_data', 'songplays_table written to S3')
+
+    if metrics is not None:
+        metrics['songplays_join'].update(task_skew(spark, before))
+        print_status('process_log_data', 'songplays_table task skew {}'.format(metrics['songplays_join']['max_skew']))
+
+
+def run_etl(spark, input_data, output_data, infer_schema=False, storage_level=StorageLevel.MEMORY_AND_DISK,
+            join_strategy='auto', broadcast_threshold=64 * 1024 * 1024, compacted_data=None):
+    """
+    Description: This function reads song data and log data once each,
+                 persisted with the storage level, writes all tables from
+                 them and unpersists them afterwards. With compacted_data
+                 they are read from the Parquet files of compaction.py.
+
+    Arguments:
+        spark: Spark session
+        input_data: Path to the folder of the input data
+        output_data: Path to the folder of the output data
+        infer_schema: infer the schemas instead of using song_schema and log_schema
+        storage_level: StorageLevel of the song and log records, None to read
+                       the files for every write
+        join_strategy: strategy of the songplays join, see joins.songplays_join
+        broadcast_threshold: maximal size of the songs in bytes to broadcast them
+        compacted_data: Path to the folder of the compacted data, None to read the json-files
+
+    Returns:
+        metrics: dict with the scans of every source and of every write, and
+                 the strategy and task skew of the songplays join
+    """
+    metrics = {'storage_level': str(storage_level), 'infer_schema': infer_schema, 'compacted_data': compacted_data,
+               'source_scans': {}, 'writes': []}
+
+    # get filepath to song data file
+    song_data_inpath = os.path.join(input_data, 'song_data/*/*/*/*.json')
+    #song_data_inpath = os.path.join(input_data, 'song_data/A/A/A/*.json')
+
+    # get filepath to log data file
+    log_data_inpath = os.path.join(input_data, 'log_data/*/*/*.json')
+
+    persisted = []
+    try:
+        if compacted_data is None:
+            song_df, source = read_json(spark, song_data_inpath, None if infer_schema else song_schema, output_data,
+                                        'song_data', storage_level, metrics=metrics)
+        else:
+            song_df, source = read_compacted(spark, os.path.join(compacted_data, 'song_data'), 'song_data',
+                                             storage_level, metrics=metrics)
+        persisted.append(source)
+        print_status('run_etl', 'song data loaded')
+        process_song_data(spark, song_df, output_data, metrics)
+
+        # only the NextSong events are persisted
+        if compacted_data is None:
+            log_df, source = read_json(spark, log_data_inpath, None if infer_schema else log_schema, output_data,
+                                       'log_data', storage_level, col('page') == 'NextSong', metrics)
+        else:
+            log_df, source = read_compacted(spark, os.path.join(compacted_data, 'log_data'), 'log_data',
+                                            storage_level, col('page') == 'NextSong', metrics)
+        persisted.append(source)
+        print_status('run_etl', 'log data loaded')
+        process_log_data(spark, log_df, song_df, output_data, metrics, join_strategy, broadcast_threshold)
+    finally:
+        for source in persisted:
+            source.unpersist()
+
+    print_status('run_etl', 'source scans: {}'.format(metrics['source_scans']))
+    return metrics
 
 
 def main():
     """
     Description: This main function specifies the input_data and output_data. 
-                 It also triggers the functions process_song_data and process_log_data.
+                 It also triggers the function run_etl and writes its
+                 metrics to the METRICS_REPORT of the config file.
     
     Arguments:
         None
@@ -165,11 +333,19 @@ def main():
         None
     """
     output_data = read_config('dl.cfg')
+    options = read_options('dl.cfg')
     spark = create_spark_session()
     input_data = 's3a://udacity-dend'
-    
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+
+    storage_level = options.get('STORAGE_LEVEL', fallback='MEMORY_AND_DISK')
+    metrics = run_etl(spark, input_data, output_data,
+                      storage_level=None if storage_level == 'NONE' else getattr(StorageLevel, storage_level),
+                      join_strategy=options.get('JOIN_STRATEGY', fallback='auto'),
+                      broadcast_threshold=options.getint('BROADCAST_THRESHOLD', fallback=64 * 1024 * 1024),
+                      compacted_data=options.get('COMPACTED_PATH', fallback='') or None)
+
+    with open(options.get('METRICS_REPORT', fallback='etl_metrics.json'), 'w') as f:
+        json.dump(metrics, f, indent=2)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+import math
+import statistics
+from pyspark.sql.functions import broadcast, col, lit, lower, trim, regexp_replace, rand, explode, sequence, when
+from tools import print_status
+
+
+# names of the normalized join keys, on both sides of the songplays join
+join_keys = ['song_key', 'artist_key']
+
+strategies = ['auto', 'broadcast', 'salted', 'shuffle']
+
+
+def normalize_key(column):
+    """
+    Description: This function normalizes a free text join key: lower case,
+                 without leading and trailing blanks and with single blanks
+
+    Arguments:
+        column: name of the column
+
+    Returns:
+        Column of the normalized key
+    """
+    return lower(trim(regexp_replace(col(column), r'\s+', ' ')))
+
+
+def size_in_bytes(df):
+    """
+    Description: This function returns the size Spark estimates for a
+                 DataFrame. For a persisted DataFrame that was read once it is
+                 the size in memory.
+
+    Arguments:
+        df: DataFrame
+
+    Returns:
+        size in bytes
+    """
+    return int(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString())
+
+
+def hot_keys(spark, df, skew_factor=1.0, max_keys=1000):
+    """
+    Description: This function finds the join keys of the log records that
+                 have more records than skew_factor times the records of one
+                 shuffle partition, each with the number of salts that splits
+                 it into parts of about one partition
+
+    Arguments:
+        spark: Spark session
+        df: DataFrame of log records with the join keys
+        skew_factor: records of a hot key relative to the records of one partition
+        max_keys: maximal number of hot keys, the hottest are salted
+
+    Returns:
+        list of tuples of the join keys, their records and salts
+    """
+    partitions = int(spark.conf.get('spark.sql.shuffle.partitions'))
+    counts = df.groupBy(*join_keys).count().filter(col('song_key').isNotNull() & col('artist_key').isNotNull())
+    records = counts.groupBy().sum('count').first()[0] or 0
+    partition_records = max(records / partitions, 1)
+
+    rows = counts.filter(col('count') > skew_factor * partition_records) \
+                 .orderBy(col('count').desc()).limit(max_keys).collect()
+    return [(row['song_key'], row['artist_key'], row['count'],
+             min(math.ceil(row['count'] / partition_records), partitions)) for row in rows]
+
+
+def songplays_join(spark, df, song_df, metrics=None, strategy='auto', broadcast_threshold=64 * 1024 * 1024,
+                   skew_factor=1.0):
+    """
+    Description: This function left joins the NextSong records to the songs by
+                 song title and artist name. The keys are normalized once on
+                 both sides. With the strategy auto the songs are broadcast
+                 when their estimated size fits broadcast_threshold, otherwise
+                 the hot keys of the log records are salted: their records are
+                 spread over several salts and their songs are repeated for
+                 every salt, so that no task joins all records of a popular
+                 song. Without hot keys the join is a plain shuffle join.
+
+    Arguments:
+        spark: Spark session
+        df: DataFrame of the NextSong records
+        song_df: DataFrame of the song records
+        metrics: dict of the job metrics, the strategy is added as songplays_join
+        strategy: one of strategies
+        broadcast_threshold: maximal size of the songs in bytes to broadcast them
+        skew_factor: see hot_keys
+
+    Returns:
+        DataFrame of the NextSong records with song_id and artist_id of their song
+    """
+    if strategy not in strategies:
+        raise ValueError('join strategy {} is not one of {}'.format(strategy, strategies))
+
+    songs = song_df.select('song_id', 'artist_id',
+                           normalize_key('title').alias('song_key'),
+                           normalize_key('artist_name').alias('artist_key')).distinct()
+    df = df.withColumn('song_key', normalize_key('song')).withColumn('artist_key', normalize_key('artist'))
+
+    song_bytes = size_in_bytes(songs)
+    if strategy == 'auto':
+        strategy = 'broadcast' if song_bytes <= broadcast_threshold else 'salted'
+    hot = hot_keys(spark, df, skew_factor) if strategy == 'salted' else []
+    if strategy == 'salted' and not hot:
+        strategy = 'shuffle'
+
+    if strategy == 'broadcast':
+        joined = df.join(broadcast(songs), join_keys, how='left')
+    elif strategy == 'shuffle':
+        joined = df.join(songs, join_keys, how='left')
+    else:
+        hot_df = spark.createDataFrame([(song_key, artist_key, salts) for song_key, artist_key, _, salts in hot],
+                                       'song_key string, artist_key string, salts int')
+        df = df.join(broadcast(hot_df), join_keys, how='left') \
+               .withColumn('salt', when(col('salts').isNull(), lit(0))
+                                   .otherwise((rand(42) * col('salts')).cast('int'))) \
+               .drop('salts')
+        songs = songs.join(broadcast(hot_df), join_keys, how='left') \
+                     .withColumn('salt', explode(sequence(lit(0), when(col('salts').isNull(), lit(0))
+                                                                  .otherwise(col('salts') - 1)))) \
+                     .drop('salts')
+        joined = df.join(songs, join_keys + ['salt'], how='left').drop('salt')
+
+    print_status('songplays_join', '{} join, songs estimated at {} bytes, {} hot keys'.format(
+        strategy, song_bytes, len(hot)))
+    if metrics is not None:
+        metrics['songplays_join'] = {'strategy': strategy, 'song_bytes': song_bytes,
+                                     'broadcast_threshold': broadcast_threshold,
+                                     'hot_keys': [{'song_key': song_key, 'artist_key': artist_key,
+                                                   'records': records, 'salts': salts}
+                                                  for song_key, artist_key, records, salts in hot]}
+
+    return joined
+
+
+def job_ids(spark):
+    """
+    Description: This function returns the ids of the jobs the status store
+                 of the Spark context knows, the same store the Spark UI reads
+
+    Arguments:
+        spark: Spark session
+
+    Returns:
+        set of job ids
+    """
+    jobs = spark.sparkContext._jsc.sc().statusStore().jobsList(None)
+    return {jobs.apply(i).jobId() for i in range(jobs.size())}
+
+
+def task_skew(spark, before):
+    """
+    Description: This function returns the task times of the stages of the
+                 jobs that started after the job ids before, and the skew of
+                 the stage with the largest ratio of the longest to the median
+                 task time
+
+    Arguments:
+        spark: Spark session
+        before: set of job ids returned by job_ids
+
+    Returns:
+        dict with the task times of every stage and the maximal skew
+    """
+    sc = spark.sparkContext._jsc.sc()
+    try:
+        # the status store is updated by the listener bus after the jobs ended
+        sc.listenerBus().waitUntilEmpty(10000)
+    except Exception:
+        pass
+    store = sc.statusStore()
+
+    stages = {}
+    jobs = store.jobsList(None)
+    for i in range(jobs.size()):
+        job = jobs.apply(i)
+        if job.jobId() in before:
+            continue
+        stage_ids = job.stageIds()
+        for j in range(stage_ids.size()):
+            stage_id = stage_ids.apply(j)
+            attempts = store.stageData(stage_id, False)
+            for k in range(attempts.size()):
+                tasks = store.taskList(stage_id, attempts.apply(k).attemptId(), 2 ** 31 - 1)
+                durations = [tasks.apply(t).duration().get() for t in range(tasks.size())
+                             if tasks.apply(t).duration().isDefined()]
+                if durations:
+                    median = statistics.median(durations)
+                    stages[stage_id] = {'tasks': len(durations), 'median_ms': median, 'max_ms': max(durations),
+                                        'skew': max(durations) / median if median else None}
+
+    skews = [stage['skew'] for stage in stages.values() if stage['skew'] is not None]
+    return {'stages': stages, 'max_skew': max(skews) if skews else None}
@@ -0,0 +1,174 @@
+import argparse
+import itertools
+import json
+import os
+import random
+from datetime import datetime, timezone
+
+
+first_names = ['Adler', 'Kaylee', 'Walter', 'Ryan', 'Jacqueline', 'Layla', 'Tegan', 'Chloe', 'Mohammad', 'Lily']
+last_names  = ['Barrera', 'Summers', 'Frye', 'Smith', 'Lynch', 'Griffin', 'Levine', 'Cuevas', 'Rodriguez', 'Koch']
+locations   = ['New York-Newark-Jersey City, NY-NJ-PA', 'San Francisco-Oakland-Hayward, CA',
+               'Phoenix-Mesa-Scottsdale, AZ', 'Atlanta-Sandy Springs-Roswell, GA']
+user_agent  = '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"'
+
+# 2018-11-01 00:00:00 UTC in milliseconds, the start of the original log data
+start_ts = 1541030400000
+
+
+def generate_songs(num_songs, seed=42):
+    """
+    Description: This function generates song records like the files of song_data
+
+    Arguments:
+        num_songs: number of songs
+        seed: seed of the random generator
+
+    Returns:
+        list of dicts
+    """
+    rng = random.Random(seed)
+    num_artists = max(num_songs // 4, 1)
+    songs = []
+    for i in range(num_songs):
+        artist = rng.randrange(num_artists)
+        has_location = rng.random() < 0.4
+        songs.append({'num_songs': 1,
+                      'artist_id': 'AR{:016d}'.format(artist),
+                      'artist_latitude': round(rng.uniform(-90, 90), 5) if has_location else None,
+                      'artist_longitude': round(rng.uniform(-180, 180), 5) if has_location else None,
+                      'artist_location': rng.choice(locations) if has_location else '',
+                      'artist_name': 'Artist Name {}'.format(artist),
+                      'song_id': 'SO{:016d}'.format(i),
+                      'title': 'Song Title {}'.format(i),
+                      'duration': round(rng.uniform(60.0, 480.0), 5),
+                      'year': rng.choice([0, rng.randint(1960, 2018)])})
+
+    return songs
+
+
+def generate_events(num_events, songs, num_users=1000, unknown_song_ratio=0.3, start=start_ts, seed=42):
+    """
+    Description: This function generates log records in increasing ts order.
+                 80% of the events are NextSong events playing a Zipf
+                 distributed song, a share of them plays songs missing in songs
+
+    Arguments:
+        num_events: number of events
+        songs: records returned by generate_songs
+        num_users: number of users
+        unknown_song_ratio: share of NextSong events playing an unknown song
+        start: ts of the first event in milliseconds
+        seed: seed of the random generator
+
+    Returns:
+        list of dicts
+    """
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, len(songs) + 1)))
+    users = [(str(user_id), rng.choice(first_names), rng.choice('MF'), rng.choice(last_names),
+              rng.choice(['free', 'paid']), rng.choice(locations)) for user_id in range(1, num_users + 1)]
+
+    events = []
+    ts = start
+    for i in range(num_events):
+        ts += rng.randint(0, 20000)
+        user_id, first_name, gender, last_name, level, location = rng.choice(users)
+        if rng.random() < 0.8:
+            if rng.random() < unknown_song_ratio:
+                artist, song, length = 'Unknown Artist {}'.format(i % 997), 'Unknown Song {}'.format(i), 200.0
+            else:
+                song_record = rng.choices(songs, cum_weights=cum_weights)[0]
+                artist, song, length = song_record['artist_name'], song_record['title'], song_record['duration']
+            page, method = 'NextSong', 'PUT'
+        else:
+            artist, song, length = None, None, None
+            page, method = rng.choice(['Home', 'Logout', 'Settings']), 'GET'
+        events.append({'artist': artist, 'auth': 'Logged In', 'firstName': first_name, 'gender': gender,
+                       'itemInSession': i % 50, 'lastName': last_name, 'length': length, 'level': level,
+                       'location': location, 'method': method, 'page': page, 'registration': 1540344794796.0,
+                       'sessionId': int(user_id), 'song': song, 'status': 200, 'ts': ts, 'userAgent': user_agent,
+                       'userId': user_id})
+
+    return events
+
+
+def write_lines(path, records, rng, corrupt_share):
+    """
+    Description: This function writes records as json lines, a share of them
+                 truncated like a malformed line
+
+    Arguments:
+        path: path of the file
+        records: list of dicts
+        rng: random generator
+        corrupt_share: share of malformed lines
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        for record in records:
+            line = json.dumps(record)
+            f.write((line[:len(line) // 2] if rng.random() < corrupt_share else line) + '\n')
+
+
+def write_sample(path, num_songs, num_events, corrupt_share=0.0, seed=42):
+    """
+    Description: This function writes a sample in the layout of the input
+                 data: one small file per song in song_data/A/B/C/ by the
+                 letters of the track id, one file per day in
+                 log_data/<year>/<month>/<date>-events.json
+
+    Arguments:
+        path: Path to the folder of the sample
+        num_songs: number of song files
+        num_events: number of log records
+        corrupt_share: share of malformed lines
+        seed: seed of the random generator
+
+    Returns:
+        number of song files and of log files
+    """
+    rng = random.Random(seed)
+    songs = generate_songs(num_songs, seed)
+    for i, song in enumerate(songs):
+        track = 'TR' + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(3)) + '{:013d}'.format(i)
+        write_lines(os.path.join(path, 'song_data', track[2], track[3], track[4], track + '.json'), [song],
+                    rng, corrupt_share)
+
+    days = {}
+    for event in generate_events(num_events, songs, seed=seed):
+        day = datetime.fromtimestamp(event['ts'] / 1000, timezone.utc).strftime('%Y-%m-%d')
+        days.setdefault(day, []).append(event)
+    for day, events in days.items():
+        write_lines(os.path.join(path, 'log_data', day[:4], day[5:7], day + '-events.json'), events,
+                    rng, corrupt_share)
+
+    return len(songs), len(days)
+
+
+def main():
+    """
+    Description: This main function writes a sample of song and log files
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Write a local sample of song_data and log_data')
+    parser.add_argument('path', help='folder of the sample')
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=500000)
+    parser.add_argument('--corrupt-share', type=float, default=0.0, help='share of malformed lines')
+    args = parser.parse_args()
+
+    print('{} song files and {} log files written'.format(*write_sample(args.path, args.songs, args.events,
+                                                                         args.corrupt_share)))
+
+
+if __name__ == "__main__":
+    main()
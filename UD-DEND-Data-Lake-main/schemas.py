@@ -0,0 +1,46 @@
+from pyspark.sql.types import StructType, StructField, StringType, LongType, DoubleType
+
+
+# malformed JSON lines and records whose values do not match the schema are
+# kept as raw text in this column instead of being read as rows of nulls
+corrupt_column = '_corrupt_record'
+
+# fields of the song files, with the types Spark infers for them, eg.
+# {"num_songs": 1, "artist_id": "ARJIE2Y1187B994AB7", "artist_latitude": null, ..., "year": 0}
+song_schema = StructType([
+    StructField('num_songs', LongType()),
+    StructField('artist_id', StringType()),
+    StructField('artist_latitude', DoubleType()),
+    StructField('artist_longitude', DoubleType()),
+    StructField('artist_location', StringType()),
+    StructField('artist_name', StringType()),
+    StructField('song_id', StringType()),
+    StructField('title', StringType()),
+    StructField('duration', DoubleType()),
+    StructField('year', LongType()),
+    StructField(corrupt_column, StringType()),
+])
+
+# fields of the log files, with the types Spark infers for them. userId stays a
+# string, it is empty for logged out users
+log_schema = StructType([
+    StructField('artist', StringType()),
+    StructField('auth', StringType()),
+    StructField('firstName', StringType()),
+    StructField('gender', StringType()),
+    StructField('itemInSession', LongType()),
+    StructField('lastName', StringType()),
+    StructField('length', DoubleType()),
+    StructField('level', StringType()),
+    StructField('location', StringType()),
+    StructField('method', StringType()),
+    StructField('page', StringType()),
+    StructField('registration', DoubleType()),
+    StructField('sessionId', LongType()),
+    StructField('song', StringType()),
+    StructField('status', LongType()),
+    StructField('ts', LongType()),
+    StructField('userAgent', StringType()),
+    StructField('userId', StringType()),
+    StructField(corrupt_column, StringType()),
+])
@@ -23,6 +23,26 @@ def read_config(config_path):
     return output_path
 
 
+def read_options(config_path):
+    """
+    Description: Reads the options of the ETL from the ETL section of the
+                 config file
+
+    Arguments:
+        config_path: path to config file
+
+    Returns:
+        options: section ETL of the config, empty if the config file has none
+    """
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    if not config.has_section('ETL'):
+        config.add_section('ETL')
+
+    return config['ETL']
+
+
 def print_status(module_name, message):
     """
     Description: Prints status with timestamp
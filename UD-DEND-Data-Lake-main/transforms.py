@@ -0,0 +1,98 @@
+from pyspark.sql.functions import col, year, month, dayofmonth, dayofweek, hour, weekofyear
+from pyspark.sql.types import TimestampType
+
+
+# The transforms are built-in Spark column expressions, they run in the JVM of
+# the executors without moving the rows to Python workers. The timestamps are
+# instants, hour, day, ... of them depend on spark.sql.session.timeZone, which
+# create_spark_session sets to UTC.
+
+def start_time(ts='ts'):
+    """
+    Description: This function returns the start time of log records, the ts
+                 in milliseconds truncated to seconds like the former UDFs
+
+    Arguments:
+        ts: name of the column of the ts in milliseconds
+
+    Returns:
+        Column of TimestampType
+    """
+    return (col(ts) / 1000).cast('long').cast('timestamp')
+
+
+def iso_weekday(start_time='start_time'):
+    """
+    Description: This function returns the ISO day of the week, 1 for Monday
+                 to 7 for Sunday, like date_format(start_time, 'u') of Spark
+                 2.4, which newer Spark versions refuse. dayofweek counts from
+                 1 for Sunday.
+
+    Arguments:
+        start_time: name of the column of TimestampType
+
+    Returns:
+        Column of IntegerType
+    """
+    return (dayofweek(start_time) + 5) % 7 + 1
+
+
+def time_columns(start_time='start_time'):
+    """
+    Description: This function returns the columns of the time table derived
+                 from the start time
+
+    Arguments:
+        start_time: name of the column of TimestampType
+
+    Returns:
+        list of Columns hour, day, week, month, year and weekday
+    """
+    return [hour(start_time).alias('hour'),
+            dayofmonth(start_time).alias('day'),
+            weekofyear(start_time).alias('week'),
+            month(start_time).alias('month'),
+            year(start_time).alias('year'),
+            iso_weekday(start_time).alias('weekday')]
+
+
+def start_time_pandas_udf():
+    """
+    Description: This function returns a vectorized pandas UDF of start_time,
+                 the fallback for Spark versions or ts formats without a
+                 built-in expression. The ts are moved to the Python workers
+                 in Arrow batches. pandas and pyarrow are only needed when
+                 this function is called.
+
+    Arguments:
+        None
+
+    Returns:
+        pandas UDF taking the column of the ts in milliseconds
+    """
+    import pandas as pd
+    from pyspark.sql.functions import pandas_udf, PandasUDFType
+
+    # naive timestamps of a pandas UDF are read in the session time zone, UTC
+    @pandas_udf(TimestampType(), PandasUDFType.SCALAR)
+    def start_time_udf(ts):
+        return pd.to_datetime(ts // 1000, unit='s')
+
+    return start_time_udf
+
+
+def with_time_columns(df, ts='ts', vectorized=False):
+    """
+    Description: This function adds the start time and the columns of the
+                 time table to log records
+
+    Arguments:
+        df: DataFrame of log records
+        ts: name of the column of the ts in milliseconds
+        vectorized: derive the start time with start_time_pandas_udf
+
+    Returns:
+        DataFrame with the columns start_time, hour, day, week, month, year and weekday
+    """
+    df = df.withColumn('start_time', start_time_pandas_udf()(ts) if vectorized else start_time(ts))
+    return df.select('*', *time_columns('start_time'))
@@ -0,0 +1,126 @@
+import argparse
+import re
+import shutil
+import subprocess
+from time import perf_counter
+from cql_queries import table_registry, table_profiles
+from etl import staging_names, read_staging, write_staging_arrow, create_session, create_tables, drop_tables, load_table
+from event_generator import generate_events
+from benchmark_queries import sample_parameters, run_query_pattern
+
+
+def table_size(session, nodetool, keyspace, table):
+    """
+    Description: This function flushes a table and returns its on-disk size.
+                 nodetool reports the live SSTable size, without nodetool the
+                 size is estimated from system.size_estimates
+
+    Arguments:
+        session: the session object
+        nodetool: path of the nodetool binary, None to use size_estimates
+        keyspace: keyspace of the table
+        table: name of the table
+
+    Returns:
+        size in bytes
+    """
+    if nodetool:
+        subprocess.run([nodetool, 'flush', keyspace, table], check=True)
+        output = subprocess.run([nodetool, 'tablestats', '{}.{}'.format(keyspace, table)],
+                                check=True, capture_output=True, text=True).stdout
+        match = re.search(r'Space used \(live\): (\d+)', output)
+        if match:
+            return int(match.group(1))
+
+    rows = session.execute("SELECT mean_partition_size, partitions_count FROM system.size_estimates "
+                           "WHERE keyspace_name=%s AND table_name=%s", (keyspace, table))
+    return sum(row.mean_partition_size * row.partitions_count for row in rows)
+
+
+def benchmark_profile(session, profile, staging_path, rows, args):
+    """
+    Description: This function recreates the tables with a storage profile,
+                 loads the staging file and queries the tables
+
+    Arguments:
+        session: the session object
+        profile: name of the profile in table_profiles
+        staging_path: path of the staging file
+        rows: list of the staging rows, used to draw query keys
+        args: parsed command line arguments
+
+    Returns:
+        list of result dicts, one per table
+    """
+    drop_tables(session)
+    create_tables(session, profile)
+
+    results = []
+    for table, definition in table_registry.items():
+        t0 = perf_counter()
+        num_rows = load_table(session, table, staging_path, concurrency=args.concurrency)
+        load_time = perf_counter() - t0
+
+        parameters = sample_parameters(rows, definition['select_columns'], args.requests)
+        stats = run_query_pattern(session, table, parameters, args.clients)
+
+        results.append({
+            'profile': profile,
+            'table': table,
+            'rows_per_sec': num_rows / load_time if load_time else 0.0,
+            'p50_ms': stats['p50_ms'],
+            'p99_ms': stats['p99_ms'],
+            'size_mb': table_size(session, args.nodetool, args.keyspace, table) / 2 ** 20,
+        })
+
+    return results
+
+
+def main():
+    """
+    Description: This main function loads and queries a synthetic event set with
+                 every storage profile and prints write throughput, read latency
+                 and on-disk size per profile and table
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark of the Cassandra table storage profiles')
+    parser.add_argument('--profiles', nargs='+', choices=sorted(table_profiles), default=sorted(table_profiles))
+    parser.add_argument('--rows', type=int, default=2000000, help='number of synthetic event rows')
+    parser.add_argument('--requests', type=int, default=50000, help='requests per query pattern')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--nodetool', help="path of nodetool, '' to use size_estimates "
+                                           "(default: nodetool on the PATH, else size_estimates)")
+    parser.add_argument('--staging', default='event_datafile_bench.arrow')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--port', type=int, default=9042)
+    parser.add_argument('--keyspace', default='udacity_profiles')
+    args = parser.parse_args()
+    if args.nodetool is None:
+        args.nodetool = shutil.which('nodetool')
+        if args.nodetool is None:
+            print('nodetool not found, the sizes are estimated from system.size_estimates')
+
+    write_staging_arrow(generate_events(args.rows), args.staging)
+    rows = list(read_staging(args.staging, staging_names))
+
+    cluster, session = create_session(args.hosts, args.port, args.keyspace)
+    try:
+        results = []
+        for profile in args.profiles:
+            results.extend(benchmark_profile(session, profile, args.staging, rows, args))
+    finally:
+        cluster.shutdown()
+
+    print('{:<16}{:<24}{:>12}{:>10}{:>10}{:>10}'.format('profile', 'table', 'rows/s', 'p50 ms', 'p99 ms', 'size MB'))
+    for result in results:
+        print('{profile:<16}{table:<24}{rows_per_sec:>12.0f}{p50_ms:>10.2f}{p99_ms:>10.2f}{size_mb:>10.1f}'.format(**result))
+
+
+if __name__ == "__main__":
+    main()
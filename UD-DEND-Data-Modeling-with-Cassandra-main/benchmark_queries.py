@@ -0,0 +1,213 @@
+import argparse
+import math
+import random
+import threading
+from time import perf_counter
+from cql_queries import table_registry
+from etl import staging_names, read_staging, write_staging_arrow, create_session, create_tables, load_tables
+from event_generator import generate_events
+
+
+class AsyncClient:
+    """
+    Description: A benchmark client that keeps one prepared statement in flight
+                 at a time and issues the next request from the callback of
+                 the previous one. N clients on one session give N concurrent requests.
+    """
+
+    def __init__(self, session, prepared, parameters, done):
+        self.session = session
+        self.prepared = prepared
+        self.parameters = parameters
+        self.done = done
+        self.latencies = []
+        self.errors = 0
+        self.position = 0
+
+    def start(self):
+        self.send()
+
+    def send(self):
+        if self.position == len(self.parameters):
+            self.done()
+            return
+        params = self.parameters[self.position]
+        self.position += 1
+        t0 = perf_counter()
+        future = self.session.execute_async(self.prepared, params)
+        future.add_callbacks(self.on_success, self.on_error, callback_args=(t0,), errback_args=(t0,))
+
+    def on_success(self, rows, t0):
+        self.latencies.append(perf_counter() - t0)
+        self.send()
+
+    def on_error(self, exc, t0):
+        self.errors += 1
+        self.send()
+
+
+def sample_parameters(rows, columns, num_requests, seed=7):
+    """
+    Description: This function draws query parameters from the loaded rows,
+                 so that the keys follow the distribution of the data set
+                 (popular songs and long sessions are queried more often)
+
+    Arguments:
+        rows: list of loaded staging rows
+        columns: staging columns bound to the SELECT
+        num_requests: number of parameter tuples to draw
+        seed: seed of the random generator
+
+    Returns:
+        list of parameter tuples
+    """
+    rng = random.Random(seed)
+    positions = [staging_names.index(c) for c in columns]
+    return [tuple(row[p] for p in positions) for row in rng.choices(rows, k=num_requests)]
+
+
+def percentile(values, p):
+    """
+    Description: This function returns the p-th percentile of sorted values
+                 (nearest rank)
+
+    Arguments:
+        values: sorted list of values
+        p: percentile between 0 and 100
+
+    Returns:
+        the percentile value
+    """
+    if not values:
+        return float('nan')
+    rank = max(math.ceil(p / 100.0 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def histogram(latencies, base_ms=0.125, buckets=16):
+    """
+    Description: This function counts latencies in power-of-two buckets
+
+    Arguments:
+        latencies: list of latencies in seconds
+        base_ms: upper bound of the first bucket in milliseconds
+        buckets: number of buckets, the last one is open-ended
+
+    Returns:
+        list of (upper bound in ms, count) tuples
+    """
+    bounds = [base_ms * 2 ** i for i in range(buckets - 1)] + [float('inf')]
+    counts = [0] * buckets
+    for latency in latencies:
+        ms = latency * 1000.0
+        for i, bound in enumerate(bounds):
+            if ms <= bound:
+                counts[i] += 1
+                break
+
+    return list(zip(bounds, counts))
+
+
+def run_query_pattern(session, table, parameters, num_clients):
+    """
+    Description: This function runs the SELECT of a table with prepared
+                 statements from num_clients concurrent async clients
+
+    Arguments:
+        session: the session object
+        table: name of the table in the table registry
+        parameters: list of parameter tuples, split among the clients
+        num_clients: number of concurrent clients
+
+    Returns:
+        stats: dict with throughput, latency percentiles and histogram
+    """
+    prepared = session.prepare(table_registry[table]['select'])
+    finished = threading.Semaphore(0)
+    clients = [AsyncClient(session, prepared, parameters[i::num_clients], finished.release)
+               for i in range(num_clients)]
+
+    t0 = perf_counter()
+    for client in clients:
+        client.start()
+    for _ in clients:
+        finished.acquire()
+    elapsed = perf_counter() - t0
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    return {
+        'table': table,
+        'requests': len(latencies),
+        'errors': sum(client.errors for client in clients),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000.0,
+        'p90_ms': percentile(latencies, 90) * 1000.0,
+        'p99_ms': percentile(latencies, 99) * 1000.0,
+        'max_ms': latencies[-1] * 1000.0 if latencies else float('nan'),
+        'histogram': histogram(latencies),
+    }
+
+
+def print_stats(stats):
+    """
+    Description: This function prints the summary and latency histogram of a query pattern
+
+    Arguments:
+        stats: dict returned by run_query_pattern
+
+    Returns:
+        None
+    """
+    print('{table}: {requests} requests, {errors} errors, {throughput:.0f} req/s, '
+          'p50 {p50_ms:.2f} ms, p90 {p90_ms:.2f} ms, p99 {p99_ms:.2f} ms, max {max_ms:.2f} ms'.format(**stats))
+    lower = 0.0
+    for bound, count in stats['histogram']:
+        if count:
+            print('    {:>9.3f} - {:<9} ms {:>8}'.format(lower, '{:.3f}'.format(bound), count))
+        lower = bound
+
+
+def main():
+    """
+    Description: This main function loads a scaled synthetic event set into a
+                 local Cassandra instance and benchmarks the three query patterns
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Latency benchmark of the Cassandra read path')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--port', type=int, default=9042)
+    parser.add_argument('--keyspace', default='udacity_bench')
+    parser.add_argument('--rows', type=int, default=1000000, help='number of synthetic event rows')
+    parser.add_argument('--requests', type=int, default=100000, help='requests per query pattern')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--skip-load', action='store_true', help='reuse the data of a previous run')
+    parser.add_argument('--staging', default='event_datafile_bench.arrow')
+    args = parser.parse_args()
+
+    if not args.skip_load:
+        write_staging_arrow(generate_events(args.rows), args.staging)
+    rows = list(read_staging(args.staging, staging_names))
+
+    cluster, session = create_session(args.hosts, args.port, args.keyspace)
+    try:
+        if not args.skip_load:
+            create_tables(session)
+            load_tables(session, args.staging, concurrency=256)
+
+        for table, definition in table_registry.items():
+            parameters = sample_parameters(rows, definition['select_columns'], args.requests)
+            for num_clients in args.clients:
+                stats = run_query_pattern(session, table, parameters, num_clients)
+                print('clients={}'.format(num_clients), end=' ')
+                print_stats(stats)
+    finally:
+        cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import os
+import statistics
+from time import perf_counter
+from cql_queries import table_registry
+from etl import (get_event_files, process_event_files, read_staging,
+                 create_session, create_tables, load_tables)
+
+
+def time_read(staging_path):
+    """
+    Description: This function reads the columns of every table in the
+                 table registry from a staging file, without inserting them
+
+    Arguments:
+        staging_path: path of the csv or arrow staging file
+
+    Returns:
+        elapsed time in seconds
+    """
+    t0 = perf_counter()
+    for definition in table_registry.values():
+        for _ in read_staging(staging_path, definition['columns']):
+            pass
+
+    return perf_counter() - t0
+
+
+def time_load(session, file_path_list, out_path, fmt):
+    """
+    Description: This function measures the end-to-end load: consolidating
+                 the event files into one staging format and loading all tables
+
+    Arguments:
+        session: the session object, None to skip the Cassandra inserts
+        file_path_list: list of event csv files
+        out_path: staging file path without extension
+        fmt: 'csv' or 'arrow'
+
+    Returns:
+        timings: dict with the consolidate, read and load times in seconds
+    """
+    t0 = perf_counter()
+    staging_path = process_event_files(file_path_list, out_path, fmt)[0]
+    timings = {'consolidate': perf_counter() - t0,
+               'read': time_read(staging_path)}
+
+    if session is not None:
+        for table in table_registry:
+            session.execute('TRUNCATE {}'.format(table))
+        t0 = perf_counter()
+        load_tables(session, staging_path)
+        timings['load'] = perf_counter() - t0
+
+    timings['total'] = timings['consolidate'] + timings.get('load', timings['read'])
+    return timings
+
+
+def main():
+    """
+    Description: This main function compares the end-to-end load time of the
+                 csv and the arrow staging file and prints the median timings
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark csv vs. arrow staging for the Cassandra load')
+    parser.add_argument('--event-data', default=os.path.join(os.getcwd(), 'event_data'))
+    parser.add_argument('--staging', default='event_datafile_bench')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--no-cassandra', action='store_true', help='only time consolidation and reads')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--port', type=int, default=9042)
+    args = parser.parse_args()
+
+    file_path_list = get_event_files(args.event_data)
+    cluster, session = None, None
+    if not args.no_cassandra:
+        cluster, session = create_session(args.hosts, args.port)
+        create_tables(session)
+
+    try:
+        results = {}
+        for fmt in ('csv', 'arrow'):
+            runs = [time_load(session, file_path_list, args.staging, fmt) for _ in range(args.repeat)]
+            results[fmt] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    finally:
+        if cluster is not None:
+            cluster.shutdown()
+
+    print('{:<8}{:>14}{:>10}{:>10}{:>10}'.format('format', 'consolidate', 'read', 'load', 'total'))
+    for fmt, timings in results.items():
+        print('{:<8}{:>14.3f}{:>10.3f}{:>10}{:>10.3f}'.format(
+            fmt, timings['consolidate'], timings['read'],
+            '{:.3f}'.format(timings['load']) if 'load' in timings else '-', timings['total']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import argparse
+import bisect
+import csv
+import multiprocessing
+import os
+import struct
+from time import perf_counter
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.metadata import Murmur3Token
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
+from cql_queries import table_registry
+from etl import staging_names, staging_types, convert_value, create_session, create_tables, pa
+
+
+def serialize_value(value, data_type):
+    """
+    Description: This function serializes a partition key component
+                 the way Cassandra does for int and text columns
+
+    Arguments:
+        value: value of the component
+        data_type: type of the staging column in staging_columns
+
+    Returns:
+        bytes
+    """
+    if value is None:
+        raise ValueError('a partition key component must not be null')
+    if data_type == 'int32':
+        return struct.pack('>i', value)
+    return value.encode('utf8')
+
+
+def partition_token(values, data_types):
+    """
+    Description: This function computes the Murmur3 token of a partition key.
+                 Composite keys are encoded as <length><bytes><0> per component
+
+    Arguments:
+        values: partition key values
+        data_types: staging types of the partition key columns
+
+    Returns:
+        token as int
+    """
+    if len(values) == 1:
+        key = serialize_value(values[0], data_types[0])
+    else:
+        key = b''.join(struct.pack('>H', len(b)) + b + b'\x00'
+                       for b in (serialize_value(v, t) for v, t in zip(values, data_types)))
+
+    return Murmur3Token.hash_fn(key)
+
+
+def get_ring(hosts, port, keyspace):
+    """
+    Description: This function reads the token ring of the cluster
+
+    Arguments:
+        hosts: contact points of the cluster
+        port: native transport port
+        keyspace: keyspace to use
+
+    Returns:
+        sorted list of the ring tokens
+    """
+    cluster, session = create_session(hosts, port, keyspace)
+    try:
+        return sorted(token.value for token in cluster.metadata.token_map.ring)
+    finally:
+        cluster.shutdown()
+
+
+def staging_splits(staging_path, num_workers):
+    """
+    Description: This function splits the staging file into one range per worker
+                 without reading its rows: row ranges of the arrow file from its
+                 record batch metadata, byte ranges of the csv file from its size
+
+    Arguments:
+        staging_path: path of the csv or arrow staging file
+        num_workers: number of worker processes
+
+    Returns:
+        list of (start, stop) per worker
+    """
+    if staging_path.endswith('.arrow'):
+        if pa is None:
+            raise ImportError('the arrow staging file needs the pyarrow package')
+        with pa.memory_map(staging_path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            size = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    else:
+        size = os.path.getsize(staging_path)
+
+    bounds = [size * i // num_workers for i in range(num_workers + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_staging_csv_range(path, columns, start, stop):
+    """
+    Description: This function reads the csv staging lines starting in the byte
+                 range [start, stop). A line starting before start belongs to the
+                 previous range. Quoted values must not contain line breaks
+
+    Arguments:
+        path: path of the csv file
+        columns: staging columns to read
+        start: first byte of the range
+        stop: end of the range
+
+    Returns:
+        generator of row tuples
+    """
+    positions = [staging_names.index(c) for c in columns]
+    types = [staging_types[c] for c in columns]
+
+    with open(path, 'rb') as f:
+        # skip the header, or the rest of the line the previous range reads
+        f.seek(max(start - 1, 0))
+        f.readline()
+
+        def lines():
+            while f.tell() < stop:
+                line = f.readline()
+                if not line:
+                    return
+                yield line.decode('utf8')
+
+        for line in csv.reader(lines()):
+            yield tuple(convert_value(line[p], t) for p, t in zip(positions, types))
+
+
+def read_staging_arrow_range(path, columns, start, stop):
+    """
+    Description: This function memory-maps the arrow staging file and reads
+                 the rows [start, stop) as zero-copy slices of its record batches
+
+    Arguments:
+        path: path of the arrow file
+        columns: staging columns to read
+        start: first row of the range
+        stop: end of the range
+
+    Returns:
+        generator of row tuples
+    """
+    with pa.memory_map(path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        offset = 0
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            if offset < stop and offset + batch.num_rows > start:
+                chunk = batch.select(columns).slice(max(start - offset, 0), stop - max(start, offset))
+                yield from zip(*(column.to_pylist() for column in chunk.columns))
+            offset += batch.num_rows
+
+
+def read_partition(table, staging_path, split, ring):
+    """
+    Description: This function runs in a worker process. It reads the worker's
+                 range of the staging file and sorts the rows by the token of
+                 their partition key, so that consecutive inserts go to the
+                 same replicas. Rows with a null partition key are skipped
+
+    Arguments:
+        table: name of the table in the table registry
+        staging_path: path of the csv or arrow staging file
+        split: (start, stop) range of the staging file from staging_splits
+        ring: sorted list of the ring tokens
+
+    Returns:
+        rows: rows sorted by token
+        num_ranges: number of token ranges the rows fall into
+        skipped: number of rows with a null partition key
+    """
+    definition = table_registry[table]
+    columns = definition['columns']
+    positions = [columns.index(c) for c in definition['partition_key']]
+    data_types = [staging_types[c] for c in definition['partition_key']]
+    read_range = read_staging_arrow_range if staging_path.endswith('.arrow') else read_staging_csv_range
+
+    tokens = []
+    skipped = 0
+    for row in read_range(staging_path, columns, *split):
+        values = [row[p] for p in positions]
+        if any(v is None for v in values):
+            skipped += 1
+            continue
+        tokens.append((partition_token(values, data_types), row))
+    tokens.sort(key=lambda r: r[0])
+
+    # a token t belongs to the range (ring[i - 1], ring[i]], the last range wraps around
+    num_ranges = len({bisect.bisect_left(ring, token) % len(ring) for token, _ in tokens})
+    return [row for _, row in tokens], num_ranges, skipped
+
+
+def load_partition(args):
+    """
+    Description: This function runs in a worker process. It reads its range of
+                 the staging file, opens its own token-aware session and inserts the rows
+
+    Arguments:
+        args: tuple of (worker id, table, staging path, (start, stop) range,
+              ring tokens, hosts, port, keyspace, concurrency)
+
+    Returns:
+        stats: dict with worker id, rows, errors, the first error, skipped rows,
+               ranges and elapsed seconds
+    """
+    worker_id, table, staging_path, split, ring, hosts, port, keyspace, concurrency = args
+    rows, num_ranges, skipped = read_partition(table, staging_path, split, ring)
+    profile = ExecutionProfile(load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    cluster = Cluster(list(hosts), port=port, execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    session = cluster.connect(keyspace)
+
+    stats = {'worker': worker_id, 'rows': 0, 'errors': 0, 'first_error': None, 'skipped': skipped,
+             'ranges': num_ranges}
+    try:
+        prepared = session.prepare(table_registry[table]['insert'])
+        t0 = perf_counter()
+        for success, result in execute_concurrent_with_args(session, prepared, rows,
+                                                            concurrency=concurrency,
+                                                            results_generator=True):
+            if success:
+                stats['rows'] += 1
+            else:
+                stats['errors'] += 1
+                stats['first_error'] = stats['first_error'] or str(result)
+        stats['elapsed'] = perf_counter() - t0
+    finally:
+        cluster.shutdown()
+
+    return stats
+
+
+def merge_stats(table, worker_stats, elapsed):
+    """
+    Description: This function merges the stats of the workers
+
+    Arguments:
+        table: name of the loaded table
+        worker_stats: list of dicts returned by load_partition
+        elapsed: wall time of the whole load in seconds
+
+    Returns:
+        stats: dict with totals, throughput and the per-worker stats
+    """
+    rows = sum(s['rows'] for s in worker_stats)
+    return {
+        'table': table,
+        'workers': len(worker_stats),
+        'rows': rows,
+        'errors': sum(s['errors'] for s in worker_stats),
+        'skipped': sum(s['skipped'] for s in worker_stats),
+        'first_error': next((s['first_error'] for s in worker_stats if s['first_error']), None),
+        'elapsed': elapsed,
+        'rows_per_sec': rows / elapsed if elapsed else 0.0,
+        'slowest_worker': max(s['elapsed'] for s in worker_stats),
+        'per_worker': worker_stats,
+    }
+
+
+def bulk_load(table, staging_path, hosts, port, keyspace, num_workers, concurrency=128):
+    """
+    Description: This function loads a table from the staging file with
+                 num_workers processes, each reading its own range of the file
+
+    Arguments:
+        table: name of the table in the table registry
+        staging_path: path of the csv or arrow staging file
+        hosts: contact points of the cluster
+        port: native transport port
+        keyspace: keyspace to use
+        num_workers: number of worker processes
+        concurrency: requests in flight per worker
+
+    Returns:
+        stats: merged stats of the load
+    """
+    ring = get_ring(hosts, port, keyspace)
+    splits = staging_splits(staging_path, num_workers)
+
+    # spawn instead of fork: the driver's event loop threads must not be copied into the workers
+    context = multiprocessing.get_context('spawn')
+    t0 = perf_counter()
+    with context.Pool(num_workers) as pool:
+        worker_stats = pool.map(load_partition, [
+            (worker_id, table, staging_path, split, ring, tuple(hosts), port, keyspace, concurrency)
+            for worker_id, split in enumerate(splits)])
+
+    return merge_stats(table, worker_stats, perf_counter() - t0)
+
+
+def main():
+    """
+    Description: This main function bulk loads all tables of the table
+                 registry once per worker count and prints the throughput.
+                 It exits with status 1 when a load has more failed inserts
+                 than --max-errors.
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Token-aware multi-process bulk loader for Cassandra')
+    parser.add_argument('--staging', default='event_datafile_new.arrow')
+    parser.add_argument('--workers', type=int, nargs='+', default=[multiprocessing.cpu_count()])
+    parser.add_argument('--concurrency', type=int, default=128)
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--port', type=int, default=9042)
+    parser.add_argument('--keyspace', default='udacity')
+    parser.add_argument('--max-errors', type=int, default=0, help='failed inserts per table load that are tolerated')
+    args = parser.parse_args()
+
+    cluster, session = create_session(args.hosts, args.port, args.keyspace)
+    try:
+        create_tables(session)
+    finally:
+        cluster.shutdown()
+
+    print('{:<24}{:>8}{:>10}{:>8}{:>9}{:>10}{:>12}'.format('table', 'workers', 'rows', 'errors', 'skipped',
+                                                            'seconds', 'rows/s'))
+    for num_workers in args.workers:
+        for table in table_registry:
+            stats = bulk_load(table, args.staging, args.hosts, args.port, args.keyspace,
+                              num_workers, args.concurrency)
+            print('{table:<24}{workers:>8}{rows:>10}{errors:>8}{skipped:>9}'
+                  '{elapsed:>10.2f}{rows_per_sec:>12.0f}'.format(**stats))
+            if stats['errors'] > args.max_errors:
+                raise SystemExit('{} inserts into {} failed, more than --max-errors {}, eg. {}'.format(
+                    stats['errors'], table, args.max_errors, stats['first_error']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# KEYSPACE
+keyspace_create = ("""CREATE KEYSPACE IF NOT EXISTS {}
+                      WITH REPLICATION =
+                      {{ 'class' : 'SimpleStrategy', 'replication_factor' : 1 }}
+""")
+
+# DROP TABLES
+song_info_session_drop     = "DROP TABLE IF EXISTS song_info_session"
+song_playlist_session_drop = "DROP TABLE IF EXISTS song_playlist_session"
+user_info_song_drop        = "DROP TABLE IF EXISTS user_info_song"
+
+# CREATE TABLES
+song_info_session_create = ("""CREATE TABLE IF NOT EXISTS song_info_session (
+                               session_id        int,
+                               item_in_session   int,
+                               artist            text,
+                               song_title        text,
+                               song_length       float,
+                               PRIMARY KEY (session_id, item_in_session))
+""")
+
+song_playlist_session_create = ("""CREATE TABLE IF NOT EXISTS song_playlist_session (
+                                   user_id           int,
+                                   session_id        int,
+                                   item_in_session   int,
+                                   song_title        text,
+                                   artist            text,
+                                   first_name        text,
+                                   last_name         text,
+                                   PRIMARY KEY ((user_id, session_id), item_in_session))
+""")
+
+user_info_song_create = ("""CREATE TABLE IF NOT EXISTS user_info_song (
+                            song_title   text,
+                            user_id      int,
+                            first_name   text,
+                            last_name    text,
+                            PRIMARY KEY (song_title, user_id))
+""")
+
+# INSERT RECORDS
+song_info_session_insert = ("""INSERT INTO song_info_session (
+                               session_id, item_in_session, artist, song_title, song_length)
+                               VALUES (?, ?, ?, ?, ?)
+""")
+
+song_playlist_session_insert = ("""INSERT INTO song_playlist_session (
+                                   user_id, session_id, item_in_session, song_title, artist, first_name, last_name)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)
+""")
+
+user_info_song_insert = ("""INSERT INTO user_info_song (
+                            song_title, user_id, first_name, last_name)
+                            VALUES (?, ?, ?, ?)
+""")
+
+# SELECT RECORDS
+song_info_session_select = ("""SELECT artist, song_title, song_length
+                               FROM song_info_session
+                               WHERE session_id=? AND item_in_session=?
+""")
+
+song_playlist_session_select = ("""SELECT artist, song_title, first_name, last_name
+                                   FROM song_playlist_session
+                                   WHERE user_id=? AND session_id=?
+""")
+
+user_info_song_select = ("""SELECT first_name, last_name
+                            FROM user_info_song
+                            WHERE song_title=?
+""")
+
+# TABLE REGISTRY
+# 'columns' lists the event_datafile_new columns bound to the INSERT, in order,
+# 'partition_key' the columns forming the partition key and
+# 'select_columns' the columns bound to the SELECT of the query the table answers
+table_registry = {
+    'song_info_session': {
+        'create': song_info_session_create,
+        'drop': song_info_session_drop,
+        'insert': song_info_session_insert,
+        'select': song_info_session_select,
+        'columns': ['sessionId', 'itemInSession', 'artist', 'song', 'length'],
+        'partition_key': ['sessionId'],
+        'select_columns': ['sessionId', 'itemInSession'],
+    },
+    'song_playlist_session': {
+        'create': song_playlist_session_create,
+        'drop': song_playlist_session_drop,
+        'insert': song_playlist_session_insert,
+        'select': song_playlist_session_select,
+        'columns': ['userId', 'sessionId', 'itemInSession', 'song', 'artist', 'firstName', 'lastName'],
+        'partition_key': ['userId', 'sessionId'],
+        'select_columns': ['userId', 'sessionId'],
+    },
+    'user_info_song': {
+        'create': user_info_song_create,
+        'drop': user_info_song_drop,
+        'insert': user_info_song_insert,
+        'select': user_info_song_select,
+        'columns': ['song', 'userId', 'firstName', 'lastName'],
+        'partition_key': ['song'],
+        'select_columns': ['song'],
+    },
+}
+
+# TABLE PROFILES
+# storage options appended to the CREATE TABLE statements as WITH clause, per profile and table.
+# The session tables are append-only and ordered by time, so 'time_series' compacts them
+# in daily windows and expires them after 90 days, whole expired SSTables are then dropped
+# without compaction. user_info_song is read by song_title and keeps leveled compaction.
+twcs_daily = ("{'class': 'TimeWindowCompactionStrategy', "
+              "'compaction_window_unit': 'DAYS', 'compaction_window_size': 1}")
+lcs        = "{'class': 'LeveledCompactionStrategy'}"
+lz4_16kb   = "{'class': 'LZ4Compressor', 'chunk_length_in_kb': 16}"
+zstd_64kb  = "{'class': 'ZstdCompressor', 'chunk_length_in_kb': 64}"
+
+table_profiles = {
+    'default': {},
+    'time_series': {
+        'song_info_session': {
+            'compaction': twcs_daily,
+            'default_time_to_live': 90 * 24 * 3600,
+            'gc_grace_seconds': 3 * 3600,
+            'compression': lz4_16kb,
+        },
+        'song_playlist_session': {
+            'compaction': twcs_daily,
+            'default_time_to_live': 90 * 24 * 3600,
+            'gc_grace_seconds': 3 * 3600,
+            'compression': lz4_16kb,
+        },
+        'user_info_song': {
+            'compaction': lcs,
+            'compression': lz4_16kb,
+        },
+    },
+    'compact_storage': {
+        'song_info_session': {'compaction': lcs, 'compression': zstd_64kb},
+        'song_playlist_session': {'compaction': lcs, 'compression': zstd_64kb},
+        'user_info_song': {'compaction': lcs, 'compression': zstd_64kb},
+    },
+}
+
+# options of a table without a profile, the options a profile does not set are
+# reset to them when the profile is applied to an existing table
+default_table_options = {
+    'compaction': "{'class': 'SizeTieredCompactionStrategy'}",
+    'default_time_to_live': 0,
+    'gc_grace_seconds': 864000,
+    'compression': "{'class': 'LZ4Compressor'}",
+}
+
+
+def create_table_query(table, profile='default'):
+    """
+    Description: This function returns the CREATE TABLE statement of a table
+                 with the storage options of the given profile
+
+    Arguments:
+        table: name of the table in the table registry
+        profile: name of the profile in table_profiles
+
+    Returns:
+        CREATE TABLE statement
+    """
+    options = table_profiles[profile].get(table, {})
+    query = table_registry[table]['create'].rstrip()
+    if options:
+        query += ' WITH ' + ' AND '.join('{} = {}'.format(k, v) for k, v in options.items())
+
+    return query
+
+
+def alter_table_query(table, profile):
+    """
+    Description: This function returns the ALTER TABLE statement giving an
+                 existing table the storage options of the given profile,
+                 CREATE TABLE IF NOT EXISTS leaves them as they were
+
+    Arguments:
+        table: name of the table in the table registry
+        profile: name of the profile in table_profiles
+
+    Returns:
+        ALTER TABLE statement
+    """
+    options = dict(default_table_options, **table_profiles[profile].get(table, {}))
+
+    return 'ALTER TABLE {} WITH '.format(table) + ' AND '.join('{} = {}'.format(k, v) for k, v in options.items())
+
+
+# QUERY LISTS
+create_table_queries = [table['create'] for table in table_registry.values()]
+drop_table_queries   = [table['drop'] for table in table_registry.values()]
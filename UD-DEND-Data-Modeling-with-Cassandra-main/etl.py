@@ -0,0 +1,495 @@
+import argparse
+import csv
+import glob
+import json
+import os
+from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent_with_args
+from cql_queries import (keyspace_create, table_registry, create_table_query, alter_table_query, drop_table_queries,
+                         table_profiles)
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+# columns and types of event_datafile_new, the staging file all tables are loaded from.
+# The types are named like the pyarrow types of the Arrow staging file, the csv staging
+# file is written and read without pyarrow
+staging_columns = [
+    ('artist', 'string'),
+    ('firstName', 'string'),
+    ('gender', 'string'),
+    ('itemInSession', 'int32'),
+    ('lastName', 'string'),
+    ('length', 'float64'),
+    ('level', 'string'),
+    ('location', 'string'),
+    ('sessionId', 'int32'),
+    ('song', 'string'),
+    ('userId', 'int32'),
+]
+staging_names = [name for name, _ in staging_columns]
+staging_types = dict(staging_columns)
+
+# positions of the staging columns in the rows of the original event csv files
+event_columns = (0, 2, 3, 4, 5, 6, 7, 8, 12, 13, 16)
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def get_event_files(filepath):
+    """
+    Description: This function collects the filepaths of all
+                 daily event csv files below the given folder
+
+    Arguments:
+        filepath: path to the event_data folder
+
+    Returns:
+        file_path_list: sorted list of the event csv files
+    """
+    file_path_list = []
+    for root, dirs, files in os.walk(filepath):
+        file_path_list.extend(glob.glob(os.path.join(root, '*.csv')))
+
+    return sorted(file_path_list)
+
+
+def read_event_rows(file_path_list):
+    """
+    Description: This function reads the original event csv files and
+                 yields the staging columns of every row with an artist
+
+    Arguments:
+        file_path_list: list of event csv files
+
+    Returns:
+        generator of rows (tuples of strings) in staging column order
+    """
+    for f in file_path_list:
+        with open(f, 'r', encoding='utf8', newline='') as csvfile:
+            csvreader = csv.reader(csvfile)
+            next(csvreader)
+            for line in csvreader:
+                if line[0] == '':
+                    continue
+                yield tuple(line[i] for i in event_columns)
+
+
+def arrow_schema():
+    """
+    Description: This function returns the Arrow schema of the staging
+                 columns, the Arrow staging file needs the pyarrow package
+
+    Arguments:
+        None
+
+    Returns:
+        pyarrow schema
+    """
+    if pa is None:
+        raise ImportError('the arrow staging file needs the pyarrow package')
+
+    return pa.schema([(name, getattr(pa, data_type)()) for name, data_type in staging_columns])
+
+
+def convert_value(value, data_type):
+    """
+    Description: This function converts a csv string to the python value
+                 of the given staging type, empty strings become None
+
+    Arguments:
+        value: csv string
+        data_type: type of the column in staging_columns
+
+    Returns:
+        converted value
+    """
+    if data_type == 'string':
+        return value
+    if value == '':
+        return None
+    if data_type.startswith('int'):
+        return int(value)
+    return float(value)
+
+
+def write_staging_csv(rows, path):
+    """
+    Description: This function writes the staging rows to a quoted csv file
+
+    Arguments:
+        rows: iterable of staging rows
+        path: path of the csv file
+
+    Returns:
+        number of rows written
+    """
+    num_rows = 0
+    with open(path, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(staging_names)
+        for row in rows:
+            writer.writerow(row)
+            num_rows += 1
+
+    return num_rows
+
+
+def write_staging_arrow(rows, path, batch_size=65536):
+    """
+    Description: This function writes the staging rows to a typed,
+                 memory-mappable Arrow IPC file
+
+    Arguments:
+        rows: iterable of staging rows
+        path: path of the arrow file
+        batch_size: number of rows per record batch
+
+    Returns:
+        number of rows written
+    """
+    num_rows = 0
+    schema = arrow_schema()
+
+    def flush(batch_rows, writer):
+        columns = [pa.array([convert_value(row[i], data_type) for row in batch_rows], type=field.type)
+                   for i, (field, (_, data_type)) in enumerate(zip(schema, staging_columns))]
+        writer.write_batch(pa.record_batch(columns, schema=schema))
+
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        batch_rows = []
+        for row in rows:
+            batch_rows.append(row)
+            if len(batch_rows) == batch_size:
+                flush(batch_rows, writer)
+                num_rows += len(batch_rows)
+                batch_rows = []
+        if batch_rows:
+            flush(batch_rows, writer)
+            num_rows += len(batch_rows)
+
+    return num_rows
+
+
+def process_event_files(file_path_list, out_path, fmt='both'):
+    """
+    Description: This function consolidates the event csv files into
+                 the staging file event_datafile_new in csv and/or arrow format.
+                 Without pyarrow 'both' writes only the csv file.
+
+    Arguments:
+        file_path_list: list of event csv files
+        out_path: staging file path without extension
+        fmt: 'csv', 'arrow' or 'both'
+
+    Returns:
+        paths: list of the written staging files
+    """
+    paths = []
+    num_rows = 0
+
+    # every format streams its own pass over the event files,
+    # so the rows are never held in memory all at once
+    if fmt in ('csv', 'both'):
+        paths.append(out_path + '.csv')
+        num_rows = write_staging_csv(read_event_rows(file_path_list), paths[-1])
+    if fmt == 'both' and pa is None:
+        print('pyarrow is not installed, only the csv staging file is written')
+    elif fmt in ('arrow', 'both'):
+        paths.append(out_path + '.arrow')
+        num_rows = write_staging_arrow(read_event_rows(file_path_list), paths[-1])
+
+    print('{} rows written to {}'.format(num_rows, ', '.join(paths)))
+    return paths
+
+
+def read_staging_csv(path, columns):
+    """
+    Description: This function reads the given columns from the csv
+                 staging file and converts them to their staging types
+
+    Arguments:
+        path: path of the csv file
+        columns: staging columns to read
+
+    Returns:
+        generator of row tuples
+    """
+    positions = [staging_names.index(c) for c in columns]
+    types = [staging_types[c] for c in columns]
+
+    with open(path, encoding='utf8', newline='') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)
+        for line in csvreader:
+            yield tuple(convert_value(line[p], t) for p, t in zip(positions, types))
+
+
+def read_staging_arrow(path, columns, chunk_size=4096):
+    """
+    Description: This function memory-maps the arrow staging file and
+                 reads the given columns without copying or parsing them.
+                 Only chunk_size rows of a record batch are converted at a time
+
+    Arguments:
+        path: path of the arrow file
+        columns: staging columns to read
+        chunk_size: number of rows converted to python values at a time
+
+    Returns:
+        generator of row tuples
+    """
+    if pa is None:
+        raise ImportError('the arrow staging file needs the pyarrow package')
+
+    with pa.memory_map(path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i).select(columns)
+            for offset in range(0, batch.num_rows, chunk_size):
+                chunk = batch.slice(offset, chunk_size)
+                yield from zip(*(column.to_pylist() for column in chunk.columns))
+
+
+def read_staging(path, columns):
+    """
+    Description: This function reads the given columns from a csv or
+                 arrow staging file, chosen by its extension
+
+    Arguments:
+        path: path of the staging file
+        columns: staging columns to read
+
+    Returns:
+        generator of row tuples
+    """
+    if path.endswith('.arrow'):
+        return read_staging_arrow(path, columns)
+    return read_staging_csv(path, columns)
+
+
+def read_ingest_state(state_path):
+    """
+    Description: This function reads the record of already ingested
+                 daily event files
+
+    Arguments:
+        state_path: path of the json state file
+
+    Returns:
+        state: dict of file name -> size, mtime and rows of the ingested file
+    """
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def get_new_event_files(file_path_list, state):
+    """
+    Description: This function selects the event files that have not been
+                 ingested yet or have changed since they were ingested
+
+    Arguments:
+        file_path_list: list of event csv files
+        state: dict returned by read_ingest_state
+
+    Returns:
+        list of the new or changed event csv files
+    """
+    new_files = []
+    for f in file_path_list:
+        stat = os.stat(f)
+        ingested = state.get(os.path.basename(f))
+        if ingested is None or ingested['size'] != stat.st_size or ingested['mtime'] != stat.st_mtime:
+            new_files.append(f)
+
+    return new_files
+
+
+def record_ingested_files(state, file_path_list, state_path):
+    """
+    Description: This function adds the loaded event files to the state
+                 and writes it atomically, so a failed run ingests them again
+
+    Arguments:
+        state: dict returned by read_ingest_state
+        file_path_list: list of the loaded event csv files
+        state_path: path of the json state file
+
+    Returns:
+        None
+    """
+    for f in file_path_list:
+        stat = os.stat(f)
+        state[os.path.basename(f)] = {'size': stat.st_size,
+                                      'mtime': stat.st_mtime,
+                                      'rows': sum(1 for _ in read_event_rows([f]))}
+
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def create_session(hosts=('127.0.0.1',), port=9042, keyspace='udacity'):
+    """
+    Description: This function connects to the Cassandra cluster,
+                 creates the keyspace if needed and sets it on the session
+
+    Arguments:
+        hosts: contact points of the cluster
+        port: native transport port
+        keyspace: keyspace to use
+
+    Returns:
+        cluster: the cluster object
+        session: the session object
+    """
+    cluster = Cluster(list(hosts), port=port)
+    session = cluster.connect()
+    session.execute(keyspace_create.format(keyspace))
+    session.set_keyspace(keyspace)
+
+    return cluster, session
+
+
+def create_tables(session, profile=None):
+    """
+    Description: This function creates the tables of the table registry.
+                 With a profile the storage options of the tables that exist
+                 already are altered to it too.
+
+    Arguments:
+        session: the session object
+        profile: name of the storage profile in table_profiles, None to keep
+                 the options of existing tables
+
+    Returns:
+        None
+    """
+    for table in table_registry:
+        session.execute(create_table_query(table, profile or 'default'))
+        if profile is not None:
+            session.execute(alter_table_query(table, profile))
+
+
+def drop_tables(session):
+    """
+    Description: This function drops the tables of the table registry
+
+    Arguments:
+        session: the session object
+
+    Returns:
+        None
+    """
+    for query in drop_table_queries:
+        session.execute(query)
+
+
+def load_table(session, table, staging_path, concurrency=100):
+    """
+    Description: This function inserts the staging rows into a table
+                 with a prepared statement and concurrent requests
+
+    Arguments:
+        session: the session object
+        table: name of the table in the table registry
+        staging_path: path of the csv or arrow staging file
+        concurrency: number of requests in flight
+
+    Returns:
+        num_rows: number of inserted rows
+    """
+    definition = table_registry[table]
+    prepared = session.prepare(definition['insert'])
+    rows = read_staging(staging_path, definition['columns'])
+
+    num_rows = 0
+    for success, result in execute_concurrent_with_args(session, prepared, rows,
+                                                        concurrency=concurrency,
+                                                        results_generator=True):
+        if not success:
+            raise result
+        num_rows += 1
+
+    return num_rows
+
+
+def load_tables(session, staging_path, concurrency=100):
+    """
+    Description: This function loads all tables of the table registry
+                 from the staging file
+
+    Arguments:
+        session: the session object
+        staging_path: path of the csv or arrow staging file
+        concurrency: number of requests in flight
+
+    Returns:
+        None
+    """
+    for table in table_registry:
+        num_rows = load_table(session, table, staging_path, concurrency)
+        print('{} rows loaded into {} from {}'.format(num_rows, table, staging_path))
+
+
+def main():
+    """
+    Description: This main function consolidates the event data into the
+                 staging file(s) and loads the Cassandra tables from them.
+                 In incremental mode only new daily event files are processed
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Load event_data into Apache Cassandra')
+    parser.add_argument('--event-data', default=os.path.join(os.getcwd(), 'event_data'))
+    parser.add_argument('--staging', help='staging file path without extension, defaults to '
+                                          'event_datafile_new or event_datafile_increment')
+    parser.add_argument('--format', choices=['csv', 'arrow', 'both'], default='both')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only consolidate and load event files that have not been ingested yet')
+    parser.add_argument('--state', default='ingested_event_files.json')
+    parser.add_argument('--profile', choices=sorted(table_profiles),
+                        help='storage profile of the tables, existing tables are altered to it '
+                             '(default: default for new tables, existing tables are kept)')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--port', type=int, default=9042)
+    args = parser.parse_args()
+
+    file_path_list = get_event_files(args.event_data)
+    if args.incremental:
+        state = read_ingest_state(args.state)
+        file_path_list = get_new_event_files(file_path_list, state)
+        if not file_path_list:
+            print('No new event files in {}'.format(args.event_data))
+            return
+        print('{} new event files: {}'.format(len(file_path_list),
+                                             ', '.join(os.path.basename(f) for f in file_path_list)))
+
+    staging = args.staging or ('event_datafile_increment' if args.incremental else 'event_datafile_new')
+    paths = process_event_files(file_path_list, staging, args.format)
+
+    cluster, session = create_session(args.hosts, args.port)
+    try:
+        create_tables(session, args.profile)
+        # rows of a file that is loaded twice are upserted on the same primary key,
+        # so rerunning after a failure is idempotent
+        load_tables(session, paths[-1])
+    finally:
+        cluster.shutdown()
+
+    if args.incremental:
+        record_ingested_files(state, file_path_list, args.state)
+
+
+if __name__ == "__main__":
+    main()
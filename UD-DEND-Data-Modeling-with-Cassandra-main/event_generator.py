@@ -0,0 +1,69 @@
+import itertools
+import random
+
+
+first_names = ['Adler', 'Kaylee', 'Walter', 'Ryan', 'Jacqueline', 'Layla', 'Tegan', 'Chloe', 'Mohammad', 'Lily']
+last_names  = ['Barrera', 'Summers', 'Frye', 'Smith', 'Lynch', 'Griffin', 'Levine', 'Cuevas', 'Rodriguez', 'Koch']
+locations   = ['New York-Newark-Jersey City, NY-NJ-PA',
+               'San Francisco-Oakland-Hayward, CA',
+               'Phoenix-Mesa-Scottsdale, AZ',
+               'Atlanta-Sandy Springs-Roswell, GA',
+               'Chicago-Naperville-Elgin, IL-IN-WI']
+
+
+def zipf_cum_weights(n, s=1.1):
+    """
+    Description: This function computes cumulative Zipf weights, so that a few
+                 keys (popular songs, heavy users) are drawn much more often
+
+    Arguments:
+        n: number of keys
+        s: skew exponent
+
+    Returns:
+        list of cumulative weights for random.choices
+    """
+    return list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def generate_events(num_rows, num_users=1000, num_songs=20000, max_items=40, seed=42):
+    """
+    Description: This function generates synthetic event rows in the column
+                 order of event_datafile_new. Users and songs follow a Zipf
+                 distribution and every session is a run of items of one user
+
+    Arguments:
+        num_rows: number of rows to generate
+        num_users: number of distinct users
+        num_songs: number of distinct songs
+        max_items: maximum number of items in a session
+        seed: seed of the random generator
+
+    Returns:
+        generator of staging rows
+    """
+    rng = random.Random(seed)
+
+    songs = [('Artist {}'.format(rng.randrange(max(num_songs // 4, 1))),
+              'Song {}'.format(i),
+              round(rng.uniform(60.0, 480.0), 5)) for i in range(num_songs)]
+    users = [(user_id,
+              rng.choice(first_names),
+              rng.choice('MF'),
+              rng.choice(last_names),
+              rng.choice(['free', 'paid']),
+              rng.choice(locations)) for user_id in range(1, num_users + 1)]
+    song_weights = zipf_cum_weights(num_songs)
+    user_weights = zipf_cum_weights(num_users, s=0.8)
+
+    session_id = 0
+    emitted = 0
+    while emitted < num_rows:
+        session_id += 1
+        user_id, first_name, gender, last_name, level, location = rng.choices(users, cum_weights=user_weights)[0]
+        num_items = min(rng.randint(1, max_items), num_rows - emitted)
+        for item_in_session, (artist, song, length) in enumerate(
+                rng.choices(songs, cum_weights=song_weights, k=num_items)):
+            yield (artist, first_name, gender, item_in_session, last_name, length,
+                   level, location, session_id, song, user_id)
+        emitted += num_items
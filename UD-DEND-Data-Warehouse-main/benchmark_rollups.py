@@ -0,0 +1,191 @@
+import argparse
+import statistics
+from time import perf_counter
+import psycopg2
+from dialect import to_postgres
+from rollup_cache import build_cube, refresh_cube, route, fact_select
+from sql_queries import time_table_insert, songplay_table_insert
+from table_design_advisor import build_source
+from tools import read_config, get_connection, print_status
+
+
+# roll-up, drill-down and slice requests per cube as (group by, filters)
+requests = {
+    'songplays': [([], {}),
+                  (['year', 'month'], {}),
+                  (['month', 'level'], {}),
+                  (['weekday', 'hour'], {}),
+                  (['hour'], {'level': 'paid'}),
+                  (['weekday'], {'month': 11, 'level': ('free', 'paid')}),
+                  (['month', 'weekday', 'hour', 'level'], {})],
+    'sales': [([], {}),
+              (['month', 'country'], {}),
+              (['country'], {}),
+              (['month'], {'country': 'Canada'}),
+              (['year', 'month', 'rating'], {}),
+              (['city', 'rating'], {'month': 5}),
+              (['year', 'month', 'country', 'city', 'rating'], {})],
+}
+
+# a new load of about 10% of the facts, later than all loaded facts
+new_songplays_load = ("""UPDATE staging_events
+                         SET ts = ts + (SELECT MAX(ts) - MIN(ts) + 86400000 FROM staging_events);
+                         DELETE FROM staging_events WHERE MOD(itemInSession, 10) <> 0;
+""")
+
+new_sales_load = ("""INSERT INTO factSales (date_key, customer_key, movie_key, store_key, sales_amount)
+                     SELECT date_key, customer_key, movie_key, store_key, sales_amount
+                     FROM factSales
+                     WHERE MOD(sales_key, 10) = 0;
+""")
+
+
+def normalize(rows):
+    """
+    Description: This function brings result rows into a comparable order,
+                 the values are compared as strings
+
+    Arguments:
+        rows: result rows
+
+    Returns:
+        sorted list of rows
+    """
+    return sorted(tuple(str(v) for v in row) for row in rows)
+
+
+def time_query(cur, sql, params, repeat):
+    """
+    Description: This function runs a query repeatedly
+
+    Arguments:
+        cur: the cursor object
+        sql: the query
+        params: list of parameters
+        repeat: number of runs
+
+    Returns:
+        median latency in milliseconds
+        rows: the rows of the last run
+    """
+    timings = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        timings.append((perf_counter() - t0) * 1000)
+
+    return statistics.median(timings), rows
+
+
+def compare_requests(conn, cube, repeat):
+    """
+    Description: This function answers every request of a cube once from the
+                 raw facts and once through the router
+
+    Arguments:
+        conn: object of the connection to the database
+        cube: name of the cube
+        repeat: number of runs of every query
+
+    Returns:
+        list of dicts with the request, the aggregate used, both latencies and
+        whether both answers are the same
+    """
+    results = []
+    with conn.cursor() as cur:
+        for group_by, filters in requests[cube]:
+            raw_sql, raw_params = fact_select(cube, tuple(group_by), filters)
+            table, sql, params = route(conn, cube, group_by, filters)
+            raw_ms, raw_rows = time_query(cur, raw_sql, raw_params, repeat)
+            cache_ms, cache_rows = time_query(cur, sql, params, repeat)
+            results.append({'request': '{} {}'.format(','.join(group_by) or '(total)', filters or ''),
+                            'table': table, 'raw_ms': raw_ms, 'cache_ms': cache_ms,
+                            'same': normalize(raw_rows) == normalize(cache_rows)})
+    conn.commit()
+
+    return results
+
+
+def print_results(results):
+    """
+    Description: This function prints the results of compare_requests
+
+    Arguments:
+        results: list of dicts returned by compare_requests
+
+    Returns:
+        None
+    """
+    print('{:<52}{:<46}{:>10}{:>10}{:>9}{:>6}'.format('request', 'answered from', 'raw ms', 'cache ms',
+                                                      'speedup', 'same'))
+    for r in results:
+        print('{:<52}{:<46}{:>10.2f}{:>10.2f}{:>8.1f}x{:>6}'.format(
+            r['request'], r['table'], r['raw_ms'], r['cache_ms'], r['raw_ms'] / r['cache_ms'], str(r['same'])))
+
+
+def main():
+    """
+    Description: This main function builds the aggregates of a cube, compares
+                 routed answers with raw fact scans, adds a new load and compares
+                 the incremental refresh with a full rebuild
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the rollup cache against raw fact scans')
+    parser.add_argument('--cube', choices=sorted(requests), default='songplays')
+    parser.add_argument('--dsn', help='connection string (default: CLUSTER section of dwh.cfg)')
+    parser.add_argument('--schema', help='schema of the fact tables (default: rollup_source for songplays, '
+                                         'pagila_star_bench for sales)')
+    parser.add_argument('--events', type=int, default=500000,
+                        help='songplays: synthetic events loaded into the schema first, 0 to use the loaded data')
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    schema = args.schema or ('rollup_source' if args.cube == 'songplays' else 'pagila_star_bench')
+    conn = psycopg2.connect(args.dsn) if args.dsn else get_connection(read_config('dwh.cfg'))
+    try:
+        if args.cube == 'songplays' and args.events:
+            print_status('benchmark_rollups', 'loading {} synthetic events into {}'.format(args.events, schema))
+            build_source(conn, schema, args.events, args.songs)
+            conn.commit()
+        with conn.cursor() as cur:
+            cur.execute('SET search_path TO {}, public;'.format(schema))
+
+        t0 = perf_counter()
+        build_cube(conn, args.cube)
+        print_status('benchmark_rollups', 'full build: {:.2f}s'.format(perf_counter() - t0))
+        print_results(compare_requests(conn, args.cube, args.repeat))
+
+        with conn.cursor() as cur:
+            if args.cube == 'songplays':
+                cur.execute(new_songplays_load)
+                cur.execute(to_postgres(time_table_insert))
+                cur.execute(to_postgres(songplay_table_insert))
+            else:
+                cur.execute(new_sales_load)
+            print_status('benchmark_rollups', 'new load: {} facts'.format(cur.rowcount))
+        conn.commit()
+
+        t0 = perf_counter()
+        stats = refresh_cube(conn, args.cube)
+        print_status('benchmark_rollups', 'incremental refresh: {:.2f}s, {} cells updated, {} inserted'.format(
+            perf_counter() - t0, stats['updated'], stats['inserted']))
+        results = compare_requests(conn, args.cube, 1)
+        print_status('benchmark_rollups', 'answers after the refresh match the raw facts: {}'.format(
+            all(r['same'] for r in results)))
+
+        t0 = perf_counter()
+        build_cube(conn, args.cube)
+        print_status('benchmark_rollups', 'full rebuild: {:.2f}s'.format(perf_counter() - t0))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import statistics
+from time import perf_counter
+import psycopg2
+from dialect import to_postgres
+from sql_queries import (staging_events_table_create, time_table_create, watermark_table_create, time_table_insert,
+                         time_table_merge_delete, time_table_merge_insert, staging_events_delta_create,
+                         staging_events_columns)
+from synthetic_data import generate_songs, generate_events, load_rows
+from time_dimension import extend_time_dimension
+from tools import read_config, get_connection, print_status
+
+
+# the staging tables are shared, every approach keeps its dim_time and
+# etl_watermark in a schema of its own, found first on the search path
+schema = 'time_benchmark'
+
+
+def build_source(conn, num_events, new_share):
+    """
+    Description: This function loads synthetic events into staging_events and
+                 a later load of new events into staging_events_new
+
+    Arguments:
+        conn: object of the connection to the Postgres stand-in
+        num_events: number of staging_events rows
+        new_share: size of the new load relative to num_events
+
+    Returns:
+        ts of the last event of the first load
+    """
+    songs = generate_songs(max(num_events // 100, 1))
+    events = generate_events(num_events, songs)
+    last_ts = events[-1][15]
+    new_events = generate_events(max(int(num_events * new_share), 1), songs, start=last_ts, seed=43)
+
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};'.format(schema))
+        cur.execute(to_postgres(staging_events_table_create))
+        cur.execute('CREATE TABLE staging_events_new (LIKE staging_events);')
+    load_rows(conn, 'staging_events', staging_events_columns, events)
+    load_rows(conn, 'staging_events_new', staging_events_columns, new_events)
+    with conn.cursor() as cur:
+        cur.execute('ANALYZE;')
+    conn.commit()
+
+    return last_ts
+
+
+def use_approach(cur, name):
+    """
+    Description: This function creates (if needed) the schema of an approach
+                 and puts it first on the search path
+
+    Arguments:
+        cur: the cursor object
+        name: name of the approach
+
+    Returns:
+        None
+    """
+    cur.execute('CREATE SCHEMA IF NOT EXISTS {0}_{1}; SET search_path TO {0}_{1}, {0};'.format(schema, name))
+    for query in [time_table_create, watermark_table_create]:
+        cur.execute(to_postgres(query))
+
+
+def dim_time_rows(cur):
+    """
+    Description: This function counts the rows of dim_time
+
+    Arguments:
+        cur: the cursor object
+
+    Returns:
+        number of rows
+    """
+    cur.execute('SELECT COUNT(*) FROM dim_time;')
+
+    return cur.fetchone()[0]
+
+
+def first_load(conn, name, load):
+    """
+    Description: This function fills the dim_time of an approach from the
+                 first load and keeps it for the following scenarios
+
+    Arguments:
+        conn: object of the connection to the database
+        name: name of the approach
+        load: function (cur) filling dim_time
+
+    Returns:
+        dict with the scenario, approach, seconds, inserted rows and dim_time rows
+    """
+    with conn.cursor() as cur:
+        use_approach(cur, name)
+        cur.execute('TRUNCATE dim_time; TRUNCATE etl_watermark;')
+        conn.commit()
+        t0 = perf_counter()
+        rows = load(cur)
+        seconds = perf_counter() - t0
+        conn.commit()
+        cur.execute('ANALYZE dim_time;')
+
+        return {'scenario': 'first load', 'approach': name, 'seconds': seconds, 'rows': rows,
+                'dim_time': dim_time_rows(cur)}
+
+
+def time_load(conn, scenario, name, approach, load, last_ts, new_events, repeat):
+    """
+    Description: This function times a load into the dim_time of an approach.
+                 Every run is rolled back, so all runs start from the first load.
+
+    Arguments:
+        conn: object of the connection to the database
+        scenario: name of the scenario
+        name: name shown for the load
+        approach: name of the approach whose dim_time is loaded
+        load: function (cur) loading dim_time
+        last_ts: ts of the last event of the first load
+        new_events: the new load is added to staging_events first
+        repeat: number of runs
+
+    Returns:
+        dict with the scenario, approach, median seconds, inserted rows and dim_time rows
+    """
+    timings = []
+    with conn.cursor() as cur:
+        for _ in range(repeat):
+            use_approach(cur, approach)
+            if new_events:
+                cur.execute('INSERT INTO staging_events SELECT * FROM staging_events_new;')
+            cur.execute(staging_events_delta_create, (last_ts,))
+            t0 = perf_counter()
+            rows = load(cur)
+            timings.append(perf_counter() - t0)
+            size = dim_time_rows(cur)
+            conn.rollback()
+
+    return {'scenario': scenario, 'approach': name, 'seconds': statistics.median(timings), 'rows': rows,
+            'dim_time': size}
+
+
+def distinct_rebuild(cur):
+    """
+    Description: This function rebuilds dim_time from the distinct timestamps
+                 of all staged events, as etl.py did before the calendar
+
+    Arguments:
+        cur: the cursor object
+
+    Returns:
+        number of inserted rows
+    """
+    cur.execute('TRUNCATE dim_time;')
+    cur.execute(to_postgres(time_table_insert))
+
+    return cur.rowcount
+
+
+def distinct_merge(cur):
+    """
+    Description: This function merges the distinct timestamps of the new
+                 events into dim_time, as the incremental load did before the calendar
+
+    Arguments:
+        cur: the cursor object
+
+    Returns:
+        number of inserted rows
+    """
+    cur.execute(time_table_merge_delete)
+    cur.execute(to_postgres(time_table_merge_insert))
+
+    return cur.rowcount
+
+
+def print_results(results):
+    """
+    Description: This function prints the timings of all scenarios
+
+    Arguments:
+        results: list of dicts returned by first_load and time_load
+
+    Returns:
+        None
+    """
+    print('{:<16}{:<28}{:>10}{:>14}{:>14}'.format('scenario', 'approach', 'seconds', 'inserted', 'dim_time rows'))
+    for r in results:
+        print('{scenario:<16}{approach:<28}{seconds:>10.3f}{rows:>14}{dim_time:>14}'.format(**r))
+
+
+def main():
+    """
+    Description: This main function compares the dim_time maintained from the
+                 calendar with the DISTINCT over the staged events: on the
+                 first load, on a later load of new events and on a rerun
+                 without new events
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the calendar dim_time against DISTINCT over staging_events')
+    parser.add_argument('--dsn', help='connection string of the Postgres stand-in (default: CLUSTER section of dwh.cfg)')
+    parser.add_argument('--events', type=int, default=1000000, help='staging_events rows of the first load')
+    parser.add_argument('--new-share', type=float, default=0.1, help='size of the new load relative to --events')
+    parser.add_argument('--grains', default='1,60', help='comma separated grains of the calendar in seconds')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    grains = [int(grain) for grain in args.grains.split(',')]
+    conn = psycopg2.connect(args.dsn) if args.dsn else get_connection(read_config('dwh.cfg'))
+    try:
+        print_status('benchmark_time_dimension', 'loading {} synthetic events'.format(args.events))
+        last_ts = build_source(conn, args.events, args.new_share)
+
+        results = [first_load(conn, 'distinct', distinct_rebuild)]
+        for grain in grains:
+            results.append(first_load(conn, 'calendar_{}s'.format(grain),
+                                      lambda cur, grain=grain: extend_time_dimension(cur, grain)))
+
+        for scenario, new_events in [('new load', True), ('rerun', False)]:
+            results.append(time_load(conn, scenario, 'distinct rebuild', 'distinct', distinct_rebuild,
+                                     last_ts, new_events, args.repeat))
+            results.append(time_load(conn, scenario, 'distinct merge', 'distinct', distinct_merge,
+                                     last_ts, new_events, args.repeat))
+            for grain in grains:
+                name = 'calendar_{}s'.format(grain)
+                results.append(time_load(conn, scenario, name, name,
+                                         lambda cur, grain=grain: extend_time_dimension(cur, grain),
+                                         last_ts, new_events, args.repeat))
+        print_results(results)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import statistics
+from time import perf_counter
+from dialect import to_postgres
+from sql_queries import (staging_events_table_create, staging_songs_table_create, songplay_table_create,
+                         song_table_create, artist_table_create, key_table_queries,
+                         songplay_table_insert, song_table_insert, artist_table_insert)
+from synthetic_data import load_staging
+from tools import read_config, get_connection
+
+
+# the staging tables and transforms before the typed staging schema, text columns
+# are converted in every transform and songplays are joined on title and artist name
+legacy_staging_events_table_create = ("""CREATE TABLE staging_events (
+                                         artist TEXT, auth TEXT, firstName TEXT, gender TEXT,
+                                         itemInSession INT, lastName TEXT, length TEXT, level TEXT,
+                                         location TEXT, method TEXT, page TEXT, registration TEXT,
+                                         sessionId INT, song TEXT, status INT, ts BIGINT,
+                                         userAgent TEXT, userId INT);
+""")
+
+legacy_staging_songs_table_create = ("""CREATE TABLE staging_songs (
+                                        num_songs INT, artist_id TEXT, artist_latitude TEXT,
+                                        artist_longitude TEXT, artist_location TEXT, artist_name TEXT,
+                                        song_id TEXT, title TEXT, duration TEXT, year INT);
+""")
+
+legacy_songplay_table_insert = ("""INSERT INTO fact_songplays (
+                                   start_time, user_id, level, song_id,
+                                   artist_id, session_id, location, user_agent)
+                                   SELECT TIMESTAMP 'epoch' + e.ts/1000 *INTERVAL '1 second',
+                                   e.userId, e.level, s.song_id, s.artist_id,
+                                   e.sessionId, e.location, e.userAgent
+                                   FROM staging_events AS e
+                                   JOIN staging_songs AS s
+                                   ON e.song=s.title
+                                   AND e.artist=s.artist_name
+                                   WHERE e.page='NextSong';
+""")
+
+legacy_song_table_insert = ("""INSERT INTO dim_songs (
+                               song_id, title, artist_id, year, duration)
+                               SELECT DISTINCT song_id, title, artist_id, year,
+                               CONVERT(FLOAT, duration)
+                               FROM staging_songs;
+""")
+
+legacy_artist_table_insert = ("""INSERT INTO dim_artists (
+                                 artist_id, name, location, latitude, longitude)
+                                 SELECT DISTINCT artist_id, artist_name, artist_location,
+                                 CONVERT(FLOAT, artist_latitude),
+                                 CONVERT(FLOAT, artist_longitude)
+                                 FROM staging_songs;
+""")
+
+variants = {
+    'text': {
+        'staging': [legacy_staging_events_table_create, legacy_staging_songs_table_create],
+        'steps': [('dim_songs', legacy_song_table_insert),
+                  ('dim_artists', legacy_artist_table_insert),
+                  ('fact_songplays', legacy_songplay_table_insert)],
+    },
+    'typed': {
+        'staging': [staging_events_table_create, staging_songs_table_create],
+        'steps': [('song_key', ''.join(key_table_queries)),
+                  ('dim_songs', song_table_insert),
+                  ('dim_artists', artist_table_insert),
+                  ('fact_songplays', songplay_table_insert)],
+    },
+}
+
+
+def setup_variant(conn, name, num_events, num_songs):
+    """
+    Description: This function creates the staging, dimension and fact tables of
+                 a variant in its own schema and loads the synthetic staging data
+
+    Arguments:
+        conn: object of the connection to the Postgres stand-in
+        name: name of the variant
+        num_events: number of staging_events rows
+        num_songs: number of staging_songs rows
+
+    Returns:
+        None
+    """
+    schema = 'bench_{}'.format(name)
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};'.format(schema))
+        for query in variants[name]['staging'] + [song_table_create, artist_table_create, songplay_table_create]:
+            cur.execute(to_postgres(query))
+    conn.commit()
+
+    load_staging(conn, num_events, num_songs)
+    with conn.cursor() as cur:
+        cur.execute('ANALYZE;')
+    conn.commit()
+
+
+def run_variant(conn, name):
+    """
+    Description: This function runs the transforms of a variant once and times every step
+
+    Arguments:
+        conn: object of the connection to the Postgres stand-in
+        name: name of the variant
+
+    Returns:
+        timings: dict of step -> seconds
+    """
+    timings = {}
+    with conn.cursor() as cur:
+        cur.execute('SET search_path TO bench_{};'.format(name))
+        cur.execute('TRUNCATE dim_songs, dim_artists, fact_songplays;')
+        if name == 'typed':
+            cur.execute('UPDATE staging_events SET song_key=NULL;')
+            cur.execute('UPDATE staging_songs SET song_key=NULL;')
+        cur.execute('VACUUM FULL;')
+
+        for step, query in variants[name]['steps']:
+            t0 = perf_counter()
+            cur.execute(to_postgres(query))
+            timings[step] = perf_counter() - t0
+
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def main():
+    """
+    Description: This main function compares the transform time of the text
+                 staging schema with the typed staging schema on the Postgres stand-in
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the transforms of the text vs. typed staging schema')
+    parser.add_argument('--events', type=int, default=2000000)
+    parser.add_argument('--songs', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    conn = get_connection(read_config('dwh.cfg'))
+    # every statement commits on its own, VACUUM cannot run in a transaction
+    conn.autocommit = True
+    try:
+        results = {}
+        for name in variants:
+            setup_variant(conn, name, args.events, args.songs)
+            runs = [run_variant(conn, name) for _ in range(args.repeat)]
+            results[name] = {step: statistics.median(run[step] for run in runs) for step in runs[0]}
+    finally:
+        conn.close()
+
+    steps = ['song_key', 'dim_songs', 'dim_artists', 'fact_songplays', 'total']
+    print('{:<16}{:>10}{:>10}{:>10}'.format('step', 'text', 'typed', 'speedup'))
+    for step in steps:
+        text, typed = results['text'].get(step), results['typed'].get(step)
+        print('{:<16}{:>10}{:>10}{:>10}'.format(
+            step,
+            '-' if text is None else '{:.3f}'.format(text),
+            '-' if typed is None else '{:.3f}'.format(typed),
+            '{:.2f}x'.format(text / typed) if text and typed else '-'))
+
+
+if __name__ == "__main__":
+    main()
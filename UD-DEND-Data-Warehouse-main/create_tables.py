@@ -1,6 +1,8 @@
 import configparser
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import create_table_queries, drop_table_queries, star_table_creates, staging_columns
+from query_cache import bump_table_versions
+from dialect import translate
 
 
 def drop_tables(cur, conn):
@@ -23,22 +25,28 @@ def drop_tables(cur, conn):
         print(e)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, config):
     """
     Description: This function is used to create the tables
-                 defined in the array 'create_table_queries'
+                 defined in the array 'create_table_queries'.
+                 The version stamps of the recreated tables are bumped,
+                 so no cached result of the dropped data is used. The
+                 statements are translated for a Postgres stand-in if
+                 BACKEND is not redshift.
     
     Arguments:
         cur: the cursor object
         conn: object of the connection to the database
+        config: the ConfigParser object, for the backend
         
     Returns:
         None
     """
     try:
         for query in create_table_queries:
-            cur.execute(query)
+            cur.execute(translate(config, query))
             conn.commit()
+        bump_table_versions(conn, list(star_table_creates) + list(staging_columns))
     except psycopg2.Error as e:
         print(e)
 
@@ -62,7 +70,7 @@ def main():
         cur = conn.cursor()
 
         drop_tables(cur, conn)
-        create_tables(cur, conn)
+        create_tables(cur, conn, config)
 
         conn.close()
     except psycopg2.Error as e:
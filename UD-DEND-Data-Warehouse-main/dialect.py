@@ -0,0 +1,69 @@
+import re
+
+
+def strip_table_design(sql):
+    """
+    Description: Removes the distribution style, distribution key and sort
+                 keys from a Redshift CREATE TABLE statement
+
+    Arguments:
+        sql: Redshift statement
+
+    Returns:
+        the statement without table design attributes
+    """
+    sql = re.sub(r'\s+(SORTKEY|DISTKEY)\b(?!\s*\()', '', sql, flags=re.I)
+    sql = re.sub(r'\s+DISTSTYLE\s+\w+', '', sql, flags=re.I)
+    sql = re.sub(r'\s*\b(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', '', sql, flags=re.I)
+    sql = re.sub(r'\s*\bDISTKEY\s*\([^)]*\)', '', sql, flags=re.I)
+
+    return sql
+
+
+def to_postgres(sql):
+    """
+    Description: Translates the Redshift statements of sql_queries.py for a
+                 Postgres stand-in. Distribution, sort keys and encodings are
+                 dropped, and so are primary and foreign keys, which Redshift
+                 does not enforce either. IDENTITY, CONVERT, FNV_HASH and the lateral
+                 column alias of the dim_time insert are rewritten.
+
+    Arguments:
+        sql: Redshift statement
+
+    Returns:
+        the Postgres statement
+    """
+    sql = strip_table_design(sql)
+    sql = re.sub(r'\s+ENCODE\s+\w+', '', sql, flags=re.I)
+    sql = re.sub(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)', '', sql, flags=re.I)
+    sql = re.sub(r'\s+PRIMARY KEY\b(?!\s*\()', '', sql, flags=re.I)
+    sql = re.sub(r'IDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)',
+                 r'GENERATED BY DEFAULT AS IDENTITY (MINVALUE \1 START WITH \1 INCREMENT BY \2)', sql, flags=re.I)
+    sql = re.sub(r'CONVERT\(\s*(\w+)\s*,\s*([^)]+)\)', r'CAST(\2 AS \1)', sql, flags=re.I)
+    sql = re.sub(r'\bFNV_HASH\(', 'hashtextextended(', sql, flags=re.I)
+    sql = re.sub(r'(hashtextextended\((?:[^()]|\([^()]*(?:\([^()]*\))*[^()]*\))*)\)', r'\1, 0)', sql)
+
+    # Postgres cannot refer to the alias dt in the same select list
+    sql = re.sub(r'SELECT DISTINCT (.+?) AS dt,(.*?)\n(\s*)FROM (.+?);',
+                 r'SELECT DISTINCT dt,\2\n\3FROM (SELECT \1 AS dt FROM \4) AS t;', sql, flags=re.S)
+
+    return sql
+
+
+def translate(config, sql):
+    """
+    Description: This function translates a Redshift statement for the
+                 Postgres stand-in if BACKEND is not redshift
+
+    Arguments:
+        config: the ConfigParser object
+        sql: Redshift statement
+
+    Returns:
+        the statement for the configured backend
+    """
+    if config.get('STAGING', 'BACKEND', fallback='redshift') == 'redshift':
+        return sql
+
+    return to_postgres(sql)
@@ -1,51 +1,445 @@
+import argparse
 import configparser
+from datetime import date, datetime
+from time import perf_counter
 import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from sql_queries import copy_table_queries, merge_table_queries, backfill_table_queries, staging_truncate_queries
+from sql_queries import (watermark_select, watermark_delete, watermark_insert, staging_events_delta_create,
+                         staging_events_backfill_create, staging_events_delta_stats, staging_events_delta_drop)
+from sql_queries import insert_table_statements, insert_table_dependencies, star_table_creates
+from sql_queries import (staging_events_key_update, staging_events_key_analyze, staging_songs_key_update,
+                         staging_songs_key_analyze, time_calendar_insert)
+from staging_loader import (load_staging_tables_parallel, print_report, copy_and_record, run_copy, write_load_report,
+                            load_table)
+from staging_loader import ensure_load_tables
+from parallel_executor import run_statements, print_timeline, StatementFailed
+from rollup_cache import refresh_cube
+from time_dimension import time_grain, at_grain, time_queries, load_time_dimension
+from log_discovery import discovery_enabled, keeps_staged_rows, load_new_objects
+from query_cache import bump_table_versions
+from dialect import translate
+from etl_journal import (StepFailed, fingerprint, sql_step, read_journal, find_run, record_step,
+                         run_step, plan_copy_steps, run_copy_steps, print_plan, ensure_journal)
+from tools import get_connection, get_s3_client, unquote, print_status
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(cur, conn, config):
     """
     Description: This function is used to trigger the extract-process
-                 of the data from the json-files to the staging tables
+                 of the data from the json-files to the staging tables.
+                 The telemetry of every COPY is written to load_metrics and
+                 to the load report. An incremental load only loads the new
+                 objects, see log_discovery.py. On a Postgres
+                 stand-in (BACKEND is not redshift) the JSON COPY is emulated
+                 like by staging_loader.py.
                  
     Arguments:
         cur: the cursor object
         conn: object of the connection to the database
+        config: the ConfigParser object
         
     Returns:
         None
     """
+    run_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    sources = {'staging_events': config.get('S3', 'LOG_DATA'), 'staging_songs': config.get('S3', 'SONG_DATA')}
+    loads = []
     try:
-        for query in copy_table_queries:
-            cur.execute(query)
+        ensure_load_tables(conn)
+        for (table, url), query in zip(sources.items(), copy_table_queries):
+            if discovery_enabled(config):
+                load_new_objects(config, table, url, run_id, loads)
+                continue
+            if config.get('STAGING', 'BACKEND', fallback='redshift') != 'redshift':
+                load_table(config, table, url, run_id, loads)
+                continue
+            copy_and_record(cur, run_id, table, unquote(url), lambda c: run_copy(c, query), loads)
             conn.commit()
+            bump_table_versions(conn, [table])
     except psycopg2.Error as e:
         print(e)
+    finally:
+        print('load report written to {}'.format(write_load_report(config, run_id, loads)))
 
 
-def insert_tables(cur, conn):
+def compute_join_keys(cur, conn, config):
+    """
+    Description: This function computes the song_key join keys of the
+                 freshly copied staging rows, every table in a transaction,
+                 its version stamp is bumped after the commit. The keys of
+                 the new songs of an incremental load are computed by the
+                 merge, which finds them by their missing key.
+
+    Arguments:
+        cur: the cursor object
+        conn: object of the connection to the database
+        config: the ConfigParser object, for the backend
+
+    Returns:
+        None
+    """
+    keys = [('staging_events', [staging_events_key_update, staging_events_key_analyze])]
+    if not config.getboolean('ETL', 'INCREMENTAL', fallback=False):
+        keys.append(('staging_songs', [staging_songs_key_update, staging_songs_key_analyze]))
+    try:
+        for table, queries in keys:
+            for query in queries:
+                cur.execute(translate(config, query))
+            conn.commit()
+            bump_table_versions(conn, [table])
+    except psycopg2.Error as e:
+        print(e)
+
+
+def insert_tables(cur, conn, config):
     """
     Description: This function triggers the transform and load process.
+                 dim_time is loaded for TIME_GRAIN. The version stamp of
+                 every table is bumped right after its commit, so a failing
+                 insert leaves no committed table with a stale stamp.
     
     Arguments:
         cur: the cursor object
         conn: object of the connection to the database
+        config: the ConfigParser object, for the backend and TIME_GRAIN
         
     Returns:
         None
     """
+    grain = time_grain(config)
     try:
-        for query in insert_table_queries:
-            cur.execute(query)
+        for table, query in insert_table_statements.items():
+            cur.execute(translate(config, at_grain(query, grain)))
             conn.commit()
+            bump_table_versions(conn, [table])
+        load_time_dimension(cur, config)
+        conn.commit()
+        bump_table_versions(conn, ['dim_time'])
     except psycopg2.Error as e:
         print(e)
 
 
+def insert_tables_parallel(conn, config):
+    """
+    Description: This function triggers the transform and load process with
+                 independent tables loaded concurrently on a connection pool.
+                 A failing statement cancels the others and raises StatementFailed.
+                 The version stamps of the committed tables are bumped on
+                 conn after the pool has finished.
+
+    Arguments:
+        conn: object of the connection to the database
+        config: the ConfigParser object
+
+    Returns:
+        None
+    """
+    grain = time_grain(config)
+    statements = {table: translate(config, at_grain(query, grain)) for table, query in insert_table_statements.items()}
+    statements['dim_time'] = lambda cur: load_time_dimension(cur, config)
+    try:
+        timeline = run_statements(config, statements, insert_table_dependencies,
+                                  pool_size=config.getint('ETL', 'POOL_SIZE'))
+    except StatementFailed as e:
+        bump_table_versions(conn, [entry['name'] for entry in e.timeline if entry['status'] == 'done'])
+        raise
+    bump_table_versions(conn, list(statements))
+    print_timeline(timeline)
+
+
+def truncate_staging_tables(cur, conn, config):
+    """
+    Description: This function empties the staging tables, so that an
+                 incremental run only stages the newly copied data.
+                 staging_songs keeps the songs of the former runs once its
+                 objects are recorded (see keeps_staged_rows in
+                 log_discovery.py). The version stamp is bumped after the
+                 TRUNCATE. An error is raised, so that the run does not go
+                 on to merge the stale rows still staged.
+
+    Arguments:
+        cur: the cursor object
+        conn: object of the connection to the database
+        config: the ConfigParser object
+
+    Returns:
+        None
+    """
+    for table, query in staging_truncate_queries.items():
+        if keeps_staged_rows(conn, config, table):
+            continue
+        cur.execute(query)
+        conn.commit()
+        bump_table_versions(conn, [table])
+
+
+def insert_tables_incremental(cur, conn, config):
+    """
+    Description: This function triggers the incremental transform and load process.
+                 Only NextSong events newer than the watermark of the last load
+                 and the newly staged songs are transformed, every table is
+                 merged on its primary key by delete-insert and the watermark
+                 is moved in the same transaction.
+
+    Arguments:
+        cur: the cursor object
+        conn: object of the connection to the database
+        config: the ConfigParser object, for the backend and TIME_GRAIN
+
+    Returns:
+        None
+    """
+    try:
+        merge_new_events(cur, config)
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(e)
+        return
+    bump_table_versions(conn, list(star_table_creates) + ['staging_songs'])
+
+
+def merge_new_events(cur, config):
+    """
+    Description: This function merges the new songs and the NextSong events
+                 above the watermark into the tables, loads dim_time for them
+                 and moves the watermark, without committing. The new songs
+                 are the staged ones without song_key, it is computed after
+                 their merge.
+
+    Arguments:
+        cur: the cursor object
+        config: the ConfigParser object, for the backend and TIME_GRAIN
+
+    Returns:
+        number of new events
+    """
+    cur.execute(watermark_select)
+    watermark = cur.fetchone()[0]
+    cur.execute(staging_events_delta_create, (watermark,))
+    cur.execute(staging_events_delta_stats)
+    num_events, high_ts = cur.fetchone()
+    print('{} new events above watermark {}'.format(num_events, watermark))
+
+    for query in merge_queries(config):
+        cur.execute(query)
+    load_time_dimension(cur, config, 'staging_events_delta')
+
+    if high_ts is not None:
+        cur.execute(watermark_delete)
+        cur.execute(watermark_insert, (high_ts,))
+    cur.execute(staging_events_delta_drop)
+
+    return num_events
+
+
+def merge_backfill_events(cur, config, start, end):
+    """
+    Description: This function merges the staged NextSong events of the days
+                 from start to end into the tables, also those below the
+                 watermark, which is not moved. The songplays of the events
+                 are deleted first and inserted again, so events merged before
+                 are not added twice; users are only added if they are
+                 missing, the events are older than the ones they were loaded
+                 from. dim_time is loaded for the events. The song_key of the
+                 events has to be computed before. Nothing is committed.
+
+    Arguments:
+        cur: the cursor object
+        config: the ConfigParser object, for the backend and TIME_GRAIN
+        start: first day (datetime.date)
+        end: last day (datetime.date)
+
+    Returns:
+        number of merged events
+    """
+    epoch = date(1970, 1, 1)
+    cur.execute(staging_events_backfill_create, ((start - epoch).days * 86400000, ((end - epoch).days + 1) * 86400000))
+    cur.execute(staging_events_delta_stats)
+    num_events = cur.fetchone()[0]
+    print('{} staged events from {} to {}'.format(num_events, start, end))
+
+    for query in merge_queries(config, backfill_table_queries):
+        cur.execute(query)
+    load_time_dimension(cur, config, 'staging_events_delta')
+    cur.execute(staging_events_delta_drop)
+
+    return num_events
+
+
+def merge_queries(config, queries=merge_table_queries):
+    """
+    Description: This function returns the translated merge statements, the
+                 start time of the songplays truncated to TIME_GRAIN
+
+    Arguments:
+        config: the ConfigParser object
+        queries: merge_table_queries, or backfill_table_queries
+
+    Returns:
+        list of SQL statements
+    """
+    return [translate(config, at_grain(query, time_grain(config))) for query in queries]
+
+
+def plan_steps(config, run_steps):
+    """
+    Description: This function lists the steps after the COPYs: the join
+                 keys, the inserts (or the merge of an incremental load) and
+                 the rollup refresh. Steps done in the resumed run are skipped.
+
+    Arguments:
+        config: the ConfigParser object
+        run_steps: dict of step -> fingerprint done in the resumed run
+
+    Returns:
+        list of step dicts
+    """
+    steps = [sql_step('keys:staging_events', [translate(config, staging_events_key_update),
+                                              translate(config, staging_events_key_analyze)])]
+
+    grain = time_grain(config)
+    if config.getboolean('ETL', 'INCREMENTAL', fallback=False):
+        # the keys of the new songs are computed by the merge, after it has found them by the missing key
+        time_sql = time_queries(config, 'staging_events_delta') or [time_calendar_insert]
+        steps.append({'step': 'merge', 'fingerprint': fingerprint(*merge_queries(config), *time_sql, str(grain)),
+                      'execute': lambda cur: merge_new_events(cur, config)})
+    else:
+        steps.append(sql_step('keys:staging_songs', [translate(config, staging_songs_key_update),
+                                                     translate(config, staging_songs_key_analyze)]))
+        for table, query in insert_table_statements.items():
+            steps.append(dict(sql_step('insert:' + table, [translate(config, at_grain(query, grain))]), table=table))
+        time_sql = time_queries(config) or [time_calendar_insert]
+        steps.append({'step': 'insert:dim_time', 'fingerprint': fingerprint(*time_sql, str(grain)),
+                      'execute': lambda cur: load_time_dimension(cur, config), 'table': 'dim_time'})
+
+    if config.getboolean('ETL', 'ROLLUP', fallback=False):
+        steps.append({'step': 'rollup', 'fingerprint': None,
+                      'execute': lambda cur: sum(refresh_cube(cur.connection, 'songplays').values())})
+
+    for step in steps:
+        step['action'] = 'skip' if step['step'] in run_steps \
+            and run_steps[step['step']] == step['fingerprint'] else 'run'
+
+    return steps
+
+
+def run_journaled(config, dry_run=False, restart=False):
+    """
+    Description: This function runs the ETL as steps recorded in the journal
+                 table etl_journal. A rerun after a failure resumes the
+                 incomplete run with its first step not done, COPYs of
+                 unchanged inputs are skipped in every run. With dry_run the
+                 plan and its estimated duration are printed instead.
+
+    Arguments:
+        config: the ConfigParser object
+        dry_run: only print the plan
+        restart: start a new run even if the last one is incomplete
+
+    Returns:
+        None
+    """
+    parallel = config.getboolean('STAGING', 'PARALLEL', fallback=False)
+    conn = get_connection(config)
+    try:
+        if not dry_run:
+            ensure_journal(conn)
+            ensure_load_tables(conn)
+        run_id, resumed = find_run(conn, restart)
+        run_steps, copies, history = read_journal(conn, run_id if resumed else None)
+        loads = []
+        copy_steps = plan_copy_steps(config, conn, get_s3_client(config), copies, run_id, loads, parallel,
+                                     dry_run)
+        steps = plan_steps(config, run_steps)
+
+        if dry_run:
+            print_plan(conn, run_id, resumed, copy_steps + steps, history)
+            return
+
+        print_status('etl', '{} run {}'.format('resuming' if resumed else 'starting', run_id))
+        t0 = perf_counter()
+        try:
+            run_copy_steps(config, conn, run_id, copy_steps, parallel)
+        finally:
+            if loads:
+                print_status('etl', 'load report written to {}'.format(write_load_report(config, run_id, loads)))
+
+        for step in steps:
+            if step['step'].startswith('keys:') and step['action'] == 'run':
+                run_step(conn, run_id, step)
+        inserts = {s['table']: s for s in steps if 'table' in s}
+        if inserts:
+            run_insert_steps(config, conn, run_id, inserts)
+        for step in steps:
+            if step['step'] in ('merge', 'rollup') and step['action'] == 'run':
+                run_step(conn, run_id, step)
+
+        with conn.cursor() as cur:
+            record_step(cur, run_id, 'run', None, 'done', seconds=perf_counter() - t0)
+        conn.commit()
+        print_status('etl', 'run {} complete'.format(run_id))
+    finally:
+        conn.close()
+
+
+def run_insert_steps(config, conn, run_id, inserts):
+    """
+    Description: This function runs the insert steps not done yet, with
+                 POOL_SIZE > 1 concurrently by the dependency-aware executor.
+                 Every insert is journaled in its own transaction, the
+                 version stamps of the inserted tables are bumped on conn
+                 after the pool has finished.
+
+    Arguments:
+        config: the ConfigParser object
+        conn: object of the connection to the database
+        run_id: id of the run
+        inserts: dict of table -> insert step
+
+    Returns:
+        None
+    """
+    pool_size = config.getint('ETL', 'POOL_SIZE', fallback=1)
+    if pool_size <= 1:
+        for step in inserts.values():
+            if step['action'] == 'run':
+                run_step(conn, run_id, step)
+        return
+
+    def on_commit(cur, table, seconds, rows):
+        record_step(cur, run_id, inserts[table]['step'], inserts[table]['fingerprint'], 'done', rows,
+                    seconds=seconds)
+
+    try:
+        timeline = run_statements(config, {t: s.get('sql') or s['execute'] for t, s in inserts.items()},
+                                  insert_table_dependencies,
+                                  pool_size=pool_size, on_commit=on_commit,
+                                  completed={t for t, s in inserts.items() if s['action'] == 'skip'})
+    except StatementFailed as e:
+        bump_table_versions(conn, [entry['name'] for entry in e.timeline if entry['status'] == 'done'])
+        print_timeline(e.timeline)
+        with conn.cursor() as cur:
+            record_step(cur, run_id, inserts[e.name]['step'], inserts[e.name]['fingerprint'], 'failed',
+                        error=str(e.error).strip())
+        conn.commit()
+        raise StepFailed(inserts[e.name]['step'], e.error) from e
+    bump_table_versions(conn, [entry['name'] for entry in timeline if entry['status'] == 'done'])
+    print_timeline(timeline)
+
+
 def main():
     """
     Description: This main function connects to the database and provides the cursor.
                  It also triggers the functions staging_tables and insert_tables.
+                 With PARALLEL=true in the STAGING section the staging tables are
+                 loaded concurrently from manifests by staging_loader.py.
+                 With INCREMENTAL=true in the ETL section only the new objects are
+                 copied and only new events and songs are transformed,
+                 with POOL_SIZE > 1 independent tables are loaded concurrently.
+                 With ROLLUP=true the songplays rollups are refreshed after the load.
+                 With JOURNAL=true the run is journaled and resumable (--dry-run
+                 prints the plan, --restart starts a new run).
     
     Arguments:
         None
@@ -53,17 +447,53 @@ def main():
     Returns:
         None
     """
+    parser = argparse.ArgumentParser(description='Load the staging tables and the star schema')
+    parser.add_argument('--dry-run', action='store_true', help='print the steps of the run and their estimated cost')
+    parser.add_argument('--restart', action='store_true', help='start a new run even if the last one is incomplete')
+    args = parser.parse_args()
+
     try:
         config = configparser.ConfigParser()
         config.read('dwh.cfg')
 
+        if args.dry_run or config.getboolean('ETL', 'JOURNAL', fallback=False):
+            try:
+                run_journaled(config, args.dry_run, args.restart)
+            except StepFailed as e:
+                print(e)
+                raise SystemExit('the run stopped, run etl.py again to resume at the failed step')
+            return
+
         conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
         cur = conn.cursor()
+        try:
+            incremental = config.getboolean('ETL', 'INCREMENTAL', fallback=False)
+            if incremental:
+                truncate_staging_tables(cur, conn, config)
 
-        load_staging_tables(cur, conn)
-        insert_tables(cur, conn)
+            if config.getboolean('STAGING', 'PARALLEL', fallback=False):
+                loaders = dict.fromkeys(['staging_events', 'staging_songs'], load_new_objects) \
+                    if discovery_enabled(config) else None
+                print_report(load_staging_tables_parallel(config, loaders))
+            else:
+                load_staging_tables(cur, conn, config)
+            compute_join_keys(cur, conn, config)
 
-        conn.close()
+            if incremental:
+                insert_tables_incremental(cur, conn, config)
+            elif config.getint('ETL', 'POOL_SIZE', fallback=1) > 1:
+                try:
+                    insert_tables_parallel(conn, config)
+                except StatementFailed as e:
+                    print_timeline(e.timeline)
+                    raise SystemExit('{} failed: {}'.format(e.name, str(e.error).strip()))
+            else:
+                insert_tables(cur, conn, config)
+
+            if config.getboolean('ETL', 'ROLLUP', fallback=False):
+                print('rollups refreshed: {}'.format(refresh_cube(conn, 'songplays')))
+        finally:
+            conn.close()
     except psycopg2.Error as e:
         print(e)
     
@@ -0,0 +1,503 @@
+import hashlib
+import re
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+import psycopg2
+from sql_queries import (journal_table_create, journal_last_run, journal_run_steps, journal_copy_steps,
+                         journal_stale_copies, journal_insert, journal_history, staging_events_copy,
+                         staging_songs_copy, star_table_creates)
+from query_cache import bump_table_versions
+from log_discovery import discovery_enabled, find_new_objects, keeps_staged_rows, record_objects
+from staging_loader import (list_objects, slice_aligned_groups, get_num_slices, get_field_names,
+                            write_manifest, run_copy, copy_manifest, copy_objects_postgres, copy_and_record)
+from tools import get_connection, unquote, print_status
+
+
+class StepFailed(Exception):
+    """
+    Description: Raised when a step of a journaled run fails. The step has
+                 been rolled back and recorded as failed, a rerun resumes with it.
+    """
+
+    def __init__(self, step, error):
+        super().__init__('{} failed: {}'.format(step, error))
+        self.step = step
+        self.error = error
+
+
+def fingerprint(*parts):
+    """
+    Description: This function hashes the inputs of a step, eg. the COPY
+                 statement and the key, etag and size of every source object
+
+    Arguments:
+        parts: strings or lists of objects returned by list_objects
+
+    Returns:
+        sha1 hex digest
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, list):
+            for o in part:
+                digest.update('{bucket}/{key}|{etag}|{size}\n'.format(**o).encode('utf8'))
+        else:
+            digest.update(str(part).encode('utf8'))
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+def sql_step(step, statements):
+    """
+    Description: This function builds a step that runs SQL statements in one
+                 transaction
+
+    Arguments:
+        step: name of the step
+        statements: list of SQL statements
+
+    Returns:
+        dict with step, fingerprint, sql and the function executing it, which
+        returns the rows affected by the first statement
+    """
+    def execute(cur):
+        rows = None
+        for sql in statements:
+            cur.execute(sql)
+            rows = cur.rowcount if rows is None else rows
+        return rows
+
+    return {'step': step, 'fingerprint': fingerprint(*statements), 'sql': statements[0], 'execute': execute}
+
+
+def read_journal(conn, run_id=None):
+    """
+    Description: This function reads the steps the journal knows as done.
+                 A missing journal table counts as empty, nothing is created.
+
+    Arguments:
+        conn: object of the connection to the database
+        run_id: id of the run whose steps are returned, None for none
+
+    Returns:
+        run_steps: dict of step -> fingerprint of the run
+        copies: dict of COPY step -> set of fingerprints, over all runs
+        history: dict of step -> list of (bytes, seconds) of former executions
+    """
+    run_steps, copies, history = {}, {}, {}
+    try:
+        with conn.cursor() as cur:
+            if run_id is not None:
+                cur.execute(journal_run_steps, (run_id,))
+                run_steps = dict(cur.fetchall())
+            cur.execute(journal_copy_steps, ('copy:%',))
+            for step, step_fingerprint in cur.fetchall():
+                copies.setdefault(step, set()).add(step_fingerprint)
+            cur.execute(journal_history)
+            for step, num_bytes, seconds in cur.fetchall():
+                history.setdefault(step, []).append((num_bytes, seconds))
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+
+    return run_steps, copies, history
+
+
+def find_run(conn, restart=False):
+    """
+    Description: This function finds the run to continue. The last run is
+                 resumed if it did not complete, otherwise a new run starts.
+
+    Arguments:
+        conn: object of the connection to the database
+        restart: always start a new run
+
+    Returns:
+        run_id: id of the run
+        resumed: True if the run is resumed
+    """
+    last = None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(journal_last_run)
+            last = cur.fetchone()
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+
+    if last is not None and not last[1] and not restart:
+        return last[0], True
+
+    return datetime.utcnow().strftime('%Y%m%dT%H%M%S'), False
+
+
+def step_tables(step):
+    """
+    Description: This function lists the tables a step changes
+
+    Arguments:
+        step: name of the step
+
+    Returns:
+        list of table names
+    """
+    kind, _, rest = step.partition(':')
+    if kind in ('copy', 'truncate', 'keys', 'insert'):
+        return [rest.split(':')[0]]
+    if kind == 'merge':
+        return list(star_table_creates)
+
+    return []
+
+
+def record_step(cur, run_id, step, step_fingerprint, status, rows=None, num_bytes=None, seconds=None, error=None):
+    """
+    Description: This function writes a row of the journal
+
+    Arguments:
+        cur: the cursor object
+        run_id: id of the run
+        step: name of the step
+        step_fingerprint: fingerprint of the inputs of the step
+        status: done, failed or stale
+        rows: rows loaded or changed by the step
+        num_bytes: bytes read by the step
+        seconds: duration of the step
+        error: error message of a failed step
+
+    Returns:
+        None
+    """
+    cur.execute(journal_insert, (run_id, step, step_fingerprint, status, rows, num_bytes, seconds,
+                                 datetime.utcnow(), error[:1024] if error else None))
+
+
+def run_step(conn, run_id, step):
+    """
+    Description: This function executes a step and records it as done in
+                 the same transaction, so that a step is either done and
+                 journaled or not done at all. After the commit the version
+                 stamps of the tables it changed are bumped (see query_cache.py).
+                 A failing step is rolled back, recorded as failed and
+                 StepFailed is raised.
+
+    Arguments:
+        conn: object of the connection to the database
+        run_id: id of the run
+        step: dict built by sql_step or plan_copy_steps
+
+    Returns:
+        rows loaded or changed by the step
+    """
+    t0 = perf_counter()
+    try:
+        with conn.cursor() as cur:
+            rows = step['execute'](cur)
+            record_step(cur, run_id, step['step'], step['fingerprint'], 'done', rows, step.get('bytes'),
+                        perf_counter() - t0)
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        with conn.cursor() as cur:
+            record_step(cur, run_id, step['step'], step['fingerprint'], 'failed',
+                        seconds=perf_counter() - t0, error=str(e).strip())
+        conn.commit()
+        raise StepFailed(step['step'], e) from e
+
+    bump_table_versions(conn, step_tables(step['step']))
+    print_status('etl_journal', '{} done{} in {:.2f}s'.format(
+        step['step'], ': {} rows'.format(rows) if rows is not None else '', perf_counter() - t0))
+
+    return rows
+
+
+def plan_copy_steps(config, conn, s3, copies, run_id, loads, parallel=False, dry_run=False):
+    """
+    Description: This function plans the COPY steps of the staging tables.
+                 Every source prefix is listed and fingerprinted, with
+                 parallel=True once per slice-aligned group of files. The
+                 COPYs of a table are skipped if the journal has them done
+                 with the same fingerprints. If the inputs changed, the table
+                 is emptied first and all of its COPYs run again. An
+                 incremental load copies only the objects that are new since
+                 the last run, see log_discovery.py: a COPY of them is skipped
+                 if it is done with the same fingerprint, and staging_songs is
+                 not emptied once it keeps the songs of the former runs.
+
+    Arguments:
+        config: the ConfigParser object
+        conn: object of the connection to the database
+        s3: boto3 S3 client
+        copies: dict of COPY step -> set of fingerprints returned by read_journal
+        run_id: id of the run
+        loads: list the telemetry of every COPY is appended to
+        parallel: one COPY per group of files from a manifest, as staging_loader.py
+        dry_run: only read from the database
+
+    Returns:
+        list of step dicts with table, files, bytes and action (skip, truncate or run)
+    """
+    backend = config.get('STAGING', 'BACKEND', fallback='redshift')
+    sources = {'staging_events': (config.get('S3', 'LOG_DATA'), staging_events_copy),
+               'staging_songs': (config.get('S3', 'SONG_DATA'), staging_songs_copy)}
+    discovery = discovery_enabled(config)
+    steps = []
+    for table, (url, copy_sql) in sources.items():
+        record = None
+        if discovery:
+            # only the new objects, always from manifests, and none at all if there are none
+            objects = find_new_objects(conn, s3, config, table, run_id, dry_run=dry_run)
+            record = lambda cur, group, url=url: record_objects(cur, unquote(url), group, run_id)
+        else:
+            objects = list_objects(s3, url)
+        if parallel:
+            groups = slice_aligned_groups(objects, get_num_slices(conn, config),
+                                          config.getint('STAGING', 'FILES_PER_SLICE', fallback=64))
+            names = ['copy:{}:{:04d}'.format(table, i) for i in range(len(groups))]
+        elif record:
+            groups = [objects] if objects else []
+            names = ['copy:{}:0000'.format(table)] if objects else []
+        else:
+            groups, names = [objects], ['copy:{}'.format(table)]
+
+        field_names = get_field_names(s3, config, table) if backend != 'redshift' else None
+        planned = []
+        for name, group in zip(names, groups):
+            planned.append({'step': name, 'table': table, 'objects': group, 'files': len(group),
+                            'bytes': sum(o['size'] for o in group),
+                            'fingerprint': fingerprint(backend, copy_sql, ','.join(field_names or []), group),
+                            'execute': copy_function(config, s3, run_id, loads, table, name, url, group, copy_sql,
+                                                     field_names, record)})
+
+        # earlier COPYs of the table count only if they all match the planned ones
+        done = {step: fingerprints for step, fingerprints in copies.items()
+                if step == 'copy:' + table or step.startswith('copy:{}:'.format(table))}
+        planned_fingerprints = {p['step']: p['fingerprint'] for p in planned}
+        unchanged = all(fingerprints == {planned_fingerprints.get(step)} for step, fingerprints in done.items())
+        for p in planned:
+            if record:
+                # the new objects are in the fingerprint, a match is a COPY of the same objects
+                p['action'] = 'skip' if p['fingerprint'] in done.get(p['step'], ()) else 'run'
+            else:
+                p['action'] = 'skip' if unchanged and p['step'] in done else 'run'
+
+        if not any(p['action'] == 'skip' for p in planned) and not (record and keeps_staged_rows(conn, config, table)):
+            steps.append(truncate_step(table))
+        steps.extend(planned)
+
+    return steps
+
+
+def copy_function(config, s3, run_id, loads, table, step, url, objects, copy_sql, field_names, record=None):
+    """
+    Description: This function returns the function executing one COPY step:
+                 the COPY from the source prefix, or from a manifest of the
+                 group, or its emulation on the Postgres stand-in. Its
+                 telemetry is recorded in the transaction of the step, and
+                 with record the loaded objects too.
+
+    Arguments:
+        config: the ConfigParser object
+        s3: boto3 S3 client
+        run_id: id of the run
+        loads: list the telemetry is appended to
+        table: name of the staging table
+        step: name of the step
+        url: S3 url of the source prefix
+        objects: list of source objects of the step
+        copy_sql: COPY statement of the whole prefix
+        field_names: json field of every staging column on the stand-in
+        record: function (cur, objects) recording the loaded objects, eg. for log_discovery.py
+
+    Returns:
+        function (cur) -> rows loaded
+    """
+    def copy(cur):
+        group = step.count(':') == 2
+        if field_names is not None:
+            source = '{} group {}'.format(unquote(url), int(step.rsplit(':', 1)[1])) if group else unquote(url)
+            max_error = config.getint('STAGING', 'MAXERROR', fallback=0)
+            return copy_and_record(cur, run_id, table, source, lambda c: copy_objects_postgres(
+                c, s3, table, objects, field_names, max_error), loads)['rows']
+        if not group:
+            return copy_and_record(cur, run_id, table, unquote(url), lambda c: run_copy(c, copy_sql), loads)['rows']
+
+        manifest_url = write_manifest(s3, objects, '{}/{}/{}.manifest'.format(
+            unquote(config.get('STAGING', 'MANIFEST_PREFIX')), table, step.replace(':', '-')))
+        return copy_and_record(cur, run_id, table, manifest_url, lambda c: copy_manifest(c, table, manifest_url),
+                               loads)['rows']
+
+    def execute(cur):
+        rows = copy(cur)
+        if record:
+            record(cur, objects)
+        return rows
+
+    return execute
+
+
+def truncate_step(table):
+    """
+    Description: This function builds the step emptying a staging table
+                 before it is loaded again. Its COPYs are marked stale first:
+                 TRUNCATE commits on Redshift, and a table whose COPYs are not
+                 valid anymore is emptied again by the next run.
+
+    Arguments:
+        table: name of the staging table
+
+    Returns:
+        step dict
+    """
+    def execute(cur):
+        cur.execute(journal_stale_copies, ('copy:{}%'.format(table),))
+        cur.connection.commit()
+        cur.execute('TRUNCATE {};'.format(table))
+        return None
+
+    return {'step': 'truncate:{}'.format(table), 'table': table, 'fingerprint': None, 'action': 'truncate',
+            'execute': execute}
+
+
+def run_copy_steps(config, conn, run_id, steps, parallel=False):
+    """
+    Description: This function runs the COPY steps that are not skipped.
+                 With parallel=True the tables are loaded concurrently, each
+                 over its own connection, like staging_loader.py.
+
+    Arguments:
+        config: the ConfigParser object
+        conn: object of the connection to the database
+        run_id: id of the run
+        steps: list of steps returned by plan_copy_steps
+        parallel: load the tables concurrently
+
+    Returns:
+        None
+    """
+    tables = {}
+    for step in steps:
+        if step['action'] != 'skip':
+            tables.setdefault(step['table'], []).append(step)
+
+    if not parallel:
+        for table_steps in tables.values():
+            for step in table_steps:
+                run_step(conn, run_id, step)
+        return
+
+    def load(table_steps):
+        table_conn = get_connection(config)
+        try:
+            for step in table_steps:
+                run_step(table_conn, run_id, step)
+        finally:
+            table_conn.close()
+
+    with ThreadPoolExecutor(max_workers=max(len(tables), 1)) as executor:
+        for future in [executor.submit(load, table_steps) for table_steps in tables.values()]:
+            future.result()
+
+
+def explain_cost(conn, sql):
+    """
+    Description: This function returns the total cost of the query plan of
+                 a statement, as estimated by the planner
+
+    Arguments:
+        conn: object of the connection to the database
+        sql: SQL statement
+
+    Returns:
+        total cost, None if the statement cannot be explained
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute('EXPLAIN ' + sql)
+            plan = cur.fetchone()[0]
+        conn.rollback()
+    except psycopg2.Error:
+        conn.rollback()
+        return None
+
+    match = re.search(r'cost=[\d.]+\.\.([\d.]+)', plan)
+
+    return float(match.group(1)) if match else None
+
+
+def estimate_seconds(step, history):
+    """
+    Description: This function estimates the duration of a step from the
+                 journal: the median of its former runs, for COPYs the bytes
+                 to load divided by the throughput of all former COPYs
+
+    Arguments:
+        step: step dict
+        history: dict of step -> list of (bytes, seconds) returned by read_journal
+
+    Returns:
+        estimated seconds, None without history
+    """
+    if step['step'].startswith('copy:') and step.get('bytes'):
+        copies = [(b, s) for name, runs in history.items() if name.startswith('copy:') for b, s in runs if b]
+        total_bytes, total_seconds = sum(b for b, _ in copies), sum(s for _, s in copies)
+        if total_bytes and total_seconds:
+            return step['bytes'] / (total_bytes / total_seconds)
+
+    runs = history.get(step['step'])
+    if runs:
+        return statistics.median(s for _, s in runs)
+
+    return None
+
+
+def print_plan(conn, run_id, resumed, steps, history):
+    """
+    Description: This function prints the plan of a run without executing it:
+                 what every step would do, the files and bytes of the COPYs,
+                 the estimated duration and the planner cost of SQL steps
+
+    Arguments:
+        conn: object of the connection to the database
+        run_id: id of the run
+        resumed: the run would resume an incomplete run
+        steps: list of step dicts, with action skip, truncate or run
+        history: dict of step -> list of (bytes, seconds) returned by read_journal
+
+    Returns:
+        None
+    """
+    print('{} run {}'.format('resuming' if resumed else 'new', run_id))
+    print('{:<34}{:<10}{:>8}{:>12}{:>12}{:>14}'.format('step', 'action', 'files', 'MB', 'est. s', 'plan cost'))
+    total, unknown = 0.0, 0
+    for step in steps:
+        seconds = estimate_seconds(step, history) if step['action'] != 'skip' else None
+        cost = explain_cost(conn, step['sql']) if step['action'] == 'run' and step.get('sql') else None
+        if step['action'] != 'skip':
+            total += seconds or 0
+            unknown += seconds is None and step['action'] == 'run'
+        print('{:<34}{:<10}{:>8}{:>12}{:>12}{:>14}'.format(
+            step['step'], step['action'], step.get('files', ''),
+            '{:.1f}'.format(step['bytes'] / 1e6) if step.get('bytes') is not None else '',
+            '{:.1f}'.format(seconds) if seconds is not None else '-',
+            '{:.0f}'.format(cost) if cost is not None else '-'))
+    print('estimated duration: {:.1f}s{}'.format(
+        total, ', {} steps without history'.format(unknown) if unknown else ''))
+
+
+def ensure_journal(conn):
+    """
+    Description: This function creates the journal table if it is missing
+
+    Arguments:
+        conn: object of the connection to the database
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        cur.execute(journal_table_create)
+    conn.commit()
@@ -0,0 +1,677 @@
+import argparse
+import math
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from psycopg2.extras import execute_values
+from dialect import to_postgres, translate
+from sql_queries import star_table_creates, staging_events_key_update
+from sql_queries import (loaded_objects_table_create, loaded_objects_exists, loaded_objects_last_day,
+                         loaded_objects_select, loaded_objects_count, loaded_objects_delete, loaded_objects_insert)
+from staging_loader import (list_objects, slice_aligned_groups, write_manifest, get_num_slices, get_field_names,
+                            copy_manifest, copy_objects_postgres, copy_and_record, ensure_load_tables,
+                            write_load_report, print_report)
+from query_cache import bump_table_versions
+from tools import read_config, get_connection, get_s3_client, split_s3_url, unquote, print_status
+
+
+# the day of a log object, eg. log_data/2018/11/2018-11-01-events.json or log_data/2018/11/01/events.json,
+# else the first day of its month, eg. log_data/2018/11/events.json
+day_pattern = re.compile(r'(\d{4})[/-](\d{2})[/-](\d{2})')
+month_pattern = re.compile(r'(\d{4})[/-](\d{2})(?!\d)')
+
+# a field of LOG_PREFIX_FORMAT, eg. {month:02d}
+format_field = re.compile(r'\{(\w+)[^}]*\}')
+
+# the source of every staging table in the S3 section
+sources = {'staging_events': 'LOG_DATA', 'staging_songs': 'SONG_DATA'}
+
+
+def discovery_enabled(config):
+    """
+    Description: This function tells if the staging tables are loaded from
+                 the new objects only, which an incremental load (INCREMENTAL
+                 in the ETL section) does: staging_events then holds only the
+                 new events, staging_songs keeps the songs of the former runs
+                 and gets the new ones appended (see keeps_staged_rows).
+                 LOG_DISCOVERY in the STAGING section only narrows the listing
+                 of the logs to their date prefixes.
+
+    Arguments:
+        config: the ConfigParser object
+
+    Returns:
+        True if only the new objects are loaded
+    """
+    if config.getboolean('STAGING', 'LOG_DISCOVERY', fallback=False) \
+            and not config.getboolean('ETL', 'INCREMENTAL', fallback=False):
+        print_status('log_discovery', 'LOG_DISCOVERY needs INCREMENTAL=true in the ETL section, '
+                                      'loading the whole LOG_DATA prefix')
+
+    return config.getboolean('ETL', 'INCREMENTAL', fallback=False)
+
+
+def source_url(config, table):
+    """
+    Description: This function returns the S3 url of the source of a staging table
+
+    Arguments:
+        config: the ConfigParser object
+        table: name of the staging table
+
+    Returns:
+        S3 url without quotes
+    """
+    return unquote(config.get('S3', sources[table]))
+
+
+def object_day(key, prefix, default=None):
+    """
+    Description: This function returns the day of a log object, from its
+                 file name or else from the date prefixes below the source.
+                 A key holding only a month gets the first day of the month.
+
+    Arguments:
+        key: key of the object
+        prefix: key prefix of the source, eg. log_data
+        default: day returned if the key holds no valid date
+
+    Returns:
+        datetime.date
+    """
+    relative = key[len(prefix):]
+    for part in [os.path.basename(relative), relative]:
+        match = day_pattern.search(part)
+        if match:
+            try:
+                return date(*map(int, match.groups()))
+            except ValueError:
+                pass
+    match = month_pattern.search(relative)
+    if match:
+        try:
+            return date(int(match.group(1)), int(match.group(2)), 1)
+        except ValueError:
+            pass
+
+    return default
+
+
+def day_prefixes(url, prefix_format, start, end):
+    """
+    Description: This function returns the date prefixes covering the days
+                 from start to end, eg. s3://udac-dend/log_data/2018/11/ for
+                 every day of November 2018 with the format {year:04d}/{month:02d}/
+
+    Arguments:
+        url: S3 url of the source
+        prefix_format: format of the date prefix below the source, with year, month and day
+        start: first day
+        end: last day
+
+    Returns:
+        list of (S3 url of the prefix, first day) in order
+    """
+    prefixes = []
+    day = start
+    while day <= end:
+        prefix = '{}/{}'.format(unquote(url).rstrip('/'), prefix_format.format(year=day.year, month=day.month,
+                                                                                day=day.day))
+        if not prefixes or prefixes[-1][0] != prefix:
+            prefixes.append((prefix, day))
+        day += timedelta(days=1)
+
+    return prefixes
+
+
+def list_folders(s3, url):
+    """
+    Description: This function lists the folders one level below an S3
+                 prefix with a single delimiter listing
+
+    Arguments:
+        s3: boto3 S3 client
+        url: S3 url of the prefix
+
+    Returns:
+        list of the names of the folders
+    """
+    bucket, prefix = split_s3_url(url)
+    prefix = prefix.rstrip('/') + '/' if prefix.strip('/') else ''
+    folders = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            folders.append(common_prefix['Prefix'][len(prefix):].rstrip('/'))
+
+    return folders
+
+
+def last_prefix_day(s3, url, prefix_format):
+    """
+    Description: This function finds the last day of the highest date prefix
+                 below the source, eg. 2018-11-30 for log_data/2018/11/ with
+                 the format {year:04d}/{month:02d}/. Every folder level of the
+                 format (year, then month) takes one delimiter listing.
+
+    Arguments:
+        s3: boto3 S3 client
+        url: S3 url of the source
+        prefix_format: format of the date prefix below the source, with year, month and day
+
+    Returns:
+        datetime.date, None if no folder matches the format
+    """
+    levels = prefix_format.split('/')[:-1]
+    url = unquote(url).rstrip('/')
+    values = {}
+    for level in levels:
+        pattern, position = '', 0
+        for field in format_field.finditer(level):
+            pattern += re.escape(level[position:field.start()]) + r'(?P<{}>\d+)'.format(field.group(1))
+            position = field.end()
+        pattern = re.compile(pattern + re.escape(level[position:]))
+
+        matches = [match for match in map(pattern.fullmatch, list_folders(s3, url)) if match]
+        if not matches:
+            return None
+        highest = max(matches, key=lambda m: tuple(int(v) for v in m.groups()))
+        values.update({name: int(value) for name, value in highest.groupdict().items()})
+        url = '{}/{}'.format(url, highest.group(0))
+
+    try:
+        first = date(values['year'], values.get('month', 1), values.get('day', 1))
+    except (KeyError, ValueError):
+        return None
+
+    # the last day with the same prefix, eg. the last day of the month
+    folder = lambda day: '/'.join(levels).format(year=day.year, month=day.month, day=day.day)
+    last = first
+    while folder(last + timedelta(days=1)) == folder(first):
+        last += timedelta(days=1)
+
+    return last
+
+
+def ensure_loaded_objects(conn, config):
+    """
+    Description: This function creates loaded_objects if it is missing, eg.
+                 on a cluster created before it existed
+
+    Arguments:
+        conn: object of the connection to the database
+        config: the ConfigParser object
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        if config.get('STAGING', 'BACKEND', fallback='redshift') == 'redshift':
+            cur.execute(loaded_objects_table_create)
+        else:
+            cur.execute(to_postgres(loaded_objects_table_create))
+    conn.commit()
+
+
+def keeps_staged_rows(conn, config, table):
+    """
+    Description: This function tells if an incremental run appends the new
+                 objects to a staging table instead of emptying it first.
+                 staging_songs keeps the songs of the former runs, which the
+                 songplays of the new events are joined to, as soon as its
+                 objects are recorded in loaded_objects. Until then, eg. in
+                 the first incremental run after a full load, it is emptied,
+                 so that no song is staged twice. staging_events is always
+                 emptied.
+
+    Arguments:
+        conn: object of the connection to the database
+        config: the ConfigParser object
+        table: name of the staging table
+
+    Returns:
+        True if the staged rows are kept
+    """
+    if table != 'staging_songs' or not has_loaded_objects(conn):
+        return False
+
+    with conn.cursor() as cur:
+        cur.execute(loaded_objects_count, (source_url(config, table),))
+        recorded = cur.fetchone()[0]
+    conn.commit()
+
+    return recorded > 0
+
+
+def has_loaded_objects(conn):
+    """
+    Description: This function tells if loaded_objects exists, without
+                 creating it
+
+    Arguments:
+        conn: object of the connection to the database
+
+    Returns:
+        True if the table exists
+    """
+    with conn.cursor() as cur:
+        cur.execute(loaded_objects_exists)
+        exists = cur.fetchone()[0] is not None
+    conn.rollback()
+
+    return exists
+
+
+def discover_objects(conn, s3, config, run_id, start=None, end=None, reload=False, workers=8, dry_run=False):
+    """
+    Description: This function finds the log objects that are not loaded yet.
+                 Only the date prefixes from start to end are listed,
+                 concurrently. start defaults to the last loaded day, which
+                 is listed again as more objects of the day may have arrived,
+                 then to LOG_START_DATE. Without both the whole source is
+                 listed once. end defaults to LOG_END_DATE, then to the
+                 last day of the highest date prefix of the source, so that
+                 no empty prefixes up to today are listed. A dry run does
+                 not create a missing loaded_objects, it finds nothing loaded.
+
+    Arguments:
+        conn: object of the connection to the database
+        s3: boto3 S3 client
+        config: the ConfigParser object
+        run_id: id of the run, its own objects count as not loaded, so that
+                a resumed run finds the same objects again
+        start: first day (datetime.date)
+        end: last day (datetime.date)
+        reload: also return the objects that are loaded already
+        workers: number of prefixes listed concurrently
+        dry_run: only read from the database
+
+    Returns:
+        objects: list of dicts with bucket, key, size, etag and day, sorted by key
+    """
+    source = unquote(config.get('S3', 'LOG_DATA'))
+    prefix_format = config.get('STAGING', 'LOG_PREFIX_FORMAT', fallback='{year:04d}/{month:02d}/')
+    if end is None and config.get('STAGING', 'LOG_END_DATE', fallback=''):
+        end = datetime.strptime(config.get('STAGING', 'LOG_END_DATE'), '%Y-%m-%d').date()
+    end = end or last_prefix_day(s3, source, prefix_format) or datetime.utcnow().date()
+    if dry_run:
+        exists = has_loaded_objects(conn)
+    else:
+        ensure_loaded_objects(conn, config)
+        exists = True
+
+    loaded = {}
+    with conn.cursor() as cur:
+        if start is None and exists:
+            cur.execute(loaded_objects_last_day, (source, run_id))
+            start = cur.fetchone()[0]
+        if start is None and config.get('STAGING', 'LOG_START_DATE', fallback=''):
+            start = datetime.strptime(config.get('STAGING', 'LOG_START_DATE'), '%Y-%m-%d').date()
+        if exists:
+            cur.execute(loaded_objects_select, (source, run_id, start or date.min, end))
+            loaded = dict(cur.fetchall())
+    conn.commit()
+
+    prefixes = day_prefixes(source, prefix_format, start, end) if start else [(source, None)]
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(prefixes)), 1)) as executor:
+        listings = list(executor.map(lambda p: list_objects(s3, p[0]), prefixes))
+
+    _, source_prefix = split_s3_url(source)
+    listed = []
+    for (prefix, first_day), listing in zip(prefixes, listings):
+        for o in listing:
+            day = object_day(o['key'], source_prefix, first_day)
+            if day is None or (start and day < start) or day > end:
+                continue
+            listed.append(dict(o, day=day.isoformat()))
+
+    print_status('log_discovery', '{} prefixes listed from {} to {}'.format(len(prefixes), start or 'the first log',
+                                                                            end))
+
+    return leave_out_loaded(listed, loaded, reload)
+
+
+def list_new_objects(conn, s3, config, table, run_id, reload=False, dry_run=False):
+    """
+    Description: This function finds the objects of the source of a staging
+                 table that are not loaded yet by listing the whole source,
+                 eg. the songs, or the logs without LOG_DISCOVERY. An object
+                 whose key holds no date gets the day it is loaded on.
+
+    Arguments:
+        conn: object of the connection to the database
+        s3: boto3 S3 client
+        config: the ConfigParser object
+        table: name of the staging table
+        run_id: id of the run, its own objects count as not loaded
+        reload: also return the objects that are loaded already
+        dry_run: only read from the database
+
+    Returns:
+        objects: list of dicts with bucket, key, size, etag and day, sorted by key
+    """
+    source = source_url(config, table)
+    if dry_run:
+        exists = has_loaded_objects(conn)
+    else:
+        ensure_loaded_objects(conn, config)
+        exists = True
+
+    loaded = {}
+    if exists:
+        with conn.cursor() as cur:
+            cur.execute(loaded_objects_select, (source, run_id, date.min, date.max))
+            loaded = dict(cur.fetchall())
+        conn.commit()
+
+    _, source_prefix = split_s3_url(source)
+    today = datetime.utcnow().date()
+    listed = [dict(o, day=object_day(o['key'], source_prefix, today).isoformat()) for o in list_objects(s3, source)]
+    print_status('log_discovery', '{} listed'.format(source))
+
+    return leave_out_loaded(listed, loaded, reload)
+
+
+def leave_out_loaded(listed, loaded, reload=False):
+    """
+    Description: This function leaves out the listed objects that are
+                 recorded as loaded. Recorded objects whose etag changed
+                 since are reported, they are only loaded again with reload.
+
+    Arguments:
+        listed: list of objects with their day
+        loaded: dict of recorded key -> etag
+        reload: keep the recorded objects
+
+    Returns:
+        objects: list of the new objects, sorted by key
+    """
+    objects, changed = [], []
+    for o in listed:
+        if o['key'] in loaded and not reload:
+            if loaded[o['key']] != o['etag']:
+                changed.append(o['key'])
+            continue
+        objects.append(o)
+
+    print_status('log_discovery', '{} new objects, {} loaded already'.format(len(objects), len(loaded)))
+    if changed:
+        print_status('log_discovery', '{} loaded objects changed since, eg. {}, load them again with --reload '
+                                      '(a backfill of their days for logs)'.format(len(changed), changed[0]))
+
+    return sorted(objects, key=lambda o: o['key'])
+
+
+def find_new_objects(conn, s3, config, table, run_id, start=None, end=None, reload=False, workers=8, dry_run=False):
+    """
+    Description: This function finds the objects of a staging table that are
+                 not loaded yet: the logs of the date prefixes from start to
+                 end with LOG_DISCOVERY or for a backfill (discover_objects),
+                 else those of the whole source (list_new_objects)
+
+    Arguments:
+        conn: object of the connection to the database
+        s3: boto3 S3 client
+        config: the ConfigParser object
+        table: name of the staging table
+        run_id: id of the run
+        start: first day, see discover_objects
+        end: last day, see discover_objects
+        reload: also return the objects that are loaded already
+        workers: number of prefixes listed concurrently
+        dry_run: only read from the database
+
+    Returns:
+        objects: list of dicts with bucket, key, size, etag and day, sorted by key
+    """
+    if table == 'staging_events' and (start or end or config.getboolean('STAGING', 'LOG_DISCOVERY', fallback=False)):
+        return discover_objects(conn, s3, config, run_id, start, end, reload, workers, dry_run)
+
+    return list_new_objects(conn, s3, config, table, run_id, reload, dry_run)
+
+
+def record_objects(cur, source, objects, run_id):
+    """
+    Description: This function records the objects of a COPY in
+                 loaded_objects, in the transaction of the COPY. Earlier
+                 rows of the same keys are replaced.
+
+    Arguments:
+        cur: the cursor object
+        source: S3 url of the source
+        objects: list of objects returned by discover_objects
+        run_id: id of the run
+
+    Returns:
+        None
+    """
+    if not objects:
+        return
+
+    now = datetime.utcnow()
+    cur.execute(loaded_objects_delete, (source, tuple(o['key'] for o in objects)))
+    execute_values(cur, loaded_objects_insert, [(source, o['key'], o['etag'], o['size'], o['day'], run_id, now)
+                                                for o in objects])
+
+
+def copy_objects(cur, config, s3, run_id, table, name, objects, field_names, loads=None, record=True):
+    """
+    Description: This function loads a group of new objects into a staging
+                 table from a manifest listing only them (emulated on the
+                 Postgres stand-in) and records them in loaded_objects in the
+                 same transaction, unless a backfill records them after their
+                 merge
+
+    Arguments:
+        cur: the cursor object
+        config: the ConfigParser object
+        s3: boto3 S3 client
+        run_id: id of the run
+        table: name of the staging table
+        name: name of the group, used to name the manifest
+        objects: list of objects returned by find_new_objects
+        field_names: json field of every staging column on the stand-in, None on Redshift
+        loads: list the telemetry is appended to
+        record: record the objects
+
+    Returns:
+        telemetry dict returned by copy_and_record
+    """
+    manifest_url = write_manifest(s3, objects, '{}/{}/{}.manifest'.format(
+        unquote(config.get('STAGING', 'MANIFEST_PREFIX')), table, name))
+    if field_names is None:
+        copy = lambda c: copy_manifest(c, table, manifest_url)
+    else:
+        max_error = config.getint('STAGING', 'MAXERROR', fallback=0)
+        copy = lambda c: copy_objects_postgres(c, s3, table, objects, field_names, max_error)
+
+    telemetry = copy_and_record(cur, run_id, table, manifest_url, copy, loads)
+    if record:
+        record_objects(cur, source_url(config, table), objects, run_id)
+
+    return telemetry
+
+
+def load_new_objects(config, table, source_url, run_id, loads=None, start=None, end=None, reload=False, workers=1,
+                     record=True):
+    """
+    Description: This function loads the new objects into a staging table,
+                 one COPY per slice-aligned group, like load_table in
+                 staging_loader.py, whose place it takes in an incremental
+                 load, after the table has been emptied (see keeps_staged_rows).
+                 With workers > 1 the groups are made small enough to give
+                 every worker one and are loaded concurrently, each over its
+                 own connection, eg. to backfill a date range. The version
+                 stamp of the table is bumped once after the COPYs.
+
+    Arguments:
+        config: the ConfigParser object
+        table: name of the staging table
+        source_url: S3 url of the source prefix
+        run_id: id of the run, used to name the manifests
+        loads: list the telemetry of every COPY is appended to
+        start: first day of the logs, see discover_objects
+        end: last day of the logs, see discover_objects
+        reload: also load the objects that are loaded already
+        workers: number of concurrent COPYs
+        record: record the objects in the transactions of their COPYs
+
+    Returns:
+        results: list of telemetry dicts returned by copy_and_record, with the group and its objects
+    """
+    s3 = get_s3_client(config)
+    conn = get_connection(config)
+    try:
+        objects = find_new_objects(conn, s3, config, table, run_id, start, end, reload)
+        num_slices = get_num_slices(conn, config)
+    finally:
+        conn.close()
+
+    files_per_slice = config.getint('STAGING', 'FILES_PER_SLICE', fallback=64)
+    if workers > 1:
+        files_per_slice = max(min(files_per_slice, math.ceil(len(objects) / (workers * num_slices))), 1)
+    groups = slice_aligned_groups(objects, num_slices, files_per_slice)
+    field_names = get_field_names(s3, config, table) if config.get('STAGING', 'BACKEND',
+                                                                   fallback='redshift') != 'redshift' else None
+    print_status('log_discovery', '{}: {} new files of {} in {} groups'.format(
+        table, len(objects), unquote(source_url), len(groups)))
+
+    def load(i, group):
+        group_conn = get_connection(config)
+        try:
+            with group_conn.cursor() as cur:
+                telemetry = copy_objects(cur, config, s3, run_id, table, '{}-{:04d}'.format(run_id, i), group,
+                                         field_names, loads, record)
+            group_conn.commit()
+        finally:
+            group_conn.close()
+        return dict(telemetry, group=i, objects=group)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(min(workers, len(groups)), 1)) as executor:
+            return list(executor.map(load, range(len(groups)), groups))
+    finally:
+        if groups:
+            conn = get_connection(config)
+            try:
+                bump_table_versions(conn, [table])
+            finally:
+                conn.close()
+
+
+def merge_objects(config, run_id, objects, start=None, end=None):
+    """
+    Description: This function merges the staged events into the star schema
+                 and records the loaded log objects in loaded_objects in the
+                 same transaction, so that no object counts as loaded before
+                 its events are merged. A backfill merges the events of its
+                 days, below the watermark too, else the events above the
+                 watermark are merged like by an incremental etl.py run.
+
+    Arguments:
+        config: the ConfigParser object
+        run_id: id of the run
+        objects: list of the loaded objects
+        start: first day of a backfill
+        end: last day of a backfill
+
+    Returns:
+        number of merged events
+    """
+    # imported here, etl.py imports this module
+    from etl import merge_backfill_events, merge_new_events
+
+    conn = get_connection(config)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(translate(config, staging_events_key_update))
+            if start:
+                merged = merge_backfill_events(cur, config, start, end)
+            else:
+                merged = merge_new_events(cur, config)
+            record_objects(cur, source_url(config, 'staging_events'), objects, run_id)
+        conn.commit()
+        bump_table_versions(conn, list(star_table_creates) + ['staging_events', 'staging_songs'])
+    finally:
+        conn.close()
+
+    return merged
+
+
+def parse_day(value):
+    """
+    Description: This function parses a day given on the command line
+
+    Arguments:
+        value: day as YYYY-MM-DD
+
+    Returns:
+        datetime.date
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main():
+    """
+    Description: This main function loads the log objects that are new since
+                 the last load into staging_events, or with --backfill those
+                 of a date range, concurrently, and merges their events into
+                 the star schema, see merge_objects. The objects are recorded
+                 with the merge, a failed run loads them again. --dry-run only
+                 prints the objects that would be loaded.
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Load only the new log objects into staging_events')
+    parser.add_argument('--backfill', nargs=2, type=parse_day, metavar=('START', 'END'),
+                        help='load the objects of the days from START to END (YYYY-MM-DD)')
+    parser.add_argument('--reload', action='store_true', help='also load the objects that are loaded already')
+    parser.add_argument('--workers', type=int, help='concurrent COPYs (default: BACKFILL_WORKERS, 1 without --backfill)')
+    parser.add_argument('--dry-run', action='store_true', help='print the new objects without loading them')
+    args = parser.parse_args()
+
+    config = read_config('dwh.cfg')
+    run_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    start, end = args.backfill or (None, None)
+
+    if args.dry_run:
+        conn = get_connection(config)
+        try:
+            objects = find_new_objects(conn, get_s3_client(config), config, 'staging_events', run_id, start, end,
+                                       args.reload, dry_run=True)
+        finally:
+            conn.close()
+        for o in objects:
+            print('{day}  {size:>12}  s3://{bucket}/{key}'.format(**o))
+        return
+
+    if not args.backfill and not discovery_enabled(config):
+        raise SystemExit('the new objects are merged above the watermark of the incremental load, '
+                         'set INCREMENTAL=true in the ETL section or run a --backfill')
+
+    workers = args.workers or (config.getint('STAGING', 'BACKFILL_WORKERS', fallback=4) if args.backfill else 1)
+    conn = get_connection(config)
+    ensure_load_tables(conn)
+    conn.close()
+    loads = []
+    try:
+        results = load_new_objects(config, 'staging_events', config.get('S3', 'LOG_DATA'), run_id, loads,
+                                   start, end, args.reload, workers, record=False)
+        print_report(results)
+        if not results:
+            return
+        merged = merge_objects(config, run_id, [o for r in results for o in r['objects']], start, end)
+        print_status('log_discovery', '{} events merged, {} objects recorded'.format(
+            merged, sum(len(r['objects']) for r in results)))
+    finally:
+        path = write_load_report(config, run_id, loads)
+        if path:
+            print_status('log_discovery', 'load report written to {}'.format(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import argparse
+import json
+import math
+import statistics
+from datetime import datetime, timezone
+from time import perf_counter
+import psycopg2
+from pagila_star import default_dsn, load_pagila, build_star, scale_facts
+
+
+# the star schema of the benchmark, filled with synthetic facts, so that the
+# pagila_star schema pagila_pipeline.py maintains is not touched
+bench_schema = 'pagila_star_bench'
+
+
+# QUERY FAMILIES, see the L1 E2 notebooks
+slice_query = ("""SELECT d.day, m.rating, s.city, sum(f.sales_amount) AS revenue
+                  FROM factSales f
+                  JOIN dimDate d  ON f.date_key  = d.date_key
+                  JOIN dimMovie m ON m.movie_key = f.movie_key
+                  JOIN dimStore s ON s.store_key = f.store_key
+                  WHERE m.rating = 'PG-13'
+                  GROUP BY (d.day, m.rating, s.city)
+                  ORDER BY revenue DESC
+                  LIMIT 20;
+""")
+
+dice_query = ("""SELECT d.day, m.rating, s.city, sum(f.sales_amount) AS revenue
+                 FROM factSales f
+                 JOIN dimDate d  ON f.date_key  = d.date_key
+                 JOIN dimMovie m ON m.movie_key = f.movie_key
+                 JOIN dimStore s ON s.store_key = f.store_key
+                 WHERE m.rating IN ('PG-13', 'PG')
+                 AND s.city IN ('Bellevue', 'Lancaster')
+                 AND d.day IN (1, 15, 30)
+                 GROUP BY (d.day, m.rating, s.city)
+                 ORDER BY revenue DESC
+                 LIMIT 20;
+""")
+
+rollup_query = ("""SELECT d.day, m.rating, c.country, sum(f.sales_amount) AS revenue
+                   FROM factSales f
+                   JOIN dimDate d     ON f.date_key  = d.date_key
+                   JOIN dimMovie m    ON m.movie_key = f.movie_key
+                   JOIN dimCustomer c ON c.customer_key = f.customer_key
+                   GROUP BY (d.day, m.rating, c.country)
+                   ORDER BY revenue DESC
+                   LIMIT 20;
+""")
+
+drilldown_query = ("""SELECT d.day, m.rating, c.district, sum(f.sales_amount) AS revenue
+                      FROM factSales f
+                      JOIN dimDate d     ON f.date_key  = d.date_key
+                      JOIN dimMovie m    ON m.movie_key = f.movie_key
+                      JOIN dimCustomer c ON c.customer_key = f.customer_key
+                      GROUP BY (d.day, m.rating, c.district)
+                      ORDER BY revenue DESC
+                      LIMIT 20;
+""")
+
+grouping_sets_query = ("""SELECT d.month, s.country, sum(sales_amount) AS revenue
+                          FROM factSales f
+                          JOIN dimDate d  ON f.date_key = d.date_key
+                          JOIN dimStore s ON f.store_key = s.store_key
+                          GROUP BY grouping sets ((), d.month, s.country, (d.month, s.country));
+""")
+
+cube_query = ("""SELECT d.month, s.country, sum(sales_amount) AS revenue
+                 FROM factSales f
+                 JOIN dimDate d  ON f.date_key = d.date_key
+                 JOIN dimStore s ON f.store_key = s.store_key
+                 GROUP BY CUBE (d.month, s.country);
+""")
+
+# the four groupings of month and country as separate aggregations, the
+# equivalent of both the grouping sets and the CUBE query
+union_all_query = ("""SELECT NULL::smallint AS month, NULL AS country, sum(sales_amount) AS revenue
+                      FROM factSales
+                      UNION ALL
+                      SELECT NULL, s.country, sum(sales_amount)
+                      FROM factSales f
+                      JOIN dimStore s ON s.store_key = f.store_key
+                      GROUP BY s.country
+                      UNION ALL
+                      SELECT d.month, NULL, sum(sales_amount)
+                      FROM factSales f
+                      JOIN dimDate d ON d.date_key = f.date_key
+                      GROUP BY d.month
+                      UNION ALL
+                      SELECT d.month, s.country, sum(sales_amount)
+                      FROM factSales f
+                      JOIN dimDate d  ON d.date_key = f.date_key
+                      JOIN dimStore s ON s.store_key = f.store_key
+                      GROUP BY d.month, s.country;
+""")
+
+# family -> list of (name, query)
+query_families = {
+    'slicing_dicing': [('slice', slice_query), ('dice', dice_query)],
+    'rollup_drilldown': [('rollup_country', rollup_query), ('drilldown_district', drilldown_query)],
+    'grouping_sets': [('grouping_sets', grouping_sets_query), ('grouping_sets_union_all', union_all_query)],
+    'cube': [('cube', cube_query), ('cube_union_all', union_all_query)],
+}
+
+# (native, rewrite) pairs that must return the same rows
+comparisons = [('grouping_sets', 'grouping_sets_union_all'), ('cube', 'cube_union_all')]
+
+
+def percentile(values, p):
+    """
+    Description: This function returns the nearest-rank percentile of values
+
+    Arguments:
+        values: list of numbers
+        p: percentile between 0 and 100
+
+    Returns:
+        the percentile
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+
+    return ordered[rank - 1]
+
+
+def time_query(cur, query, repeat, warmup):
+    """
+    Description: This function runs a query repeatedly and times every run
+
+    Arguments:
+        cur: the cursor object
+        query: SQL query
+        repeat: number of timed runs
+        warmup: number of untimed runs before
+
+    Returns:
+        timings: list of latencies in milliseconds
+        rows: the rows of the last run
+    """
+    for _ in range(warmup):
+        cur.execute(query)
+        cur.fetchall()
+
+    timings = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        cur.execute(query)
+        rows = cur.fetchall()
+        timings.append((perf_counter() - t0) * 1000)
+
+    return timings, rows
+
+
+def normalize(rows):
+    """
+    Description: This function brings result rows into a comparable order,
+                 the numeric columns are compared as strings
+
+    Arguments:
+        rows: result rows
+
+    Returns:
+        sorted list of rows
+    """
+    return sorted(tuple('' if v is None else str(v) for v in row) for row in rows)
+
+
+def run_benchmark(conn, repeat, warmup, families, schema=bench_schema):
+    """
+    Description: This function runs the query families against the star schema
+
+    Arguments:
+        conn: object of the connection to the database
+        repeat: number of timed runs of every query
+        warmup: number of untimed runs of every query
+        families: names of the query families to run
+        schema: schema of the star schema
+
+    Returns:
+        queries: list of dicts with the latency statistics of every query
+        comparisons: list of dicts comparing the native queries with their rewrites
+    """
+    results, rows_by_name = [], {}
+    with conn.cursor() as cur:
+        cur.execute('SET search_path TO {}, public;'.format(schema))
+        for family in families:
+            for name, query in query_families[family]:
+                timings, rows = time_query(cur, query, repeat, warmup)
+                rows_by_name[name] = rows
+                results.append({'family': family, 'query': name, 'runs': repeat, 'rows': len(rows),
+                                'median_ms': statistics.median(timings), 'p95_ms': percentile(timings, 95),
+                                'min_ms': min(timings), 'max_ms': max(timings)})
+    conn.rollback()
+
+    by_name = {r['query']: r for r in results}
+    compared = []
+    for native, rewrite in comparisons:
+        if native in by_name and rewrite in by_name:
+            compared.append({'native': native, 'rewrite': rewrite,
+                             'native_median_ms': by_name[native]['median_ms'],
+                             'rewrite_median_ms': by_name[rewrite]['median_ms'],
+                             'speedup': by_name[rewrite]['median_ms'] / by_name[native]['median_ms'],
+                             'same_result': normalize(rows_by_name[native]) == normalize(rows_by_name[rewrite])})
+
+    return results, compared
+
+
+def print_report(report):
+    """
+    Description: This function prints the latencies and comparisons of a report
+
+    Arguments:
+        report: dict written by main
+
+    Returns:
+        None
+    """
+    print('fact rows: {}'.format(report['run']['fact_rows']))
+    print('{:<18}{:<26}{:>8}{:>12}{:>12}'.format('family', 'query', 'rows', 'median ms', 'p95 ms'))
+    for r in report['queries']:
+        print('{family:<18}{query:<26}{rows:>8}{median_ms:>12.2f}{p95_ms:>12.2f}'.format(**r))
+    for c in report['comparisons']:
+        print('{native} vs. {rewrite}: {native_median_ms:.2f} ms vs. {rewrite_median_ms:.2f} ms, '
+              'native {speedup:.2f}x faster, same result: {same_result}'.format(**c))
+
+
+def main():
+    """
+    Description: This main function loads pagila, builds and scales the star
+                 schema, runs the OLAP query families and writes the report as JSON
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the OLAP queries of the L1 E2 notebooks on a pagila star schema')
+    parser.add_argument('--dsn', default=default_dsn)
+    parser.add_argument('--scale', type=int, default=1, help='size of factSales as a multiple of the pagila facts')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--family', action='append', choices=sorted(query_families),
+                        help='query family to run, can be repeated (default: all)')
+    parser.add_argument('--schema', default=bench_schema, help='schema of the star schema, dropped and rebuilt')
+    parser.add_argument('--reload', action='store_true', help='reload the pagila 3NF schema and data')
+    parser.add_argument('--output', default='olap_benchmark.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        errors = load_pagila(conn, args.reload)
+        for statement, error in errors:
+            print('skipped: {} ({})'.format(statement, error))
+        build_star(conn, args.schema)
+        fact_rows = scale_facts(conn, args.scale, args.schema)
+
+        with conn.cursor() as cur:
+            cur.execute('SHOW server_version;')
+            server_version = cur.fetchone()[0]
+        queries, compared = run_benchmark(conn, args.repeat, args.warmup, args.family or list(query_families),
+                                          args.schema)
+    finally:
+        conn.close()
+
+    report = {'run': {'timestamp': datetime.now(timezone.utc).isoformat(), 'server_version': server_version,
+                      'scale': args.scale, 'fact_rows': fact_rows, 'repeat': args.repeat, 'warmup': args.warmup},
+              'queries': queries,
+              'comparisons': compared}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print('report written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
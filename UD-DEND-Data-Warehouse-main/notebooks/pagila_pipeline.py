@@ -0,0 +1,289 @@
+import argparse
+import csv
+import io
+from datetime import datetime
+from time import perf_counter
+import psycopg2
+from pagila_star import default_dsn, star_schema, star_table_creates
+
+
+# the high payment_id of the last run, kept in the star schema
+pipeline_state_create = ("""CREATE TABLE IF NOT EXISTS pipeline_state (
+                            source      varchar(32)   PRIMARY KEY,
+                            high_id     integer       NOT NULL,
+                            loaded_at   timestamp     NOT NULL
+                            );
+""")
+
+pipeline_state_select = "SELECT high_id FROM pipeline_state WHERE source = 'payment';"
+
+pipeline_state_upsert = ("""INSERT INTO pipeline_state (source, high_id, loaded_at)
+                            VALUES ('payment', %s, %s)
+                            ON CONFLICT (source) DO UPDATE SET high_id = EXCLUDED.high_id,
+                                                               loaded_at = EXCLUDED.loaded_at;
+""")
+
+# every payment of a rental is a sale, in payment_id order, so that the
+# sales_key of the facts grows with the payments (see rollup_cache.py)
+new_payments_select = ("""SELECT p.payment_id, p.payment_date::date, p.customer_id, i.film_id, i.store_id, p.amount
+                          FROM payment p
+                          JOIN rental r     ON r.rental_id = p.rental_id
+                          JOIN inventory i  ON i.inventory_id = r.inventory_id
+                          WHERE p.payment_id > %s
+                          ORDER BY p.payment_id;
+""")
+
+# SURROGATE KEY LOOKUPS
+# natural key -> surrogate key of every dimension, and the insert of the
+# dimension rows of new natural keys, like the inserts of L1 E1 - Step 5
+date_key_select = "SELECT date, date_key FROM dimDate;"
+
+date_key_insert = ("""INSERT INTO dimDate (date_key, date, year, quarter, month, day, week, is_weekend)
+                      SELECT TO_CHAR(d, 'yyyyMMDD')::integer, d,
+                             EXTRACT(year FROM d), EXTRACT(quarter FROM d), EXTRACT(month FROM d),
+                             EXTRACT(day FROM d), EXTRACT(week FROM d), EXTRACT(ISODOW FROM d) IN (6, 7)
+                      FROM unnest(%s::date[]) AS d
+                      RETURNING date, date_key;
+""")
+
+customer_key_select = "SELECT customer_id, MAX(customer_key) FROM dimCustomer GROUP BY customer_id;"
+
+customer_key_insert = ("""INSERT INTO dimCustomer (customer_id, first_name, last_name, email, address, address2,
+                                                   district, city, country, postal_code, phone, active,
+                                                   create_date, start_date, end_date)
+                          SELECT c.customer_id, c.first_name, c.last_name, c.email, a.address, a.address2,
+                                 a.district, ci.city, co.country, a.postal_code, a.phone, c.active,
+                                 now(), now(), now()
+                          FROM customer c
+                          JOIN address a  ON (c.address_id = a.address_id)
+                          JOIN city ci    ON (a.city_id = ci.city_id)
+                          JOIN country co ON (ci.country_id = co.country_id)
+                          WHERE c.customer_id = ANY(%s)
+                          RETURNING customer_id, customer_key;
+""")
+
+movie_key_select = "SELECT film_id, MAX(movie_key) FROM dimMovie GROUP BY film_id;"
+
+movie_key_insert = ("""INSERT INTO dimMovie (film_id, title, description, release_year, language, original_language,
+                                             rental_duration, length, rating, special_features)
+                       SELECT f.film_id, f.title, f.description, f.release_year, l.name, orig_lang.name,
+                              f.rental_duration, f.length, f.rating, f.special_features
+                       FROM film f
+                       JOIN language l              ON (f.language_id = l.language_id)
+                       LEFT JOIN language orig_lang ON (f.original_language_id = orig_lang.language_id)
+                       WHERE f.film_id = ANY(%s)
+                       RETURNING film_id, movie_key;
+""")
+
+store_key_select = "SELECT store_id, MAX(store_key) FROM dimStore GROUP BY store_id;"
+
+store_key_insert = ("""INSERT INTO dimStore (store_id, address, address2, district, city, country, postal_code,
+                                             manager_first_name, manager_last_name, start_date, end_date)
+                       SELECT s.store_id, a.address, a.address2, a.district, ci.city, co.country, a.postal_code,
+                              st.first_name, st.last_name, now(), now()
+                       FROM store s
+                       JOIN staff st    ON st.staff_id = s.manager_staff_id
+                       JOIN address a   ON a.address_id = s.address_id
+                       JOIN city ci     ON ci.city_id = a.city_id
+                       JOIN country co  ON ci.country_id = co.country_id
+                       WHERE s.store_id = ANY(%s)
+                       RETURNING store_id, store_key;
+""")
+
+# dimension -> (select, insert)
+key_lookups = {'dimDate': (date_key_select, date_key_insert),
+               'dimCustomer': (customer_key_select, customer_key_insert),
+               'dimMovie': (movie_key_select, movie_key_insert),
+               'dimStore': (store_key_select, store_key_insert)}
+
+# the serial keys of a star built by pagila_star.build_star are set explicitly
+serial_keys = [('dimCustomer', 'customer_key'), ('dimMovie', 'movie_key'), ('dimStore', 'store_key'),
+               ('factSales', 'sales_key')]
+
+
+class KeyLookup:
+    """
+    Description: Surrogate keys of one dimension by natural key, read once per
+                 run and held in memory. Natural keys that are not found get
+                 their dimension rows inserted from the 3NF tables, all
+                 misses of a batch with one statement.
+    """
+
+    def __init__(self, cur, select_sql, insert_sql):
+        cur.execute(select_sql)
+        self.keys = dict(cur.fetchall())
+        self.insert_sql = insert_sql
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, cur, natural_keys):
+        """
+        Description: This function makes sure all natural keys of a batch have
+                     a surrogate key
+
+        Arguments:
+            cur: the cursor object
+            natural_keys: natural keys of the batch
+
+        Returns:
+            None
+        """
+        missing = sorted(set(k for k in natural_keys if k not in self.keys))
+        self.misses += len(missing)
+        self.hits += len(natural_keys) - len(missing)
+        if missing:
+            cur.execute(self.insert_sql, (missing,))
+            self.keys.update(cur.fetchall())
+
+
+def create_star(conn, schema=star_schema):
+    """
+    Description: This function creates the empty star schema with the state
+                 of the pipeline in its own schema
+
+    Arguments:
+        conn: object of the connection to the database
+        schema: name of the star schema
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}, public;'.format(schema))
+        for query in star_table_creates + [pipeline_state_create]:
+            cur.execute(query)
+    conn.commit()
+
+
+def read_high_id(cur):
+    """
+    Description: This function returns the high payment_id of the last run.
+                 A star with facts but without state was built by
+                 pagila_star.build_star, loading it again would double the facts.
+
+    Arguments:
+        cur: the cursor object, with the star schema on the search path
+
+    Returns:
+        high payment_id, 0 before the first run
+    """
+    cur.execute(pipeline_state_create)
+    cur.execute(pipeline_state_select)
+    row = cur.fetchone()
+    if row:
+        return row[0]
+
+    cur.execute('SELECT EXISTS (SELECT 1 FROM factSales);')
+    if cur.fetchone()[0]:
+        raise SystemExit('factSales was not loaded by the pipeline, run it with --rebuild')
+    for table, column in serial_keys:
+        cur.execute("SELECT setval(pg_get_serial_sequence('{0}', '{1}'), COALESCE(MAX({1}), 0) + 1, false) "
+                    "FROM {0};".format(table, column))
+
+    return 0
+
+
+def run_pipeline(conn, schema=star_schema, source_schema='public', batch_size=50000):
+    """
+    Description: This function loads the payments that are new since the last
+                 run from the 3NF tables into the star schema: the payments
+                 are read in batches, the surrogate keys are looked up in
+                 memory (the dimension rows of new natural keys are added)
+                 and the facts are written with COPY. The facts and the new
+                 high payment_id are committed in one transaction.
+
+    Arguments:
+        conn: object of the connection to the database
+        schema: name of the star schema
+        source_schema: schema of the 3NF tables, tables missing there are read from public
+        batch_size: payments per batch
+
+    Returns:
+        dict with the previous and new high payment_id, facts, seconds and
+        the hits, misses and rows of every key lookup
+    """
+    t0 = perf_counter()
+    with conn.cursor() as cur:
+        cur.execute('SET search_path TO {}, {}, public;'.format(schema, source_schema))
+        high_id = read_high_id(cur)
+        lookups = {dimension: KeyLookup(cur, select_sql, insert_sql)
+                   for dimension, (select_sql, insert_sql) in key_lookups.items()}
+
+        facts, new_high_id = 0, high_id
+        with conn.cursor('new_payments') as payments:
+            payments.itersize = batch_size
+            payments.execute(new_payments_select, (high_id,))
+            while True:
+                batch = payments.fetchmany(batch_size)
+                if not batch:
+                    break
+                for position, dimension in enumerate(['dimDate', 'dimCustomer', 'dimMovie', 'dimStore'], 1):
+                    lookups[dimension].resolve(cur, [row[position] for row in batch])
+
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for payment_id, date, customer_id, film_id, store_id, amount in batch:
+                    writer.writerow([lookups['dimDate'].keys[date], lookups['dimCustomer'].keys[customer_id],
+                                     lookups['dimMovie'].keys[film_id], lookups['dimStore'].keys[store_id], amount])
+                buffer.seek(0)
+                cur.copy_expert('COPY factSales (date_key, customer_key, movie_key, store_key, sales_amount) '
+                                'FROM STDIN WITH (FORMAT csv)', buffer)
+                facts += len(batch)
+                new_high_id = batch[-1][0]
+
+        cur.execute(pipeline_state_upsert, (new_high_id, datetime.now()))
+        if facts:
+            cur.execute('ANALYZE factSales;')
+    conn.commit()
+
+    return {'previous_high_id': high_id, 'high_id': new_high_id, 'facts': facts, 'seconds': perf_counter() - t0,
+            'lookups': {dimension: {'keys': len(lookup.keys), 'hits': lookup.hits, 'misses': lookup.misses}
+                        for dimension, lookup in lookups.items()}}
+
+
+def print_stats(stats):
+    """
+    Description: This function prints the stats of a run
+
+    Arguments:
+        stats: dict returned by run_pipeline
+
+    Returns:
+        None
+    """
+    print('payments {previous_high_id} < payment_id <= {high_id}: {facts} facts in {seconds:.2f}s'.format(**stats))
+    print('{:<14}{:>10}{:>10}{:>10}'.format('dimension', 'keys', 'hits', 'misses'))
+    for dimension, lookup in stats['lookups'].items():
+        print('{:<14}{keys:>10}{hits:>10}{misses:>10}'.format(dimension, **lookup))
+
+
+def main():
+    """
+    Description: This main function loads the new payments of pagila into the
+                 star schema, with --rebuild into a new star schema
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Load the new pagila payments into the star schema')
+    parser.add_argument('--dsn', default=default_dsn)
+    parser.add_argument('--schema', default=star_schema, help='schema of the star schema')
+    parser.add_argument('--source-schema', default='public', help='schema of the 3NF tables')
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--rebuild', action='store_true', help='drop the star schema and load all payments')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        if args.rebuild:
+            create_star(conn, args.schema)
+        print_stats(run_pipeline(conn, args.schema, args.source_schema, args.batch_size))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
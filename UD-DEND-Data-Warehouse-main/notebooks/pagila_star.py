@@ -0,0 +1,319 @@
+import io
+import os
+import re
+import psycopg2
+
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+pagila_files = ['pagila-schema.sql', 'pagila-data.sql']
+
+# connection of the exercises, see L1 E1 - Step 1 and 2
+default_dsn = "host=127.0.0.1 port=5433 dbname=pagila user=student password=student"
+
+star_schema = 'pagila_star'
+
+# STAR SCHEMA, see L1 E1 - Step 4
+date_table_create = ("""CREATE TABLE dimDate (
+                        date_key     SERIAL     PRIMARY KEY,
+                        date         date       NOT NULL,
+                        year         smallint   NOT NULL,
+                        quarter      smallint   NOT NULL,
+                        month        smallint   NOT NULL,
+                        day          smallint   NOT NULL,
+                        week         smallint   NOT NULL,
+                        is_weekend   boolean    NOT NULL
+                        );
+""")
+
+customer_table_create = ("""CREATE TABLE dimCustomer (
+                            customer_key   SERIAL        PRIMARY KEY,
+                            customer_id    smallint      NOT NULL,
+                            first_name     varchar(45)   NOT NULL,
+                            last_name      varchar(45)   NOT NULL,
+                            email          varchar(50),
+                            address        varchar(50)   NOT NULL,
+                            address2       varchar(50),
+                            district       varchar(20)   NOT NULL,
+                            city           varchar(50)   NOT NULL,
+                            country        varchar(50)   NOT NULL,
+                            postal_code    varchar(10),
+                            phone          varchar(20)   NOT NULL,
+                            active         smallint      NOT NULL,
+                            create_date    timestamp     NOT NULL,
+                            start_date     date          NOT NULL,
+                            end_date       date          NOT NULL
+                            );
+""")
+
+movie_table_create = ("""CREATE TABLE dimMovie (
+                         movie_key           SERIAL         PRIMARY KEY,
+                         film_id             smallint       NOT NULL,
+                         title               varchar(255)   NOT NULL,
+                         description         text,
+                         release_year        year,
+                         language            varchar(20)    NOT NULL,
+                         original_language   varchar(20),
+                         rental_duration     smallint       NOT NULL,
+                         length              smallint       NOT NULL,
+                         rating              varchar(5)     NOT NULL,
+                         special_features    varchar(60)    NOT NULL
+                         );
+""")
+
+store_table_create = ("""CREATE TABLE dimStore (
+                         store_key            SERIAL        PRIMARY KEY,
+                         store_id             smallint      NOT NULL,
+                         address              varchar(50)   NOT NULL,
+                         address2             varchar(50),
+                         district             varchar(20)   NOT NULL,
+                         city                 varchar(50)   NOT NULL,
+                         country              varchar(50)   NOT NULL,
+                         postal_code          varchar(10),
+                         manager_first_name   varchar(45)   NOT NULL,
+                         manager_last_name    varchar(45)   NOT NULL,
+                         start_date           date          NOT NULL,
+                         end_date             date          NOT NULL
+                         );
+""")
+
+sales_table_create = ("""CREATE TABLE factSales (
+                         sales_key      SERIAL    PRIMARY KEY,
+                         date_key       integer   REFERENCES dimDate(date_key),
+                         customer_key   integer   REFERENCES dimCustomer(customer_key),
+                         movie_key      integer   REFERENCES dimMovie(movie_key),
+                         store_key      integer   REFERENCES dimStore(store_key),
+                         sales_amount   numeric   NOT NULL
+                         );
+""")
+
+# ETL FROM THE 3NF SCHEMA, see L1 E1 - Step 5
+date_table_insert = ("""INSERT INTO dimDate (date_key, date, year, quarter, month, day, week, is_weekend)
+                        SELECT DISTINCT(TO_CHAR(payment_date :: DATE, 'yyyyMMDD')::integer) AS date_key,
+                               date(payment_date)                                           AS date,
+                               EXTRACT(year FROM payment_date)                              AS year,
+                               EXTRACT(quarter FROM payment_date)                           AS quarter,
+                               EXTRACT(month FROM payment_date)                             AS month,
+                               EXTRACT(day FROM payment_date)                               AS day,
+                               EXTRACT(week FROM payment_date)                              AS week,
+                               CASE WHEN EXTRACT(ISODOW FROM payment_date) IN (6, 7) THEN true ELSE false END AS is_weekend
+                        FROM payment;
+""")
+
+customer_table_insert = ("""INSERT INTO dimCustomer (customer_key, customer_id, first_name, last_name, email, address,
+                                                     address2, district, city, country, postal_code, phone, active,
+                                                     create_date, start_date, end_date)
+                            SELECT c.customer_id AS customer_key, c.customer_id, c.first_name, c.last_name, c.email,
+                                   a.address, a.address2, a.district, ci.city, co.country, a.postal_code, a.phone,
+                                   c.active, now() AS create_date, now() AS start_date, now() AS end_date
+                            FROM customer c
+                            JOIN address a  ON (c.address_id = a.address_id)
+                            JOIN city ci    ON (a.city_id = ci.city_id)
+                            JOIN country co ON (ci.country_id = co.country_id);
+""")
+
+movie_table_insert = ("""INSERT INTO dimMovie (movie_key, film_id, title, description, release_year, language,
+                                               original_language, rental_duration, length, rating, special_features)
+                         SELECT f.film_id AS movie_key, f.film_id, f.title, f.description, f.release_year,
+                                l.name AS language, orig_lang.name AS original_language, f.rental_duration,
+                                f.length, f.rating, f.special_features
+                         FROM film f
+                         JOIN language l              ON (f.language_id=l.language_id)
+                         LEFT JOIN language orig_lang ON (f.original_language_id = orig_lang.language_id);
+""")
+
+store_table_insert = ("""INSERT INTO dimStore (store_key, store_id, address, address2, district, city, country,
+                                               postal_code, manager_first_name, manager_last_name, start_date, end_date)
+                         SELECT s.store_id AS store_key, s.store_id, a.address, a.address2, a.district, ci.city,
+                                co.country, a.postal_code, st.first_name AS manager_first_name,
+                                st.last_name AS manager_last_name, now() AS start_date, now() AS end_date
+                         FROM store s
+                         JOIN staff st    ON st.store_id = s.store_id
+                         JOIN address a   ON a.address_id = s.address_id
+                         JOIN city ci     ON ci.city_id = a.city_id
+                         JOIN country co  ON ci.country_id = co.country_id;
+""")
+
+sales_table_insert = ("""INSERT INTO factSales (date_key, customer_key, movie_key, store_key, sales_amount)
+                         SELECT DISTINCT(TO_CHAR(payment_date :: DATE, 'yyyyMMDD')::integer) AS date_key,
+                                p.customer_id AS customer_key,
+                                i.film_id     AS movie_key,
+                                i.store_id    AS store_key,
+                                p.amount      AS sales_amount
+                         FROM payment p
+                         JOIN rental r     ON r.rental_id = p.rental_id
+                         JOIN inventory i  ON i.inventory_id = r.inventory_id;
+""")
+
+# copies of the facts with random date, customer and movie, the store and amount are kept
+sales_table_scale = ("""INSERT INTO factSales (date_key, customer_key, movie_key, store_key, sales_amount)
+                        SELECT k.dates[1 + floor(random() * cardinality(k.dates))::int],
+                               k.customers[1 + floor(random() * cardinality(k.customers))::int],
+                               k.movies[1 + floor(random() * cardinality(k.movies))::int],
+                               f.store_key,
+                               f.sales_amount
+                        FROM factSales f
+                        CROSS JOIN (SELECT (SELECT array_agg(date_key) FROM dimDate)         AS dates,
+                                           (SELECT array_agg(customer_key) FROM dimCustomer) AS customers,
+                                           (SELECT array_agg(movie_key) FROM dimMovie)       AS movies) AS k
+                        CROSS JOIN generate_series(1, %s) AS copy
+                        WHERE f.sales_key <= %s;
+""")
+
+star_table_creates = [date_table_create, customer_table_create, movie_table_create, store_table_create, sales_table_create]
+star_table_inserts = [date_table_insert, customer_table_insert, movie_table_insert, store_table_insert, sales_table_insert]
+
+
+def split_sql(text):
+    """
+    Description: This function splits a psql script into its statements. The
+                 rows following a COPY ... FROM stdin statement up to the line
+                 with a backslash and a dot are returned with the statement.
+
+    Arguments:
+        text: content of the script
+
+    Returns:
+        list of (statement, COPY data or None)
+    """
+    statements = []
+    start, i, n = 0, 0, len(text)
+    while i < n:
+        c = text[i]
+        if c == '-' and text.startswith('--', i):
+            i = text.find('\n', i)
+            i = n if i == -1 else i
+        elif c == "'":
+            i += 1
+            while i < n and text[i] != "'":
+                # the dumps are written with standard_conforming_strings off
+                i += 2 if text[i] == '\\' else 1
+        elif c == '$':
+            tag = re.match(r'\$\w*\$', text[i:])
+            if tag:
+                i = text.find(tag.group(0), i + len(tag.group(0))) + len(tag.group(0)) - 1
+        elif c == ';':
+            statement = text[start:i + 1].strip()
+            data = None
+            if re.match(r'COPY\b.*\bFROM\s+stdin\s*;$', statement, flags=re.I | re.S):
+                end = text.find('\n\\.\n', i)
+                data = text[i + 2:end + 1]
+                i = end + 3
+            statements.append((statement, data))
+            start = i + 1
+        i += 1
+
+    return statements
+
+
+def run_sql_file(conn, path):
+    """
+    Description: This function runs a psql script like psql -f does: every
+                 statement runs on its own, failing statements are reported
+                 and skipped. Statements of old dumps that do not apply to a
+                 current server (eg. CREATE PROCEDURAL LANGUAGE plpgsql, OWNER
+                 TO a missing role) fail that way without stopping the load.
+
+    Arguments:
+        conn: object of the connection to the database
+        path: path to the script
+
+    Returns:
+        errors: list of (statement, error message)
+    """
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+
+    errors = []
+    with conn.cursor() as cur:
+        for statement, data in split_sql(text):
+            cur.execute('SAVEPOINT statement;')
+            try:
+                if data is None:
+                    cur.execute(statement)
+                else:
+                    cur.copy_expert(statement.rstrip(';'), io.StringIO(data))
+            except psycopg2.Error as e:
+                cur.execute('ROLLBACK TO SAVEPOINT statement;')
+                first_line = next(line for line in statement.split('\n') if line and not line.startswith('--'))
+                errors.append((first_line, str(e).strip().split('\n')[0]))
+            cur.execute('RELEASE SAVEPOINT statement;')
+    conn.commit()
+
+    return errors
+
+
+def load_pagila(conn, reload=False):
+    """
+    Description: This function loads the pagila 3NF schema and data of
+                 notebooks/Data into the public schema, unless it is loaded
+
+    Arguments:
+        conn: object of the connection to the database
+        reload: drop and load the public schema even if pagila is loaded
+
+    Returns:
+        errors: list of (statement, error message) of the skipped statements
+    """
+    with conn.cursor() as cur:
+        if reload:
+            cur.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+        cur.execute("SELECT to_regclass('public.payment');")
+        loaded = cur.fetchone()[0] is not None
+    conn.commit()
+    if loaded:
+        return []
+
+    errors = []
+    for file_name in pagila_files:
+        errors += run_sql_file(conn, os.path.join(data_dir, file_name))
+
+    return errors
+
+
+def build_star(conn, schema=star_schema):
+    """
+    Description: This function creates the star schema in its own schema and
+                 fills it from the 3NF tables of the public schema
+
+    Arguments:
+        conn: object of the connection to the database
+        schema: name of the star schema
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}, public;'.format(schema))
+        for query in star_table_creates + star_table_inserts:
+            cur.execute(query)
+        cur.execute("SELECT setval(pg_get_serial_sequence('factSales', 'sales_key'), MAX(sales_key)) FROM factSales;")
+    conn.commit()
+
+
+def scale_facts(conn, factor, schema=star_schema, seed=0.42):
+    """
+    Description: This function grows factSales to factor times the facts
+                 loaded from pagila by inserting random variations of them
+
+    Arguments:
+        conn: object of the connection to the database
+        factor: target size as a multiple of the pagila facts
+        schema: name of the star schema
+        seed: seed of random() for reproducible data
+
+    Returns:
+        number of rows of factSales
+    """
+    with conn.cursor() as cur:
+        cur.execute('SET search_path TO {}, public;'.format(schema))
+        cur.execute('SELECT MAX(sales_key) FROM factSales;')
+        base = cur.fetchone()[0]
+        if factor > 1:
+            cur.execute('SELECT setseed(%s);', (seed,))
+            cur.execute(sales_table_scale, (factor - 1, base))
+        cur.execute('ANALYZE;')
+        cur.execute('SELECT COUNT(*) FROM factSales;')
+        rows = cur.fetchone()[0]
+    conn.commit()
+
+    return rows
@@ -0,0 +1,379 @@
+import argparse
+import json
+import statistics
+from datetime import datetime, timezone
+from time import perf_counter
+import psycopg2
+from olap_benchmark import percentile, time_query, normalize
+from pagila_star import default_dsn, load_pagila, star_table_creates, star_table_inserts
+from pagila_pipeline import create_star, run_pipeline
+
+
+# every scale gets a 3NF schema with n copies of rental and payment (the other
+# tables are read from public) and a star schema loaded from it by the pipeline
+source_schema = 'pagila_3nf_x{}'
+target_schema = 'pagila_star_x{}'
+rebuild_schema = 'pagila_rebuild_x{}'
+
+# copy k of a rental or payment gets its id shifted by k times the highest id
+rental_table_scale = ("""CREATE TABLE rental AS
+                         SELECT r.rental_id + k * m.high AS rental_id, r.rental_date, r.inventory_id,
+                                r.customer_id, r.return_date, r.staff_id, r.last_update
+                         FROM public.rental r
+                         CROSS JOIN (SELECT MAX(rental_id) AS high FROM public.rental) AS m
+                         CROSS JOIN generate_series(0, %s) AS k;
+""")
+
+payment_table_scale = ("""CREATE TABLE payment AS
+                          SELECT p.payment_id + k * m.high AS payment_id, p.customer_id, p.staff_id,
+                                 p.rental_id + k * m.rental_high AS rental_id, p.amount, p.payment_date
+                          FROM public.payment p
+                          CROSS JOIN (SELECT MAX(payment_id) AS high,
+                                             (SELECT MAX(rental_id) FROM public.rental) AS rental_high
+                                      FROM public.payment) AS m
+                          CROSS JOIN generate_series(0, %s) AS k;
+""")
+
+# the keys and foreign key indexes of pagila
+scale_indexes = ['ALTER TABLE rental ADD PRIMARY KEY (rental_id);',
+                 'CREATE INDEX ON rental (inventory_id);',
+                 'ALTER TABLE payment ADD PRIMARY KEY (payment_id);',
+                 'CREATE INDEX ON payment (rental_id);',
+                 'CREATE INDEX ON payment (customer_id);']
+
+# the fact insert of L1 E1 - Step 5 without its DISTINCT, which drops the
+# payments of the same day, customer, movie, store and amount (all copies)
+sales_table_rebuild = ("""INSERT INTO factSales (date_key, customer_key, movie_key, store_key, sales_amount)
+                          SELECT TO_CHAR(payment_date :: DATE, 'yyyyMMDD')::integer AS date_key,
+                                 p.customer_id AS customer_key,
+                                 i.film_id     AS movie_key,
+                                 i.store_id    AS store_key,
+                                 p.amount      AS sales_amount
+                          FROM payment p
+                          JOIN rental r     ON r.rental_id = p.rental_id
+                          JOIN inventory i  ON i.inventory_id = r.inventory_id;
+""")
+
+# QUERIES
+# (name, 3NF query, star query), both return the same rows
+month_country_3nf = ("""SELECT EXTRACT(month FROM p.payment_date)::smallint AS month, co.country,
+                               sum(p.amount) AS revenue
+                        FROM payment p
+                        JOIN customer c ON c.customer_id = p.customer_id
+                        JOIN address a  ON a.address_id = c.address_id
+                        JOIN city ci    ON ci.city_id = a.city_id
+                        JOIN country co ON co.country_id = ci.country_id
+                        GROUP BY 1, 2;
+""")
+
+month_country_star = ("""SELECT d.month, c.country, sum(f.sales_amount) AS revenue
+                         FROM factSales f
+                         JOIN dimDate d     ON d.date_key = f.date_key
+                         JOIN dimCustomer c ON c.customer_key = f.customer_key
+                         GROUP BY 1, 2;
+""")
+
+title_month_city_3nf = ("""SELECT f.title, EXTRACT(month FROM p.payment_date)::smallint AS month, ci.city,
+                                  sum(p.amount) AS revenue
+                           FROM payment p
+                           JOIN rental r    ON r.rental_id = p.rental_id
+                           JOIN inventory i ON i.inventory_id = r.inventory_id
+                           JOIN film f      ON f.film_id = i.film_id
+                           JOIN customer c  ON c.customer_id = p.customer_id
+                           JOIN address a   ON a.address_id = c.address_id
+                           JOIN city ci     ON ci.city_id = a.city_id
+                           GROUP BY 1, 2, 3;
+""")
+
+title_month_city_star = ("""SELECT m.title, d.month, c.city, sum(f.sales_amount) AS revenue
+                            FROM factSales f
+                            JOIN dimMovie m    ON m.movie_key = f.movie_key
+                            JOIN dimDate d     ON d.date_key = f.date_key
+                            JOIN dimCustomer c ON c.customer_key = f.customer_key
+                            GROUP BY 1, 2, 3;
+""")
+
+rating_store_3nf = ("""SELECT f.rating, ci.city, sum(p.amount) AS revenue
+                       FROM payment p
+                       JOIN rental r    ON r.rental_id = p.rental_id
+                       JOIN inventory i ON i.inventory_id = r.inventory_id
+                       JOIN film f      ON f.film_id = i.film_id
+                       JOIN store s     ON s.store_id = i.store_id
+                       JOIN address a   ON a.address_id = s.address_id
+                       JOIN city ci     ON ci.city_id = a.city_id
+                       WHERE f.rating IN ('PG-13', 'PG')
+                       GROUP BY 1, 2;
+""")
+
+rating_store_star = ("""SELECT m.rating, s.city, sum(f.sales_amount) AS revenue
+                        FROM factSales f
+                        JOIN dimMovie m ON m.movie_key = f.movie_key
+                        JOIN dimStore s ON s.store_key = f.store_key
+                        WHERE m.rating IN ('PG-13', 'PG')
+                        GROUP BY 1, 2;
+""")
+
+weekend_3nf = ("""SELECT EXTRACT(ISODOW FROM p.payment_date) IN (6, 7) AS is_weekend, count(*) AS sales,
+                         sum(p.amount) AS revenue
+                  FROM payment p
+                  GROUP BY 1;
+""")
+
+weekend_star = ("""SELECT d.is_weekend, count(*) AS sales, sum(f.sales_amount) AS revenue
+                   FROM factSales f
+                   JOIN dimDate d ON d.date_key = f.date_key
+                   GROUP BY 1;
+""")
+
+top_customers_3nf = ("""SELECT c.customer_id, c.first_name, c.last_name, sum(p.amount) AS revenue
+                        FROM payment p
+                        JOIN customer c ON c.customer_id = p.customer_id
+                        GROUP BY 1, 2, 3
+                        ORDER BY revenue DESC, c.customer_id
+                        LIMIT 10;
+""")
+
+top_customers_star = ("""SELECT c.customer_id, c.first_name, c.last_name, sum(f.sales_amount) AS revenue
+                         FROM factSales f
+                         JOIN dimCustomer c ON c.customer_key = f.customer_key
+                         GROUP BY 1, 2, 3
+                         ORDER BY revenue DESC, c.customer_id
+                         LIMIT 10;
+""")
+
+queries = [('month_country', month_country_3nf, month_country_star),
+           ('title_month_city', title_month_city_3nf, title_month_city_star),
+           ('rating_store_city', rating_store_3nf, rating_store_star),
+           ('weekend', weekend_3nf, weekend_star),
+           ('top_customers', top_customers_3nf, top_customers_star)]
+
+
+def build_source(conn, scale, new_share):
+    """
+    Description: This function creates the 3NF schema of a scale. The newest
+                 payments are moved to payment_new, they are the later load.
+
+    Arguments:
+        conn: object of the connection to the database
+        scale: number of copies of rental and payment
+        new_share: share of the payments of the later load
+
+    Returns:
+        number of payments of the first load
+    """
+    schema = source_schema.format(scale)
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0}, public;'.format(schema))
+        cur.execute(rental_table_scale, (scale - 1,))
+        cur.execute(payment_table_scale, (scale - 1,))
+        for query in scale_indexes:
+            cur.execute(query)
+        cur.execute('SELECT percentile_disc(%s) WITHIN GROUP (ORDER BY payment_id) FROM payment;', (1 - new_share,))
+        cutoff = cur.fetchone()[0]
+        cur.execute('CREATE TABLE payment_new AS SELECT * FROM payment WHERE payment_id > %s;', (cutoff,))
+        cur.execute('DELETE FROM payment WHERE payment_id > %s;', (cutoff,))
+        cur.execute('ANALYZE rental; ANALYZE payment;')
+        cur.execute('SELECT COUNT(*) FROM payment;')
+        payments = cur.fetchone()[0]
+    conn.commit()
+
+    return payments
+
+
+def add_new_payments(conn, scale):
+    """
+    Description: This function adds the payments of the later load to the 3NF
+                 schema of a scale
+
+    Arguments:
+        conn: object of the connection to the database
+        scale: number of copies of rental and payment
+
+    Returns:
+        number of new payments
+    """
+    with conn.cursor() as cur:
+        cur.execute('SET search_path TO {}, public;'.format(source_schema.format(scale)))
+        cur.execute('INSERT INTO payment SELECT * FROM payment_new;')
+        rows = cur.rowcount
+        cur.execute('ANALYZE payment;')
+    conn.commit()
+
+    return rows
+
+
+def rebuild_star(conn, scale):
+    """
+    Description: This function builds the star schema of a scale again with
+                 the INSERT ... SELECT statements of L1 E1 - Step 5, the full
+                 rebuild the incremental load is compared with. It keeps
+                 every payment, like the pipeline.
+
+    Arguments:
+        conn: object of the connection to the database
+        scale: number of copies of rental and payment
+
+    Returns:
+        seconds
+    """
+    schema = rebuild_schema.format(scale)
+    t0 = perf_counter()
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};'.format(schema))
+        cur.execute('SET search_path TO {}, {}, public;'.format(schema, source_schema.format(scale)))
+        for query in star_table_creates + star_table_inserts[:-1] + [sales_table_rebuild]:
+            cur.execute(query)
+        cur.execute('ANALYZE factSales;')
+    conn.commit()
+    seconds = perf_counter() - t0
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA {} CASCADE;'.format(schema))
+    conn.commit()
+
+    return seconds
+
+
+def run_queries(conn, scale, repeat, warmup):
+    """
+    Description: This function runs every query on the 3NF schema and on the
+                 star schema of a scale and compares the results
+
+    Arguments:
+        conn: object of the connection to the database
+        scale: number of copies of rental and payment
+        repeat: number of timed runs of every query
+        warmup: number of untimed runs of every query
+
+    Returns:
+        list of dicts with the median and p95 latencies of both schemas, the
+        speedup of the star schema and if the results are the same
+    """
+    results = []
+    with conn.cursor() as cur:
+        for name, query_3nf, query_star in queries:
+            cur.execute('SET search_path TO {}, public;'.format(source_schema.format(scale)))
+            timings_3nf, rows_3nf = time_query(cur, query_3nf, repeat, warmup)
+            cur.execute('SET search_path TO {}, public;'.format(target_schema.format(scale)))
+            timings_star, rows_star = time_query(cur, query_star, repeat, warmup)
+            results.append({'scale': scale, 'query': name, 'rows': len(rows_star),
+                            '3nf_median_ms': statistics.median(timings_3nf), '3nf_p95_ms': percentile(timings_3nf, 95),
+                            'star_median_ms': statistics.median(timings_star),
+                            'star_p95_ms': percentile(timings_star, 95),
+                            'speedup': statistics.median(timings_3nf) / statistics.median(timings_star),
+                            'same_result': normalize(rows_3nf) == normalize(rows_star)})
+    conn.rollback()
+
+    return results
+
+
+def run_scale(conn, scale, new_share, batch_size, repeat, warmup):
+    """
+    Description: This function benchmarks one scale: the first load of the
+                 star schema by the pipeline, the later load by the pipeline
+                 against a full rebuild, and the queries on both schemas
+
+    Arguments:
+        conn: object of the connection to the database
+        scale: number of copies of rental and payment
+        new_share: share of the payments of the later load
+        batch_size: payments per batch of the pipeline
+        repeat: number of timed runs of every query
+        warmup: number of untimed runs of every query
+
+    Returns:
+        load: dict with the payments and seconds of the loads
+        queries: list of dicts returned by run_queries
+    """
+    payments = build_source(conn, scale, new_share)
+    create_star(conn, target_schema.format(scale))
+    first = run_pipeline(conn, target_schema.format(scale), source_schema.format(scale), batch_size)
+    new_payments = add_new_payments(conn, scale)
+    incremental = run_pipeline(conn, target_schema.format(scale), source_schema.format(scale), batch_size)
+    rebuild_seconds = rebuild_star(conn, scale)
+
+    load = {'scale': scale, 'payments': payments + new_payments, 'first_load_seconds': first['seconds'],
+            'new_payments': new_payments, 'incremental_seconds': incremental['seconds'],
+            'rebuild_seconds': rebuild_seconds,
+            'incremental_key_misses': sum(lookup['misses'] for lookup in incremental['lookups'].values())}
+
+    return load, run_queries(conn, scale, repeat, warmup)
+
+
+def print_report(report):
+    """
+    Description: This function prints the load times and query latencies of a report
+
+    Arguments:
+        report: dict written by main
+
+    Returns:
+        None
+    """
+    print('{:>6}{:>12}{:>12}{:>8}{:>14}{:>12}'.format('scale', 'payments', 'first load', 'new', 'incremental',
+                                                      'rebuild'))
+    for r in report['loads']:
+        print('{scale:>6}{payments:>12}{first_load_seconds:>11.2f}s{new_payments:>8}{incremental_seconds:>13.2f}s'
+              '{rebuild_seconds:>11.2f}s'.format(**r))
+    print()
+    print('{:>6}  {:<20}{:>8}{:>12}{:>12}{:>10}{:>7}'.format('scale', 'query', 'rows', '3NF ms', 'star ms',
+                                                           'speedup', 'same'))
+    for r in report['queries']:
+        print('{scale:>6}  {query:<20}{rows:>8}{3nf_median_ms:>12.2f}{star_median_ms:>12.2f}{speedup:>9.2f}x'
+              '{same_result!s:>7}'.format(**r))
+
+
+def main():
+    """
+    Description: This main function compares the queries on the 3NF schema of
+                 pagila with the same queries on its star schema, at several
+                 scales, and the incremental load of the star schema with a
+                 full rebuild, and writes the report as JSON
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark pagila queries on the 3NF schema against the star schema')
+    parser.add_argument('--dsn', default=default_dsn)
+    parser.add_argument('--scales', default='1,10,50', help='comma separated numbers of copies of the payments')
+    parser.add_argument('--new-share', type=float, default=0.1, help='share of the payments of the later load')
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='keep the schemas of the scales')
+    parser.add_argument('--output', default='star_benchmark.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    conn = psycopg2.connect(args.dsn)
+    loads, results = [], []
+    try:
+        for statement, error in load_pagila(conn):
+            print('skipped: {} ({})'.format(statement, error))
+        for scale in scales:
+            load, queries_of_scale = run_scale(conn, scale, args.new_share, args.batch_size, args.repeat, args.warmup)
+            loads.append(load)
+            results += queries_of_scale
+            if not args.keep:
+                with conn.cursor() as cur:
+                    cur.execute('DROP SCHEMA {} CASCADE; DROP SCHEMA {} CASCADE;'.format(
+                        source_schema.format(scale), target_schema.format(scale)))
+                conn.commit()
+    finally:
+        conn.close()
+
+    report = {'run': {'timestamp': datetime.now(timezone.utc).isoformat(), 'scales': scales,
+                      'new_share': args.new_share, 'repeat': args.repeat, 'warmup': args.warmup},
+              'loads': loads,
+              'queries': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print('report written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,579 @@
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from time import perf_counter
+import psycopg2
+from olap_benchmark import percentile, time_query
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+default_dsn = "host=127.0.0.1 port=5433 dbname=reviews user=student password=student"
+
+# the customer reviews of the L1 E3 notebook
+review_columns = [('customer_id', 'TEXT'), ('review_date', 'DATE'), ('review_rating', 'INTEGER'),
+                  ('review_votes', 'INTEGER'), ('review_helpful_votes', 'INTEGER'), ('product_id', 'CHAR(10)'),
+                  ('product_title', 'TEXT'), ('product_sales_rank', 'BIGINT'), ('product_group', 'TEXT'),
+                  ('product_category', 'TEXT'), ('product_subcategory', 'TEXT'),
+                  ('similar_product_ids', 'CHAR(10)[]')]
+
+# the benchmark keeps its own schema, tables and cstore_fdw server, so the
+# customer_reviews tables and the foreign tables of the notebook are not touched
+bench_schema = 'storage_bench'
+row_table = '{}.bench_reviews_row'.format(bench_schema)
+col_table = '{}.bench_reviews_col'.format(bench_schema)
+cstore_server = 'bench_cstore_server'
+
+product_groups = {'Book': ['Literature & Fiction', 'Science', 'Children', 'History'],
+                  'Music': ['Pop', 'Classical', 'Jazz', 'Rock'],
+                  'Video': ['Drama', 'Comedy', 'Documentary'],
+                  'DVD': ['Action & Adventure', 'Drama', 'Kids & Family'],
+                  'Toy': ['Games', 'Puzzles'],
+                  'Software': ['Business', 'Education']}
+
+# AGGREGATE QUERY SUITE
+# every query is described once and run as SQL on the tables and with pyarrow
+# on the Parquet file: where is a list of (column, operator, value), the
+# aggregates are (function, column) with function avg, sum or count (column None)
+queries = {
+    # the query of the notebook
+    'avg_rating_by_title_1995': {'where': [('review_date', '>=', date(1995, 1, 1)),
+                                           ('review_date', '<=', date(1995, 12, 31))],
+                                 'group_by': ['product_title'],
+                                 'aggregates': [('avg', 'review_rating')],
+                                 'order_by': [('avg_review_rating', 'descending'), ('product_title', 'ascending')],
+                                 'limit': 20},
+    'totals': {'where': [], 'group_by': [],
+               'aggregates': [('count', None), ('avg', 'review_rating'), ('sum', 'review_votes'),
+                              ('sum', 'review_helpful_votes')]},
+    'rating_by_group': {'where': [], 'group_by': ['product_group'],
+                        'aggregates': [('count', None), ('avg', 'review_rating')]},
+    'five_stars_by_category': {'where': [('review_rating', '=', 5)], 'group_by': ['product_group', 'product_category'],
+                               'aggregates': [('count', None), ('sum', 'review_helpful_votes')]},
+    'votes_by_rating_1999': {'where': [('review_date', '>=', date(1999, 1, 1))], 'group_by': ['review_rating'],
+                             'aggregates': [('sum', 'review_votes'), ('sum', 'review_helpful_votes')]},
+}
+
+arrow_functions = {'avg': 'mean', 'sum': 'sum', 'count': 'count_all'}
+
+
+def generate_reviews(num_rows, chunk_size=100000, seed=42):
+    """
+    Description: This function generates customer reviews in review_date
+                 order, like the yearly files of the notebook. The reviews per
+                 day grow over the years 1995 to 1999, the products are Zipf
+                 distributed.
+
+    Arguments:
+        num_rows: number of reviews
+        chunk_size: reviews per chunk
+        seed: seed of the random generator
+
+    Returns:
+        generator of lists of rows in review_columns order
+    """
+    rng = random.Random(seed)
+    start, days = date(1995, 1, 1), (date(1999, 12, 31) - date(1995, 1, 1)).days
+    num_products = max(num_rows // 20, 10)
+    groups = sorted(product_groups)
+    products = []
+    for k in range(num_products):
+        group = groups[k % len(groups)]
+        category = product_groups[group][k // len(groups) % len(product_groups[group])]
+        products.append(('{:010d}'.format(k), 'Product Title {}'.format(k), rng.randint(1, 2000000), group,
+                         category, '{} {}'.format(category, k % 7)))
+    cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, num_products + 1)))
+
+    chunk = []
+    for i in range(num_rows):
+        product_id, title, sales_rank, group, category, subcategory = rng.choices(products, cum_weights=cum_weights)[0]
+        votes = rng.choice([0, 0, 1, 2, rng.randint(0, 50)])
+        similar = ['{:010d}'.format(rng.randrange(num_products)) for _ in range(rng.randint(0, 5))]
+        chunk.append(('A{:013d}'.format(rng.randrange(num_rows)),
+                      start + timedelta(days=int(days * (i / num_rows) ** 0.5)),
+                      rng.choices([1, 2, 3, 4, 5], weights=[6, 5, 10, 24, 55])[0],
+                      votes, rng.randint(0, votes), product_id, title, sales_rank, group, category, subcategory,
+                      similar))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def find_columnar(conn, requested='auto', create_extension=False):
+    """
+    Description: This function finds the columnar storage of the server: the
+                 columnar access method of citus (or Hydra), else the cstore_fdw
+                 foreign data wrapper of the notebook, else the Parquet fallback.
+                 Only installed extensions are used, an available one is only
+                 created with create_extension.
+
+    Arguments:
+        conn: object of the connection to the database
+        requested: auto, columnar, cstore_fdw or parquet
+        create_extension: create an available extension that is not installed
+
+    Returns:
+        columnar, cstore_fdw or parquet
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT name FROM pg_available_extensions WHERE name IN ('citus_columnar', 'columnar', 'citus', "
+                    "'cstore_fdw');")
+        available = {row[0] for row in cur.fetchall()}
+        cur.execute("SELECT COUNT(*) FROM pg_am WHERE amname='columnar';")
+        has_access_method = cur.fetchone()[0] > 0
+        cur.execute("SELECT COUNT(*) FROM pg_extension WHERE extname='cstore_fdw';")
+        has_cstore_fdw = cur.fetchone()[0] > 0
+
+        if requested in ('auto', 'columnar') and not has_access_method and create_extension:
+            for extension in ('citus_columnar', 'columnar', 'citus'):
+                if extension in available:
+                    try:
+                        cur.execute('CREATE EXTENSION IF NOT EXISTS {};'.format(extension))
+                        conn.commit()
+                        has_access_method = True
+                        break
+                    except psycopg2.Error as e:
+                        conn.rollback()
+                        print('{} not usable: {}'.format(extension, str(e).strip()))
+        if requested in ('auto', 'cstore_fdw') and not has_cstore_fdw and create_extension \
+                and not (requested == 'auto' and has_access_method) and 'cstore_fdw' in available:
+            try:
+                cur.execute('CREATE EXTENSION IF NOT EXISTS cstore_fdw;')
+                conn.commit()
+                has_cstore_fdw = True
+            except psycopg2.Error as e:
+                conn.rollback()
+                print('cstore_fdw not usable: {}'.format(str(e).strip()))
+    if requested in ('auto', 'columnar') and has_access_method:
+        return 'columnar'
+    if requested in ('auto', 'cstore_fdw') and has_cstore_fdw:
+        return 'cstore_fdw'
+    if requested in ('columnar', 'cstore_fdw'):
+        raise SystemExit('{} is not installed on the server, --create-extension creates an available '
+                         'extension'.format(requested))
+    if pa is None:
+        raise SystemExit('no columnar storage on the server, the Parquet fallback needs the pyarrow package')
+
+    return 'parquet'
+
+
+def create_table(conn, name, storage):
+    """
+    Description: This function creates a reviews table with row (heap),
+                 columnar or cstore_fdw storage in the schema of the benchmark.
+                 The cstore_fdw table uses the server of the benchmark, which
+                 is created once and never dropped.
+
+    Arguments:
+        conn: object of the connection to the database
+        name: name of the table
+        storage: heap, columnar or cstore_fdw
+
+    Returns:
+        None
+    """
+    columns = ',\n'.join('    {} {}'.format(column, data_type) for column, data_type in review_columns)
+    with conn.cursor() as cur:
+        cur.execute('CREATE SCHEMA IF NOT EXISTS {};'.format(bench_schema))
+        cur.execute('DROP TABLE IF EXISTS {0}; DROP FOREIGN TABLE IF EXISTS {0};'.format(name))
+        if storage == 'cstore_fdw':
+            cur.execute('CREATE SERVER IF NOT EXISTS {} FOREIGN DATA WRAPPER cstore_fdw;'.format(cstore_server))
+            cur.execute("CREATE FOREIGN TABLE {} (\n{}\n) SERVER {} OPTIONS(compression 'pglz');".format(
+                name, columns, cstore_server))
+        else:
+            cur.execute('CREATE TABLE {} (\n{}\n) USING {};'.format(name, columns, storage))
+    conn.commit()
+
+
+def copy_chunk(cur, table, rows):
+    """
+    Description: This function loads a chunk of reviews with COPY FROM STDIN
+
+    Arguments:
+        cur: the cursor object
+        table: name of the table
+        rows: list of rows in review_columns order
+
+    Returns:
+        None
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row[:-1] + ('{' + ','.join(row[-1]) + '}',))
+    buffer.seek(0)
+    cur.copy_expert('COPY {} FROM STDIN WITH CSV'.format(table), buffer)
+
+
+def load_reviews(conn, num_rows, columnar, parquet_path, row_group_size):
+    """
+    Description: This function generates the reviews and loads them into the
+                 row table and into the columnar table or the Parquet file
+
+    Arguments:
+        conn: object of the connection to the database
+        num_rows: number of reviews
+        columnar: columnar, cstore_fdw or parquet
+        parquet_path: path of the Parquet file
+        row_group_size: rows per row group of the Parquet file
+
+    Returns:
+        dict of storage -> load seconds
+    """
+    create_table(conn, row_table, 'heap')
+    if columnar != 'parquet':
+        create_table(conn, col_table, columnar)
+
+    seconds = {'row': 0.0, columnar: 0.0}
+    writer = None
+    try:
+        with conn.cursor() as cur:
+            for chunk in generate_reviews(num_rows):
+                t0 = perf_counter()
+                copy_chunk(cur, row_table, chunk)
+                seconds['row'] += perf_counter() - t0
+
+                t0 = perf_counter()
+                if columnar == 'parquet':
+                    batch = pa.Table.from_pylist([dict(zip([c for c, _ in review_columns], row)) for row in chunk],
+                                                 schema=arrow_schema())
+                    if writer is None:
+                        writer = pq.ParquetWriter(parquet_path, batch.schema, compression='snappy')
+                    writer.write_table(batch, row_group_size=row_group_size)
+                else:
+                    copy_chunk(cur, col_table, chunk)
+                seconds[columnar] += perf_counter() - t0
+            cur.execute('ANALYZE {};'.format(row_table))
+        conn.commit()
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return seconds
+
+
+def arrow_schema():
+    """
+    Description: This function returns the Parquet schema of the reviews
+
+    Arguments:
+        None
+
+    Returns:
+        pyarrow schema
+    """
+    return pa.schema([('customer_id', pa.string()), ('review_date', pa.date32()), ('review_rating', pa.int32()),
+                      ('review_votes', pa.int32()), ('review_helpful_votes', pa.int32()),
+                      ('product_id', pa.string()), ('product_title', pa.string()),
+                      ('product_sales_rank', pa.int64()), ('product_group', pa.string()),
+                      ('product_category', pa.string()), ('product_subcategory', pa.string()),
+                      ('similar_product_ids', pa.list_(pa.string()))])
+
+
+def alias(function, column):
+    """
+    Description: This function names the result column of an aggregate
+
+    Arguments:
+        function: avg, sum or count
+        column: aggregated column, None for count
+
+    Returns:
+        name of the result column
+    """
+    return 'count_all' if column is None else '{}_{}'.format(function, column)
+
+
+def build_sql(query, table):
+    """
+    Description: This function builds the SQL of a query of the suite
+
+    Arguments:
+        query: dict of queries
+        table: name of the table
+
+    Returns:
+        SQL statement and its parameters
+    """
+    select = list(query['group_by']) + ['{}({}) AS {}'.format(f.upper(), c or '*', alias(f, c))
+                                        for f, c in query['aggregates']]
+    sql = 'SELECT {} FROM {}'.format(', '.join(select), table)
+    if query['where']:
+        sql += ' WHERE ' + ' AND '.join('{} {} %s'.format(c, op) for c, op, _ in query['where'])
+    if query['group_by']:
+        sql += ' GROUP BY ' + ', '.join(query['group_by'])
+    if query.get('order_by'):
+        sql += ' ORDER BY ' + ', '.join('{} {}'.format(c, 'DESC' if d == 'descending' else 'ASC')
+                                        for c, d in query['order_by'])
+    if query.get('limit'):
+        sql += ' LIMIT {}'.format(query['limit'])
+
+    return sql + ';', [value for _, _, value in query['where']]
+
+
+class CountingFile(io.RawIOBase):
+    """
+    Description: Binary file which counts the bytes read from it, so the
+                 bytes a Parquet query reads after pruning can be reported
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        num_bytes = self.file.readinto(buffer)
+        self.bytes_read += num_bytes
+        return num_bytes
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def run_parquet(query, parquet_path):
+    """
+    Description: This function runs a query of the suite on the Parquet file.
+                 Only the needed columns are read, row groups whose min/max
+                 statistics exclude the filter are skipped.
+
+    Arguments:
+        query: dict of queries
+        parquet_path: path of the Parquet file
+
+    Returns:
+        rows: list of result tuples
+        bytes_read: bytes read from the file
+    """
+    columns = sorted(set(query['group_by']) | {c for _, c in query['aggregates'] if c}
+                     | {c for c, _, _ in query['where']}) or ['review_rating']
+    source = CountingFile(parquet_path)
+    try:
+        table = pq.read_table(source, columns=columns,
+                              filters=[(c, '==' if op == '=' else op, v) for c, op, v in query['where']] or None)
+    finally:
+        source.close()
+
+    result = table.group_by(query['group_by']).aggregate(
+        [(c or [], arrow_functions[f]) for f, c in query['aggregates']])
+    # pyarrow names the aggregates <column>_<function>
+    names = {'{}_{}'.format(c, arrow_functions[f]): alias(f, c) for f, c in query['aggregates'] if c}
+    result = result.rename_columns([names.get(name, name) for name in result.column_names])
+    result = result.select(query['group_by'] + [alias(f, c) for f, c in query['aggregates']])
+    if query.get('order_by'):
+        result = result.sort_by(query['order_by'])
+    if query.get('limit'):
+        result = result.slice(0, query['limit'])
+
+    return [tuple(row.values()) for row in result.to_pylist()], source.bytes_read
+
+
+def bytes_read_postgres(cur, sql, block_size):
+    """
+    Description: This function runs a query with EXPLAIN (ANALYZE, BUFFERS)
+                 and returns the bytes of the blocks it read from the cache or disk
+
+    Arguments:
+        cur: the cursor object
+        sql: SQL statement
+        block_size: block size of the server in bytes
+
+    Returns:
+        bytes read, None if the plan reports no blocks (cstore_fdw reads its own files)
+    """
+    cur.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql)
+    plan = cur.fetchone()[0][0]['Plan']
+    blocks = plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0)
+
+    return blocks * block_size if blocks else None
+
+
+def storage_size(cur, storage, table, parquet_path):
+    """
+    Description: This function returns the bytes a table or the Parquet file occupies
+
+    Arguments:
+        cur: the cursor object
+        storage: row, columnar, cstore_fdw or parquet
+        table: name of the table
+        parquet_path: path of the Parquet file
+
+    Returns:
+        size in bytes
+    """
+    if storage == 'parquet':
+        return os.path.getsize(parquet_path)
+    if storage == 'cstore_fdw':
+        cur.execute("SELECT cstore_table_size('{}');".format(table))
+    else:
+        cur.execute("SELECT pg_total_relation_size('{}');".format(table))
+
+    return cur.fetchone()[0]
+
+
+def normalize(rows):
+    """
+    Description: This function brings result rows into a comparable form,
+                 numbers are rounded so averages of both storages compare equal
+
+    Arguments:
+        rows: result rows
+
+    Returns:
+        list of rows
+    """
+    return [tuple(round(float(v), 6) if isinstance(v, (int, float, Decimal)) else v for v in row) for row in rows]
+
+
+def run_suite(conn, columnar, parquet_path, repeat, warmup):
+    """
+    Description: This function runs every query of the suite on the row table
+                 and on the columnar storage, and checks that both answer the same
+
+    Arguments:
+        conn: object of the connection to the database
+        columnar: columnar, cstore_fdw or parquet
+        parquet_path: path of the Parquet file
+        repeat: number of timed runs of every query
+        warmup: number of untimed runs of every query
+
+    Returns:
+        list of dicts with the latency statistics and bytes read of every query and storage
+    """
+    results = []
+    with conn.cursor() as cur:
+        cur.execute('SHOW block_size;')
+        block_size = int(cur.fetchone()[0])
+        for name, query in queries.items():
+            answers = {}
+            for storage in ['row', columnar]:
+                if storage == 'parquet':
+                    for _ in range(warmup):
+                        run_parquet(query, parquet_path)
+                    timings = []
+                    for _ in range(repeat):
+                        t0 = perf_counter()
+                        rows, bytes_read = run_parquet(query, parquet_path)
+                        timings.append((perf_counter() - t0) * 1000)
+                else:
+                    sql, params = build_sql(query, row_table if storage == 'row' else col_table)
+                    sql = cur.mogrify(sql, params).decode()
+                    timings, rows = time_query(cur, sql, repeat, warmup)
+                    bytes_read = bytes_read_postgres(cur, sql, block_size)
+                answers[storage] = normalize(rows)
+                results.append({'query': name, 'storage': storage, 'runs': repeat, 'rows': len(rows),
+                                'median_ms': statistics.median(timings), 'p95_ms': percentile(timings, 95),
+                                'bytes_read': bytes_read})
+            ordered = query.get('order_by')
+            results[-1]['same_result'] = answers['row'] == answers[columnar] if ordered \
+                else sorted(answers['row'], key=str) == sorted(answers[columnar], key=str)
+    conn.rollback()
+
+    return results
+
+
+def print_report(report):
+    """
+    Description: This function prints the storage sizes and the query latencies of a report
+
+    Arguments:
+        report: dict written by main
+
+    Returns:
+        None
+    """
+    print('reviews: {}'.format(report['run']['rows']))
+    print('{:<12}{:>14}{:>12}'.format('storage', 'size MB', 'load s'))
+    for storage, s in report['storage'].items():
+        print('{:<12}{:>14.1f}{:>12.2f}'.format(storage, s['bytes'] / 1e6, s['load_seconds']))
+    print('{:<28}{:<12}{:>8}{:>12}{:>12}{:>14}{:>6}'.format('query', 'storage', 'rows', 'median ms', 'p95 ms',
+                                                             'MB read', 'same'))
+    for r in report['queries']:
+        print('{:<28}{:<12}{:>8}{:>12.2f}{:>12.2f}{:>14}{:>6}'.format(
+            r['query'], r['storage'], r['rows'], r['median_ms'], r['p95_ms'],
+            '-' if r['bytes_read'] is None else '{:.1f}'.format(r['bytes_read'] / 1e6),
+            str(r['same_result']) if 'same_result' in r else ''))
+
+
+def main():
+    """
+    Description: This main function generates the reviews, loads them into
+                 the row table and the columnar storage, runs the aggregate
+                 query suite and writes the report as JSON
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark row against columnar storage as in the L1 E3 notebook')
+    parser.add_argument('--dsn', default=default_dsn)
+    parser.add_argument('--rows', type=int, default=1000000, help='number of synthetic reviews')
+    parser.add_argument('--columnar', choices=['auto', 'columnar', 'cstore_fdw', 'parquet'], default='auto',
+                        help='columnar storage (default: the columnar access method, cstore_fdw, else Parquet)')
+    parser.add_argument('--create-extension', action='store_true',
+                        help='create an available columnar extension that is not installed yet')
+    parser.add_argument('--parquet-path', default='bench_reviews.parquet')
+    parser.add_argument('--row-group-size', type=int, default=150000,
+                        help='rows per Parquet row group (the stripe size of cstore_fdw)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--output', default='storage_benchmark.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        columnar = find_columnar(conn, args.columnar, args.create_extension)
+        print('columnar storage: {}'.format(columnar))
+        load_seconds = load_reviews(conn, args.rows, columnar, args.parquet_path, args.row_group_size)
+
+        with conn.cursor() as cur:
+            cur.execute('SHOW server_version;')
+            server_version = cur.fetchone()[0]
+            storage = {s: {'bytes': storage_size(cur, s, row_table if s == 'row' else col_table, args.parquet_path),
+                           'load_seconds': load_seconds[s]} for s in ['row', columnar]}
+        conn.rollback()
+        results = run_suite(conn, columnar, args.parquet_path, args.repeat, args.warmup)
+    finally:
+        conn.close()
+
+    report = {'run': {'timestamp': datetime.now(timezone.utc).isoformat(), 'server_version': server_version,
+                      'rows': args.rows, 'columnar': columnar, 'repeat': args.repeat, 'warmup': args.warmup},
+              'storage': storage,
+              'queries': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_report(report)
+    print('report written to {}'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+from psycopg2.pool import ThreadedConnectionPool
+from tools import get_dsn, print_status
+
+
+class StatementFailed(Exception):
+    """
+    Description: Raised when a statement of run_statements fails. The other
+                 statements have been cancelled, the timeline shows what ran.
+    """
+
+    def __init__(self, name, error, timeline):
+        super().__init__('{} failed: {}'.format(name, error))
+        self.name = name
+        self.error = error
+        self.timeline = timeline
+
+
+def check_dependencies(statements, dependencies):
+    """
+    Description: This function checks that every dependency names a statement
+                 and that the dependencies contain no cycle
+
+    Arguments:
+        statements: dict of name -> SQL statement
+        dependencies: dict of name -> list of names that must finish first
+
+    Returns:
+        None
+    """
+    for name, deps in dependencies.items():
+        unknown = set(deps) - set(statements)
+        if unknown:
+            raise ValueError('{} depends on unknown statements {}'.format(name, sorted(unknown)))
+
+    done = set()
+    while len(done) < len(statements):
+        ready = {n for n in statements if n not in done and set(dependencies.get(n, [])) <= done}
+        if not ready:
+            raise ValueError('cyclic dependencies between {}'.format(sorted(set(statements) - done)))
+        done |= ready
+
+
+def run_statements(config, statements, dependencies, pool_size=4, completed=(), on_commit=None):
+    """
+    Description: This function runs SQL statements concurrently on a small
+                 connection pool. A statement starts as soon as all statements
+                 it depends on have committed. If one statement fails, the
+                 statements not started yet are skipped, the running ones are
+                 cancelled and rolled back, and StatementFailed is raised.
+
+    Arguments:
+        config: the ConfigParser object
+        statements: dict of name -> SQL statement, or function (cur) returning
+                    the number of rows for statements built at run time
+        dependencies: dict of name -> list of names that must finish first
+        pool_size: number of connections and concurrent statements
+        completed: names of statements that already ran (eg. in a resumed run),
+                   they are not run again
+        on_commit: function (cur, name, seconds, rows) called after a statement
+                   in its transaction, before the commit
+
+    Returns:
+        timeline: list of dicts with name, start, end, seconds (relative to the
+                  start of the run), thread and status of every statement
+    """
+    check_dependencies(statements, dependencies)
+
+    pool = ThreadedConnectionPool(1, pool_size, get_dsn(config))
+    running_conns = {}
+    lock = threading.Lock()
+    failed = threading.Event()
+    timeline = []
+    t0 = perf_counter()
+
+    def execute(name):
+        conn = pool.getconn()
+        entry = {'name': name, 'thread': threading.current_thread().name}
+        with lock:
+            running_conns[name] = conn
+        try:
+            entry['start'] = perf_counter() - t0
+            with conn.cursor() as cur:
+                if callable(statements[name]):
+                    rows = statements[name](cur)
+                else:
+                    cur.execute(statements[name])
+                    rows = cur.rowcount
+                if on_commit is not None:
+                    on_commit(cur, name, perf_counter() - t0 - entry['start'], rows)
+            conn.commit()
+            entry['status'] = 'done'
+        except Exception:
+            conn.rollback()
+            entry['status'] = 'cancelled' if failed.is_set() else 'failed'
+            raise
+        finally:
+            entry['end'] = perf_counter() - t0
+            entry['seconds'] = entry['end'] - entry['start']
+            with lock:
+                running_conns.pop(name)
+                timeline.append(entry)
+            pool.putconn(conn)
+
+    done, pending, error = set(completed), {}, None
+    try:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            while len(done) < len(statements) and error is None:
+                for name in statements:
+                    if name not in done and name not in pending.values() \
+                            and set(dependencies.get(name, [])) <= done:
+                        pending[executor.submit(execute, name)] = name
+                        print_status('parallel_executor', '{} started'.format(name))
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = pending.pop(future)
+                    if future.exception() is not None and error is None:
+                        error = (name, future.exception())
+                        failed.set()
+                    elif future.exception() is None:
+                        done.add(name)
+                        print_status('parallel_executor', '{} done'.format(name))
+
+            if error is not None:
+                with lock:
+                    for conn in running_conns.values():
+                        conn.cancel()
+                wait(pending)
+    finally:
+        pool.closeall()
+
+    for name in statements:
+        if name in completed:
+            timeline.append({'name': name, 'thread': None, 'start': None, 'end': None,
+                             'seconds': None, 'status': 'completed'})
+        elif name not in done and all(entry['name'] != name for entry in timeline):
+            timeline.append({'name': name, 'thread': None, 'start': None, 'end': None,
+                             'seconds': None, 'status': 'skipped'})
+
+    if error is not None:
+        raise StatementFailed(error[0], error[1], timeline)
+
+    return timeline
+
+
+def print_timeline(timeline):
+    """
+    Description: This function prints the timeline of run_statements
+
+    Arguments:
+        timeline: list of dicts returned by run_statements
+
+    Returns:
+        None
+    """
+    print('{:<18}{:<10}{:>10}{:>10}{:>10}  {}'.format('statement', 'status', 'start', 'end', 'seconds', 'thread'))
+    for entry in sorted(timeline, key=lambda e: (e['start'] is None, e['start'])):
+        if entry['start'] is None:
+            print('{:<18}{:<10}'.format(entry['name'], entry['status']))
+        else:
+            print('{name:<18}{status:<10}{start:>10.2f}{end:>10.2f}{seconds:>10.2f}  {thread}'.format(**entry))
@@ -0,0 +1,446 @@
+import argparse
+import hashlib
+import os
+import pickle
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from time import perf_counter
+from sql_queries import (table_versions_lock, table_version_insert, table_version_bump, table_versions_select,
+                         current_schema_select)
+from tools import read_config, get_connection, get_dsn, print_status
+
+
+def qualify_tables(cur, tables):
+    """
+    Description: This function qualifies table names with their schema, the
+                 unqualified ones with current_schema(), so that the tables
+                 of the same name in different schemas get their own stamps
+
+    Arguments:
+        cur: the cursor object
+        tables: table names, with or without schema
+
+    Returns:
+        sorted list of schema.table names
+    """
+    cur.execute(current_schema_select)
+    schema = cur.fetchone()[0]
+
+    return sorted({table if '.' in table else '{}.{}'.format(schema, table) for table in tables})
+
+
+def bump_table_versions(conn, tables):
+    """
+    Description: This function moves the version stamps of tables, so that
+                 cached results of queries on them are not used anymore. It
+                 is called after a load step has committed, in a short
+                 transaction of its own which locks table_versions first:
+                 concurrent bumps wait for each other instead of aborting
+                 with a serialization conflict (error 1023 on Redshift), and
+                 the load transactions do not write the shared rows at all.
+                 table_versions is created by create_tables.py.
+
+    Arguments:
+        conn: object of the connection to the database, without an open transaction
+        tables: names of the changed tables, unqualified ones are in current_schema()
+
+    Returns:
+        None
+    """
+    if not tables:
+        return
+
+    now = datetime.utcnow()
+    with conn.cursor() as cur:
+        cur.execute(table_versions_lock)
+        for table in qualify_tables(cur, tables):
+            cur.execute(table_version_insert, (table, now, table))
+            cur.execute(table_version_bump, (now, table))
+    conn.commit()
+
+
+def split_quoted(sql):
+    """
+    Description: This function splits SQL into the parts outside and inside
+                 of quoted strings and identifiers
+
+    Arguments:
+        sql: SQL statement
+
+    Returns:
+        list of parts, every second part is quoted
+    """
+    return re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", sql)
+
+
+def normalize_sql(sql):
+    """
+    Description: This function normalizes a query for the cache key: comments
+                 are removed, whitespace is collapsed and the text outside of
+                 quotes is lower-cased, so that differently formatted copies
+                 of a query share their cached result
+
+    Arguments:
+        sql: SQL query
+
+    Returns:
+        the normalized query
+    """
+    parts = split_quoted(sql)
+    for i in range(0, len(parts), 2):
+        part = re.sub(r'/\*.*?\*/', ' ', re.sub(r'--[^\n]*', ' ', parts[i]), flags=re.S)
+        part = re.sub(r'\s*([,()=])\s*', r'\1', re.sub(r'\s+', ' ', part))
+        parts[i] = part.lower()
+
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def referenced_tables(sql):
+    """
+    Description: This function finds the tables a normalized query reads:
+                 the names in FROM lists and after JOIN with their schema if
+                 they have one, except the names of common table expressions. FROM inside
+                 EXTRACT, SUBSTRING and TRIM is skipped. A function in the
+                 FROM list is returned as a name too, which has no version
+                 stamp, so the query is not cached.
+
+    Arguments:
+        sql: query returned by normalize_sql
+
+    Returns:
+        sorted list of table names
+    """
+    parts = split_quoted(sql)
+    # string literals are blanked, quoted identifiers keep their name
+    text = ''.join(part if i % 2 == 0 else ("''" if part.startswith("'") else part[1:-1])
+                   for i, part in enumerate(parts))
+    text = re.sub(r'\b(extract|substring|trim|overlay|position)\([^()]*\)', ' ', text)
+    name = r'[^\s,()]+'
+    names = re.findall(r'\bjoin ?({})'.format(name), text)
+    for from_list in re.findall(r'\bfrom ?(.*?)(?=\b(?:where|group|order|limit|having|union|except|intersect|'
+                                r'join|left|right|inner|full|cross|natural|on)\b|[()]|$)', text):
+        names += [item.split()[0] for item in from_list.split(',') if item.strip()]
+    ctes = set(re.findall(r'(?:\bwith(?: recursive)?|,) ?([^\s,()]+) as ?\(', text))
+
+    return sorted(set(names) - ctes)
+
+
+class QueryCache:
+    """
+    Description: Caches the result sets of warehouse queries. An entry is keyed
+                 on the normalized query, its parameters and the version stamps
+                 of the tables it reads, so a load bumping a version makes the
+                 entry unreachable and the query runs again. The entries are
+                 kept in memory up to max_bytes, the least recently used ones
+                 are spilled to files in spill_dir up to spill_max_bytes and
+                 evicted from there. Queries on tables without a version stamp
+                 are not cached.
+    """
+
+    def __init__(self, conn, max_bytes=256 * 1024 * 1024, spill_dir=None, spill_max_bytes=2 * 1024 * 1024 * 1024):
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.database = conn.dsn
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.spilled = OrderedDict()
+        self.spilled_bytes = 0
+        self.latest = {}
+        self.metrics = {'hits_memory': 0, 'hits_spill': 0, 'misses': 0, 'uncacheable': 0, 'evictions': 0,
+                        'spills': 0, 'query_seconds': 0.0, 'saved_seconds': 0.0}
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            paths = [os.path.join(spill_dir, name) for name in os.listdir(spill_dir) if name.endswith('.pickle')]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.spilled[os.path.basename(path)[:-len('.pickle')]] = os.path.getsize(path)
+                self.spilled_bytes += os.path.getsize(path)
+
+    def table_versions(self, tables):
+        """
+        Description: This method reads the version stamps of tables, the
+                     unqualified ones in the current schema of the connection
+
+        Arguments:
+            tables: list of table names
+
+        Returns:
+            dict of schema.table -> version, None if a table has no stamp
+        """
+        with self.conn.cursor() as cur:
+            tables = qualify_tables(cur, tables)
+            cur.execute(table_versions_select, (tuple(tables),))
+            versions = dict(cur.fetchall())
+        self.conn.rollback()
+
+        return versions if len(versions) == len(tables) else None
+
+    def query(self, sql, params=None, tables=None):
+        """
+        Description: This method returns the rows of a query, from the cache
+                     if the tables it reads have not changed since it was cached
+
+        Arguments:
+            sql: SQL query
+            params: parameters of the query
+            tables: tables the query reads (default: found in the query)
+
+        Returns:
+            list of rows
+        """
+        t0 = perf_counter()
+        normalized = normalize_sql(sql)
+        tables = sorted(tables) if tables else referenced_tables(normalized)
+        versions = self.table_versions(tables) if tables else None
+        if versions is None:
+            rows, _ = self.execute(sql, params)
+            with self.lock:
+                self.metrics['uncacheable'] += 1
+            return rows
+
+        query_key = hashlib.sha1(repr((self.database, normalized, params)).encode()).hexdigest()
+        key = hashlib.sha1(repr((query_key, sorted(versions.items()))).encode()).hexdigest()
+        entry = self.get(key)
+        if entry is not None:
+            with self.lock:
+                self.latest[query_key] = key
+                self.metrics['saved_seconds'] += max(entry['seconds'] - (perf_counter() - t0), 0)
+            return entry['rows']
+
+        rows, seconds = self.execute(sql, params)
+        with self.lock:
+            self.metrics['misses'] += 1
+            stale = self.latest.get(query_key)
+            self.latest[query_key] = key
+            if stale is not None and stale != key:
+                self.discard(stale)
+            self.put(key, {'rows': rows, 'seconds': seconds})
+
+        return rows
+
+    def execute(self, sql, params):
+        """
+        Description: This method runs a query on the warehouse
+
+        Arguments:
+            sql: SQL query
+            params: parameters of the query
+
+        Returns:
+            rows: list of rows
+            seconds: duration of the query
+        """
+        t0 = perf_counter()
+        with self.conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+        self.conn.rollback()
+        seconds = perf_counter() - t0
+        with self.lock:
+            self.metrics['query_seconds'] += seconds
+
+        return rows, seconds
+
+    def get(self, key):
+        """
+        Description: This method looks up an entry in memory, then in the
+                     spill files. A spilled entry is moved back to memory.
+
+        Arguments:
+            key: cache key
+
+        Returns:
+            the entry, None if it is not cached
+        """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.metrics['hits_memory'] += 1
+                return self.memory[key][0]
+            if key not in self.spilled:
+                return None
+
+            path = os.path.join(self.spill_dir, key + '.pickle')
+            self.spilled_bytes -= self.spilled.pop(key)
+            try:
+                with open(path, 'rb') as f:
+                    entry = pickle.load(f)
+                os.remove(path)
+            except FileNotFoundError:
+                return None
+            self.metrics['hits_spill'] += 1
+            self.put(key, entry)
+
+            return entry
+
+    def put(self, key, entry):
+        """
+        Description: This method stores an entry in memory and spills the least
+                     recently used entries while the memory is over max_bytes.
+                     The caller holds the lock.
+
+        Arguments:
+            key: cache key
+            entry: dict with the rows and the seconds the query took
+
+        Returns:
+            None
+        """
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[1]
+        self.memory[key] = (entry, len(data))
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_bytes and self.memory:
+            old_key, (old_entry, size) = self.memory.popitem(last=False)
+            self.memory_bytes -= size
+            self.spill(old_key, data if old_key == key else pickle.dumps(old_entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def spill(self, key, data):
+        """
+        Description: This method writes an entry evicted from memory to the
+                     spill directory and evicts the least recently spilled
+                     entries while it is over spill_max_bytes. Without a spill
+                     directory the entry is dropped. The caller holds the lock.
+
+        Arguments:
+            key: cache key
+            data: pickled entry
+
+        Returns:
+            None
+        """
+        self.metrics['evictions'] += 1
+        if not self.spill_dir or len(data) > self.spill_max_bytes:
+            return
+
+        with open(os.path.join(self.spill_dir, key + '.pickle'), 'wb') as f:
+            f.write(data)
+        self.spilled[key] = len(data)
+        self.spilled_bytes += len(data)
+        self.metrics['spills'] += 1
+        while self.spilled_bytes > self.spill_max_bytes:
+            old_key, size = self.spilled.popitem(last=False)
+            self.spilled_bytes -= size
+            os.remove(os.path.join(self.spill_dir, old_key + '.pickle'))
+
+    def discard(self, key):
+        """
+        Description: This method removes the entry of an older version of a
+                     query from memory or the spill directory. The caller
+                     holds the lock.
+
+        Arguments:
+            key: cache key
+
+        Returns:
+            None
+        """
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[1]
+        elif key in self.spilled:
+            self.spilled_bytes -= self.spilled.pop(key)
+            os.remove(os.path.join(self.spill_dir, key + '.pickle'))
+
+    def stats(self):
+        """
+        Description: This method returns the metrics of the cache
+
+        Arguments:
+            None
+
+        Returns:
+            dict with hits (from memory and spill files), misses, uncached
+            queries, evictions, spills, hit ratio, seconds spent in queries and
+            seconds saved by hits, and the entries and bytes of both tiers
+        """
+        with self.lock:
+            stats = dict(self.metrics)
+            stats.update({'memory_entries': len(self.memory), 'memory_bytes': self.memory_bytes,
+                          'spill_entries': len(self.spilled), 'spill_bytes': self.spilled_bytes})
+        lookups = stats['hits_memory'] + stats['hits_spill'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits_memory'] + stats['hits_spill']) / lookups if lookups else 0.0
+
+        return stats
+
+
+def open_cache(config):
+    """
+    Description: This function opens a connection to the warehouse and a
+                 query cache configured in the CACHE section of dwh.cfg
+
+    Arguments:
+        config: the ConfigParser object
+
+    Returns:
+        QueryCache object
+    """
+    return QueryCache(get_connection(config),
+                      max_bytes=int(config.getfloat('CACHE', 'MAX_MB', fallback=256) * 1024 * 1024),
+                      spill_dir=config.get('CACHE', 'SPILL_DIR', fallback='') or None,
+                      spill_max_bytes=int(config.getfloat('CACHE', 'SPILL_MAX_MB', fallback=2048) * 1024 * 1024))
+
+
+def print_stats(stats):
+    """
+    Description: This function prints the metrics of a cache
+
+    Arguments:
+        stats: dict returned by QueryCache.stats
+
+    Returns:
+        None
+    """
+    print('hits: {} from memory, {} from spill files, misses: {}, not cacheable: {}, hit ratio: {:.1%}'.format(
+        stats['hits_memory'], stats['hits_spill'], stats['misses'], stats['uncacheable'], stats['hit_ratio']))
+    print('query time: {:.2f}s, saved by hits: {:.2f}s'.format(stats['query_seconds'], stats['saved_seconds']))
+    print('memory: {} entries, {:.1f} MB, spill files: {} entries, {:.1f} MB, evicted: {}, spilled: {}'.format(
+        stats['memory_entries'], stats['memory_bytes'] / 1e6, stats['spill_entries'], stats['spill_bytes'] / 1e6,
+        stats['evictions'], stats['spills']))
+
+
+def main():
+    """
+    Description: This main function runs queries through the cache several
+                 times (by default the workload of table_design_advisor.py)
+                 and prints their latencies and the cache metrics
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Run warehouse queries through the result cache')
+    parser.add_argument('sql', nargs='*', help='queries to run (default: the workload of table_design_advisor.py)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every query')
+    args = parser.parse_args()
+
+    if args.sql:
+        queries = {'query_{}'.format(i): sql for i, sql in enumerate(args.sql, 1)}
+    else:
+        from table_design_advisor import workload
+        queries = {q['name']: q['sql'] for q in workload}
+
+    config = read_config('dwh.cfg')
+    cache = open_cache(config)
+    print_status('query_cache', 'caching results of {}'.format(get_dsn(config).split(' password=')[0]))
+    try:
+        print('{:<22}{:>6}{:>12}{:>8}'.format('query', 'run', 'ms', 'rows'))
+        for run in range(1, args.repeat + 1):
+            for name, sql in queries.items():
+                t0 = perf_counter()
+                rows = cache.query(sql)
+                print('{:<22}{:>6}{:>12.2f}{:>8}'.format(name, run, (perf_counter() - t0) * 1000, len(rows)))
+    finally:
+        cache.conn.close()
+    print_stats(cache.stats())
+
+
+if __name__ == "__main__":
+    main()
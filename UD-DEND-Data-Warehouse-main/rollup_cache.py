@@ -0,0 +1,407 @@
+import argparse
+import itertools
+from datetime import datetime
+import psycopg2
+from query_cache import bump_table_versions
+from tools import read_config, get_connection, print_status
+
+
+# Every cube is rolled up into one aggregate table per subset of its dimensions
+# (the cube lattice). The dimensions come from inner joins on NOT NULL columns,
+# so cells can be matched with =. The measures are additive, every aggregate
+# can be summed up again. New facts are found by delta_column, which grows
+# with every load (the serial sales_key, the IDENTITY songplay_id; start_time
+# is truncated to whole seconds and misses facts in the second of the last
+# refresh).
+cubes = {
+    'sales': {
+        'fact': 'factSales',
+        'delta_column': 'sales_key',
+        'joins': ['JOIN dimDate d ON f.date_key = d.date_key',
+                  'JOIN dimStore s ON f.store_key = s.store_key',
+                  'JOIN dimMovie m ON f.movie_key = m.movie_key'],
+        'dimensions': {'year': 'd.year', 'month': 'd.month', 'country': 's.country', 'city': 's.city',
+                       'rating': 'm.rating'},
+        'measures': {'revenue': 'SUM(f.sales_amount)', 'sales': 'COUNT(*)'},
+    },
+    'songplays': {
+        'fact': 'fact_songplays',
+        'delta_column': 'songplay_id',
+        'joins': ['JOIN dim_time t ON f.start_time = t.start_time'],
+        'dimensions': {'year': 't.year', 'month': 't.month', 'weekday': 't.weekday', 'hour': 't.hour',
+                       'level': 'f.level'},
+        'measures': {'plays': 'COUNT(*)'},
+    },
+}
+
+rollup_catalog_create = ("""CREATE TABLE IF NOT EXISTS rollup_catalog (
+                            cube           VARCHAR(32)    NOT NULL,
+                            cuboid         VARCHAR(256)   NOT NULL,
+                            cells          BIGINT         NOT NULL,
+                            high_value     VARCHAR(64),
+                            refreshed_at   TIMESTAMP      NOT NULL,
+                            PRIMARY KEY (cube, cuboid)
+                            );
+""")
+
+
+def lattice(name):
+    """
+    Description: This function lists the cuboids of a cube, every subset of
+                 its dimensions in the order of the cube definition, finest first
+
+    Arguments:
+        name: name of the cube
+
+    Returns:
+        list of tuples of dimension names
+    """
+    dims = list(cubes[name]['dimensions'])
+
+    return [c for n in range(len(dims), -1, -1) for c in itertools.combinations(dims, n)]
+
+
+def table_name(name, cuboid):
+    """
+    Description: This function returns the name of the aggregate table of a cuboid
+
+    Arguments:
+        name: name of the cube
+        cuboid: tuple of dimension names
+
+    Returns:
+        name of the table, eg. rollup_sales_month_country or rollup_sales_all
+    """
+    return 'rollup_{}_{}'.format(name, '_'.join(cuboid) if cuboid else 'all')
+
+
+def rollup_select(name, source, cuboid, conditions=None):
+    """
+    Description: This function builds the query that rolls an aggregate table
+                 (or its delta) up to a coarser cuboid
+
+    Arguments:
+        name: name of the cube
+        source: table holding a finer cuboid
+        cuboid: tuple of dimension names of the result
+        conditions: list of WHERE conditions on the dimensions of source
+
+    Returns:
+        SELECT statement
+    """
+    measures = ', '.join('SUM({0}) AS {0}'.format(m) for m in cubes[name]['measures'])
+    sql = 'SELECT {} FROM {}'.format(', '.join(list(cuboid) + [measures]), source)
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if cuboid:
+        sql += ' GROUP BY {}'.format(', '.join(cuboid))
+
+    return sql
+
+
+def fact_select(name, cuboid, filters=None, lower=None, upper=None):
+    """
+    Description: This function builds the aggregation of a cube over the raw
+                 fact table, optionally restricted to the facts with
+                 lower < delta_column <= upper
+
+    Arguments:
+        name: name of the cube
+        cuboid: tuple of dimension names to group by
+        filters: dict of dimension -> value or tuple of values
+        lower: exclusive lower bound of delta_column
+        upper: inclusive upper bound of delta_column
+
+    Returns:
+        SELECT statement with %s placeholders
+        params: list of parameters
+    """
+    cube = cubes[name]
+    dims = cube['dimensions']
+    columns = ['{} AS {}'.format(dims[d], d) for d in cuboid]
+    columns += ['{} AS {}'.format(expression, m) for m, expression in cube['measures'].items()]
+
+    conditions, params = [], []
+    for dim, value in (filters or {}).items():
+        conditions.append('{} {} %s'.format(dims[dim], 'IN' if isinstance(value, tuple) else '='))
+        params.append(value)
+    if lower is not None:
+        conditions.append('f.{} > %s'.format(cube['delta_column']))
+        params.append(lower)
+    if upper is not None:
+        conditions.append('f.{} <= %s'.format(cube['delta_column']))
+        params.append(upper)
+
+    sql = 'SELECT {} FROM {} f {}'.format(', '.join(columns), cube['fact'], ' '.join(cube['joins']))
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if cuboid:
+        sql += ' GROUP BY {}'.format(', '.join(dims[d] for d in cuboid))
+
+    return sql, params
+
+
+def get_high_value(cur, name):
+    """
+    Description: This function returns the highest delta_column value of the facts
+
+    Arguments:
+        cur: the cursor object
+        name: name of the cube
+
+    Returns:
+        the value as text, None if the fact table is empty
+    """
+    cube = cubes[name]
+    cur.execute('SELECT CAST(MAX({}) AS VARCHAR) FROM {};'.format(cube['delta_column'], cube['fact']))
+
+    return cur.fetchone()[0]
+
+
+def smallest_parent(cuboid, built):
+    """
+    Description: This function picks the smallest already computed cuboid
+                 which contains all dimensions of cuboid
+
+    Arguments:
+        cuboid: tuple of dimension names
+        built: dict of cuboid -> (table, rows)
+
+    Returns:
+        (table, rows) of the parent
+    """
+    parents = [built[c] for c in built if set(cuboid) < set(c)]
+
+    return min(parents, key=lambda parent: parent[1])
+
+
+def build_cube(conn, name):
+    """
+    Description: This function computes the whole lattice of a cube. Only the
+                 finest cuboid scans the fact table, every other cuboid is
+                 rolled up from the smallest cuboid computed before it.
+
+    Arguments:
+        conn: object of the connection to the database
+        name: name of the cube
+
+    Returns:
+        dict of cuboid -> (table, rows)
+    """
+    cuboids = lattice(name)
+    built = {}
+    with conn.cursor() as cur:
+        cur.execute(rollup_catalog_create)
+        cur.execute('DELETE FROM rollup_catalog WHERE cube=%s;', (name,))
+        high_value = get_high_value(cur, name)
+
+        for cuboid in cuboids:
+            table = table_name(name, cuboid)
+            if not built:
+                select, params = fact_select(name, cuboid, upper=high_value)
+            else:
+                select, params = rollup_select(name, smallest_parent(cuboid, built)[0], cuboid), []
+            cur.execute('DROP TABLE IF EXISTS {};'.format(table))
+            cur.execute('CREATE TABLE {} AS {};'.format(table, select), params)
+            cur.execute('SELECT COUNT(*) FROM {};'.format(table))
+            built[cuboid] = (table, cur.fetchone()[0])
+            cur.execute("""INSERT INTO rollup_catalog (cube, cuboid, cells, high_value, refreshed_at)
+                           VALUES (%s, %s, %s, %s, %s);""", (name, table, built[cuboid][1], high_value, datetime.now()))
+    conn.commit()
+    bump_table_versions(conn, [table for table, _ in built.values()])
+
+    return built
+
+
+def merge_cells(cur, name, table, delta, cuboid):
+    """
+    Description: This function adds the cells of a delta to an aggregate table,
+                 existing cells are updated and new cells are inserted
+
+    Arguments:
+        cur: the cursor object
+        name: name of the cube
+        table: aggregate table
+        delta: table with the delta of the same cuboid
+        cuboid: tuple of dimension names
+
+    Returns:
+        (updated, inserted) number of cells
+    """
+    measures = list(cubes[name]['measures'])
+    match = ' AND '.join('{0}.{1} = d.{1}'.format(table, d) for d in cuboid) or 'TRUE'
+    # the grand total of an empty fact table is NULL
+    cur.execute('UPDATE {0} SET {1} FROM {2} d WHERE {3};'.format(
+        table, ', '.join('{1} = COALESCE({0}.{1}, 0) + d.{1}'.format(table, m) for m in measures), delta, match))
+    updated = cur.rowcount
+
+    columns = ', '.join(list(cuboid) + measures)
+    cur.execute('INSERT INTO {0} ({1}) SELECT {2} FROM {3} d WHERE NOT EXISTS (SELECT 1 FROM {0} WHERE {4});'.format(
+        table, columns, ', '.join('d.' + c for c in list(cuboid) + measures), delta, match))
+
+    return updated, cur.rowcount
+
+
+def refresh_cube(conn, name):
+    """
+    Description: This function brings the aggregates of a cube up to date after
+                 a load. The facts above the stored high value are aggregated
+                 into delta tables of every cuboid, which only touch the
+                 affected cells. All aggregates and the high value are changed
+                 in one transaction. A cube which was never built is built.
+
+    Arguments:
+        conn: object of the connection to the database
+        name: name of the cube
+
+    Returns:
+        dict with the new facts' high value and the updated and inserted cells
+    """
+    with conn.cursor() as cur:
+        cur.execute(rollup_catalog_create)
+        cur.execute('SELECT cuboid, cells, high_value FROM rollup_catalog WHERE cube=%s;', (name,))
+        catalog = {table: (cells, high) for table, cells, high in cur.fetchall()}
+    conn.commit()
+    if len(catalog) != len(lattice(name)):
+        build_cube(conn, name)
+        return {'built': True, 'updated': 0, 'inserted': 0}
+
+    old_high = next(iter(catalog.values()))[1]
+    stats = {'built': False, 'updated': 0, 'inserted': 0}
+    with conn.cursor() as cur:
+        new_high = get_high_value(cur, name)
+        if new_high is None or (old_high is not None and new_high == old_high):
+            conn.commit()
+            return stats
+
+        deltas = {}
+        for cuboid in lattice(name):
+            table = table_name(name, cuboid)
+            delta = table.replace('rollup_', 'rollup_delta_', 1)
+            if not deltas:
+                select, params = fact_select(name, cuboid, lower=old_high, upper=new_high)
+            else:
+                select, params = rollup_select(name, smallest_parent(cuboid, deltas)[0], cuboid), []
+            cur.execute('CREATE TEMP TABLE {} AS {};'.format(delta, select), params)
+            cur.execute('SELECT COUNT(*) FROM {};'.format(delta))
+            deltas[cuboid] = (delta, cur.fetchone()[0])
+
+            updated, inserted = merge_cells(cur, name, table, delta, cuboid)
+            stats['updated'] += updated
+            stats['inserted'] += inserted
+            cur.execute("""UPDATE rollup_catalog SET cells=cells + %s, high_value=%s, refreshed_at=%s
+                           WHERE cube=%s AND cuboid=%s;""", (inserted, new_high, datetime.now(), name, table))
+
+        for delta, _ in deltas.values():
+            cur.execute('DROP TABLE {};'.format(delta))
+    conn.commit()
+    bump_table_versions(conn, [table_name(name, cuboid) for cuboid in deltas])
+
+    return stats
+
+
+def route(conn, name, group_by, filters=None):
+    """
+    Description: This function answers a roll-up, drill-down or slice request
+                 from the smallest aggregate that contains all grouped and
+                 filtered dimensions
+
+    Arguments:
+        conn: object of the connection to the database
+        name: name of the cube
+        group_by: list of dimension names
+        filters: dict of dimension -> value or tuple of values
+
+    Returns:
+        table: the aggregate table used
+        sql: the query on the aggregate table with %s placeholders
+        params: list of parameters
+    """
+    filters = filters or {}
+    needed = set(group_by) | set(filters)
+    unknown = needed - set(cubes[name]['dimensions'])
+    if unknown:
+        raise ValueError('{} has no dimensions {}'.format(name, sorted(unknown)))
+
+    with conn.cursor() as cur:
+        cur.execute('SELECT cuboid, cells FROM rollup_catalog WHERE cube=%s;', (name,))
+        cells = dict(cur.fetchall())
+    conn.commit()
+    candidates = [c for c in lattice(name) if needed <= set(c) and table_name(name, c) in cells]
+    if not candidates:
+        raise ValueError('cube {} is not built'.format(name))
+    table = table_name(name, min(candidates, key=lambda c: (cells[table_name(name, c)], len(c))))
+
+    conditions, params = [], []
+    for dim, value in filters.items():
+        conditions.append('{} {} %s'.format(dim, 'IN' if isinstance(value, tuple) else '='))
+        params.append(value)
+
+    return table, rollup_select(name, table, tuple(group_by), conditions), params
+
+
+def parse_filters(values):
+    """
+    Description: This function parses dimension=value arguments, several
+                 values are separated by |, eg. country=Canada|Australia
+
+    Arguments:
+        values: list of dimension=value strings
+
+    Returns:
+        dict of dimension -> value or tuple of values
+    """
+    filters = {}
+    for value in values or []:
+        dim, _, text = value.partition('=')
+        parts = tuple(text.split('|'))
+        filters[dim] = parts if len(parts) > 1 else parts[0]
+
+    return filters
+
+
+def main():
+    """
+    Description: This main function builds or refreshes the aggregates of a
+                 cube, or answers a query from them
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Pre-aggregated rollups of the fact tables')
+    parser.add_argument('action', choices=['build', 'refresh', 'query'])
+    parser.add_argument('--cube', choices=sorted(cubes), default='songplays')
+    parser.add_argument('--dsn', help='connection string (default: CLUSTER section of dwh.cfg)')
+    parser.add_argument('--schema', help='schema of the fact and aggregate tables')
+    parser.add_argument('--group-by', default='', help='comma separated dimensions of a query')
+    parser.add_argument('--where', action='append', help='dimension=value filter of a query, can be repeated')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn) if args.dsn else get_connection(read_config('dwh.cfg'))
+    try:
+        if args.schema:
+            with conn.cursor() as cur:
+                cur.execute('SET search_path TO {}, public;'.format(args.schema))
+
+        if args.action == 'build':
+            for cuboid, (table, rows) in build_cube(conn, args.cube).items():
+                print_status('rollup_cache', '{} {} rows'.format(table, rows))
+        elif args.action == 'refresh':
+            print_status('rollup_cache', 'refreshed {}: {}'.format(args.cube, refresh_cube(conn, args.cube)))
+        else:
+            group_by = [d for d in args.group_by.split(',') if d]
+            table, sql, params = route(conn, args.cube, group_by, parse_filters(args.where))
+            print_status('rollup_cache', 'answered from {}'.format(table))
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                for row in cur.fetchall():
+                    print(row)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+import argparse
+import gzip
+import io
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from tools import read_config, get_connection, get_s3_client, split_s3_url, print_status
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+extensions = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def strip_compression(name):
+    """
+    Description: This function removes a .gz or .zst extension from a file name
+
+    Arguments:
+        name: file name
+
+    Returns:
+        the file name without compression extension
+    """
+    for extension in extensions.values():
+        if name.endswith(extension):
+            return name[:-len(extension)]
+
+    return name
+
+
+def open_input(path):
+    """
+    Description: This function opens the input file for reading in binary
+                 mode, gzip and zstd compressed files are decompressed on the fly
+
+    Arguments:
+        path: path to the input file
+
+    Returns:
+        binary file object
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+
+    return open(path, 'rb')
+
+
+def estimate_raw_size(path, sample_size=4 * 1024 * 1024):
+    """
+    Description: This function estimates the decompressed size of the input.
+                 A compressed input is decompressed up to sample_size bytes
+                 and its size scaled by the ratio of the sample to the
+                 compressed bytes read for it. The decoders read ahead, so the
+                 ratio and the estimate are rather too low than too high.
+
+    Arguments:
+        path: path to the input file
+        sample_size: decompressed bytes of the sample
+
+    Returns:
+        estimated size in bytes
+    """
+    size = os.path.getsize(path)
+    if strip_compression(path) == path:
+        return size
+
+    with open(path, 'rb') as raw:
+        if path.endswith('.gz'):
+            f = gzip.GzipFile(fileobj=raw, mode='rb')
+        else:
+            f = zstandard.ZstdDecompressor().stream_reader(raw)
+        sample = 0
+        while sample < sample_size:
+            block = f.read(min(1024 * 1024, sample_size - sample))
+            if not block:
+                # the whole input fitted into the sample
+                return sample
+            sample += len(block)
+        consumed = raw.tell()
+
+    return int(size * sample / max(consumed, 1))
+
+
+def count_records(data, fmt):
+    """
+    Description: This function counts the complete records of data and finds
+                 the end of the last one. In CSV a newline inside a quoted
+                 field does not end the record. Splitting at the quotes finds
+                 them: only newlines in every second piece are outside of quotes.
+
+    Arguments:
+        data: bytes starting at a record boundary
+        fmt: csv or jsonl
+
+    Returns:
+        records: number of newlines ending a record
+        cut: position after the last of them, 0 if there is none
+    """
+    if fmt != 'csv' or b'"' not in data:
+        return data.count(b'\n'), data.rfind(b'\n') + 1
+
+    records, cut, offset = 0, 0, 0
+    for i, piece in enumerate(data.split(b'"')):
+        if i % 2 == 0 and b'\n' in piece:
+            records += piece.count(b'\n')
+            cut = offset + piece.rfind(b'\n') + 1
+        offset += len(piece) + 1
+
+    return records, cut
+
+
+def read_chunks(f, fmt, chunk_size):
+    """
+    Description: This function reads the input in chunks of about chunk_size
+                 bytes which end at a record boundary
+
+    Arguments:
+        f: binary file object
+        fmt: csv or jsonl
+        chunk_size: size of a chunk in bytes
+
+    Returns:
+        generator of (chunk, number of records)
+    """
+    rest = b''
+    while True:
+        block = f.read(chunk_size)
+        if not block:
+            break
+        data = rest + block
+        records, cut = count_records(data, fmt)
+        if not records:
+            rest = data
+            continue
+        yield data[:cut], records
+        rest = data[cut:]
+
+    if rest.strip():
+        if not rest.endswith(b'\n'):
+            rest += b'\n'
+        yield rest, count_records(rest, fmt)[0]
+
+
+def compress(chunk, compression, level):
+    """
+    Description: This function compresses a chunk into a gzip member or a
+                 zstd frame. Concatenated members and frames are valid files.
+
+    Arguments:
+        chunk: bytes
+        compression: gzip or zstd
+        level: compression level
+
+    Returns:
+        compressed bytes
+    """
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(chunk)
+
+    return gzip.compress(chunk, compresslevel=level)
+
+
+def count_part(path, fmt, header):
+    """
+    Description: This function decompresses a part and counts its records
+
+    Arguments:
+        path: path to the part
+        fmt: csv or jsonl
+        header: the part starts with a header line
+
+    Returns:
+        number of records
+    """
+    with open_input(path) as f:
+        records = sum(n for _, n in read_chunks(f, fmt, 4 * 1024 * 1024))
+
+    return records - 1 if header else records
+
+
+def split_file(input_path, output_dir, num_parts, fmt, compression='gzip', level=6, header=False,
+               chunk_size=4 * 1024 * 1024, workers=None):
+    """
+    Description: This function splits the input into num_parts compressed
+                 parts of nearly the same size. The input is read in chunks
+                 which are handed out to the parts in turn and compressed by a
+                 pool of processes. At most two chunks per process are in
+                 flight, so the memory stays bounded by the chunk size. The
+                 chunk size is lowered to give every part at least 8 chunks of
+                 the (estimated decompressed) input. Parts without records,
+                 left over by a small input, are removed.
+
+    Arguments:
+        input_path: path to the CSV or JSON lines input
+        output_dir: directory of the parts
+        num_parts: number of parts
+        fmt: csv or jsonl
+        compression: gzip or zstd
+        level: compression level
+        header: the first line of the CSV input is a header, it is repeated
+                in every part (use IGNOREHEADER 1 in the COPY)
+        chunk_size: size of a chunk in bytes
+        workers: number of compressing processes (default: number of cores)
+
+    Returns:
+        parts: list of dicts with path, records, raw and compressed bytes of
+               the parts with records
+    """
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError('zstd compression needs the zstandard package')
+
+    os.makedirs(output_dir, exist_ok=True)
+    stem, ext = os.path.splitext(strip_compression(os.path.basename(input_path)))
+    parts = [{'path': os.path.join(output_dir, '{}.part{:04d}{}{}'.format(stem, i, ext, extensions[compression])),
+              'records': 0, 'raw_bytes': 0, 'bytes': 0} for i in range(num_parts)]
+    files = [open(part['path'], 'wb') for part in parts]
+
+    workers = workers or os.cpu_count()
+    # at least 8 chunks per part keep the parts of a small input even
+    chunk_size = max(min(chunk_size, estimate_raw_size(input_path, chunk_size) // (num_parts * 8)), 64 * 1024)
+    try:
+        with open_input(input_path) as f, ProcessPoolExecutor(max_workers=workers) as executor:
+            header_line = f.readline() if header else b''
+            if header_line:
+                for part, out in zip(parts, files):
+                    data = compress(header_line, compression, level)
+                    out.write(data)
+                    part['bytes'] += len(data)
+
+            pending = deque()
+            for i, (chunk, records) in enumerate(read_chunks(f, fmt, chunk_size)):
+                part = parts[i % num_parts]
+                part['records'] += records
+                part['raw_bytes'] += len(chunk)
+                pending.append((i % num_parts, executor.submit(compress, chunk, compression, level)))
+                # write in submission order, wait for the oldest chunk when the pool is full
+                while pending and (len(pending) >= 2 * workers or pending[0][1].done()):
+                    index, future = pending.popleft()
+                    data = future.result()
+                    files[index].write(data)
+                    parts[index]['bytes'] += len(data)
+
+            while pending:
+                index, future = pending.popleft()
+                data = future.result()
+                files[index].write(data)
+                parts[index]['bytes'] += len(data)
+    finally:
+        for out in files:
+            out.close()
+
+    empty = [part for part in parts if not part['records']]
+    for part in empty:
+        os.remove(part['path'])
+    if empty:
+        print_status('split_files', 'removed {} parts without records, the input has too few chunks'.format(
+            len(empty)))
+
+    return [part for part in parts if part['records']]
+
+
+def verify_parts(parts, fmt, header, workers=None):
+    """
+    Description: This function decompresses every part and compares its
+                 records with the records written into it
+
+    Arguments:
+        parts: list of dicts returned by split_file
+        fmt: csv or jsonl
+        header: the parts start with a header line
+        workers: number of processes (default: number of cores)
+
+    Returns:
+        list of parts whose count differs, with the counted records
+    """
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        counts = executor.map(count_part, [p['path'] for p in parts], [fmt] * len(parts), [header] * len(parts))
+        mismatches = []
+        for part, counted in zip(parts, counts):
+            if counted != part['records']:
+                mismatches.append(dict(part, counted=counted))
+
+    return mismatches
+
+
+def local_manifest(parts, prefix_url, manifest_path):
+    """
+    Description: This function writes the COPY manifest of the parts as they
+                 will be found below an S3 prefix
+
+    Arguments:
+        parts: list of dicts returned by split_file
+        prefix_url: S3 url of the prefix the parts are uploaded to
+        manifest_path: path of the manifest file
+
+    Returns:
+        list of objects (bucket, key, size) of the parts
+    """
+    bucket, prefix = split_s3_url(prefix_url)
+    objects = [{'bucket': bucket, 'key': '{}/{}'.format(prefix.rstrip('/'), os.path.basename(p['path'])).lstrip('/'),
+                'size': p['bytes']} for p in parts]
+    manifest = {'entries': [{'url': 's3://{}/{}'.format(o['bucket'], o['key']),
+                             'mandatory': True,
+                             'meta': {'content_length': o['size']}} for o in objects]}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return objects
+
+
+def main():
+    """
+    Description: This main function splits an input file into compressed parts
+                 for the slices of the cluster, verifies them and writes (and
+                 optionally uploads) the COPY manifest
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Split a CSV or JSON lines file into compressed parts for COPY')
+    parser.add_argument('input')
+    parser.add_argument('--output-dir', default='split')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='format of the input (default: jsonl for .json/.jsonl files, otherwise csv)')
+    parser.add_argument('--header', action='store_true', help='the CSV input starts with a header line')
+    parser.add_argument('--compression', choices=sorted(extensions), default='gzip')
+    parser.add_argument('--level', type=int, help='compression level (default: 6 for gzip, 3 for zstd)')
+    parser.add_argument('--parts', type=int, help='number of parts (default: slices * files per slice)')
+    parser.add_argument('--slices', type=int, help='number of slices (default: from dwh.cfg or the cluster)')
+    parser.add_argument('--files-per-slice', type=int, default=1)
+    parser.add_argument('--chunk-mb', type=int, default=4)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--s3-prefix', help='S3 url the parts are loaded from, a manifest is written for it')
+    parser.add_argument('--upload', action='store_true', help='upload the parts and the manifest to --s3-prefix')
+    args = parser.parse_args()
+
+    fmt = args.format or ('jsonl' if strip_compression(args.input).endswith(('.json', '.jsonl')) else 'csv')
+    level = args.level or (3 if args.compression == 'zstd' else 6)
+    config = read_config('dwh.cfg')
+    num_parts = args.parts
+    if not num_parts:
+        slices = args.slices or int(config.get('STAGING', 'SLICES', fallback='') or 0)
+        if not slices:
+            # imported here, sql_queries reads dwh.cfg of the cluster on import
+            from staging_loader import get_num_slices
+            conn = get_connection(config)
+            slices = get_num_slices(conn, config)
+            conn.close()
+        num_parts = slices * args.files_per_slice
+
+    t0 = perf_counter()
+    parts = split_file(args.input, args.output_dir, num_parts, fmt, args.compression, level, args.header,
+                       args.chunk_mb * 1024 * 1024, args.workers)
+    seconds = perf_counter() - t0
+
+    records = sum(p['records'] for p in parts)
+    raw_bytes = sum(p['raw_bytes'] for p in parts)
+    compressed = sum(p['bytes'] for p in parts)
+    print('{:<48}{:>12}{:>14}{:>14}'.format('part', 'records', 'raw bytes', 'bytes'))
+    for p in parts:
+        print('{:<48}{:>12}{:>14}{:>14}'.format(os.path.basename(p['path']), p['records'], p['raw_bytes'], p['bytes']))
+    print_status('split_files', '{} records, {} parts, {:.1f} MB -> {:.1f} MB in {:.2f}s ({:.1f} MB/s)'.format(
+        records, len(parts), raw_bytes / 1e6, compressed / 1e6, seconds, raw_bytes / 1e6 / seconds))
+
+    mismatches = verify_parts(parts, fmt, args.header, args.workers)
+    for p in mismatches:
+        print_status('split_files', '{} has {} records, {} were written'.format(p['path'], p['counted'], p['records']))
+    if mismatches:
+        raise SystemExit(1)
+    print_status('split_files', 'verified the records of all parts')
+
+    if args.s3_prefix:
+        manifest_path = os.path.join(args.output_dir, 'manifest.json')
+        objects = local_manifest(parts, args.s3_prefix, manifest_path)
+        manifest_url = '{}/manifest.json'.format(args.s3_prefix.rstrip('/'))
+        if args.upload:
+            from staging_loader import write_manifest
+            s3 = get_s3_client(config)
+            for part, obj in zip(parts, objects):
+                s3.upload_file(part['path'], obj['bucket'], obj['key'])
+            write_manifest(s3, objects, manifest_url)
+            print_status('split_files', 'uploaded {} parts and {}'.format(len(parts), manifest_url))
+
+        options = 'CSV IGNOREHEADER 1' if args.header else ('CSV' if fmt == 'csv' else "FORMAT AS JSON 'auto'")
+        print("COPY <table> FROM '{}' IAM_ROLE '<arn>' {} {} MANIFEST;".format(
+            manifest_url, args.compression.upper(), options))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ log_data      = config.get('S3', 'LOG_DATA')
 log_json_path = config.get('S3', 'LOG_JSONPATH')
 song_data     = config.get('S3', 'SONG_DATA')
 s3_region     = config.get('S3', 'S3_REGION')
+max_error     = config.getint('STAGING', 'MAXERROR', fallback=0)
+copy_max_error = 'MAXERROR {}'.format(max_error) if max_error else ''
 
 # DROP TABLES
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
@@ -20,41 +22,45 @@ user_table_drop           = "DROP TABLE IF EXISTS dim_users"
 song_table_drop           = "DROP TABLE IF EXISTS dim_songs"
 artist_table_drop         = "DROP TABLE IF EXISTS dim_artists"
 time_table_drop           = "DROP TABLE IF EXISTS dim_time"
+watermark_table_drop      = "DROP TABLE IF EXISTS etl_watermark"
+journal_table_drop        = "DROP TABLE IF EXISTS etl_journal"
 
 # CREATE TABLES
 staging_events_table_create = ("""CREATE TABLE IF NOT EXISTS staging_events (
-                                  artist          TEXT,
-                                  auth            TEXT,
-                                  firstName       TEXT,
-                                  gender          TEXT,
-                                  itemInSession   INT,
-                                  lastName        TEXT,
-                                  length          TEXT,
-                                  level           TEXT,
-                                  location        TEXT,
-                                  method          TEXT,
-                                  page            TEXT,
-                                  registration    TEXT,
-                                  sessionId       INT,
-                                  song            TEXT,
-                                  status          INT,
-                                  ts              BIGINT,
-                                  userAgent       TEXT,
-                                  userId          INT
+                                  artist          TEXT            ENCODE ZSTD,
+                                  auth            TEXT            ENCODE ZSTD,
+                                  firstName       TEXT            ENCODE ZSTD,
+                                  gender          TEXT            ENCODE ZSTD,
+                                  itemInSession   INT             ENCODE AZ64,
+                                  lastName        TEXT            ENCODE ZSTD,
+                                  length          DECIMAL(10,5)   ENCODE AZ64,
+                                  level           TEXT            ENCODE ZSTD,
+                                  location        TEXT            ENCODE ZSTD,
+                                  method          TEXT            ENCODE ZSTD,
+                                  page            TEXT            ENCODE ZSTD,
+                                  registration    TEXT            ENCODE ZSTD,
+                                  sessionId       INT             ENCODE AZ64,
+                                  song            TEXT            ENCODE ZSTD,
+                                  status          INT             ENCODE AZ64,
+                                  ts              BIGINT          ENCODE AZ64,
+                                  userAgent       TEXT            ENCODE ZSTD,
+                                  userId          INT             ENCODE AZ64,
+                                  song_key        BIGINT          ENCODE AZ64
                                   );
 """)
 
 staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS staging_songs (
-                                 num_songs          INT,
-                                 artist_id          TEXT,
-                                 artist_latitude    TEXT,
-                                 artist_longitude   TEXT,
-                                 artist_location    TEXT,
-                                 artist_name        TEXT,
-                                 song_id            TEXT,
-                                 title              TEXT,
-                                 duration           TEXT,
-                                 year               INT
+                                 num_songs          INT             ENCODE AZ64,
+                                 artist_id          TEXT            ENCODE ZSTD,
+                                 artist_latitude    DECIMAL(9,6)    ENCODE AZ64,
+                                 artist_longitude   DECIMAL(9,6)    ENCODE AZ64,
+                                 artist_location    TEXT            ENCODE ZSTD,
+                                 artist_name        TEXT            ENCODE ZSTD,
+                                 song_id            TEXT            ENCODE ZSTD,
+                                 title              TEXT            ENCODE ZSTD,
+                                 duration           DECIMAL(10,5)   ENCODE AZ64,
+                                 year               INT             ENCODE AZ64,
+                                 song_key           BIGINT          ENCODE AZ64
                                  );
 """)
 
@@ -115,23 +121,178 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS dim_time (
                         );
 """)
 
+watermark_table_create = ("""CREATE TABLE IF NOT EXISTS etl_watermark (
+                             table_name   TEXT     NOT NULL   PRIMARY KEY,
+                             high_ts      BIGINT   NOT NULL
+                             );
+""")
+
+journal_table_create = ("""CREATE TABLE IF NOT EXISTS etl_journal (
+                           run_id        VARCHAR(32)        NOT NULL,
+                           step          VARCHAR(128)       NOT NULL,
+                           fingerprint   VARCHAR(40),
+                           status        VARCHAR(16)        NOT NULL,
+                           num_rows      BIGINT,
+                           num_bytes     BIGINT,
+                           seconds       DOUBLE PRECISION,
+                           finished_at   TIMESTAMP          NOT NULL,
+                           error         VARCHAR(1024)
+                           );
+""")
+
+# LOAD METRICS
+# one row per COPY and one per rejected row, create_tables.py does not drop them to keep the history
+load_metrics_table_create = ("""CREATE TABLE IF NOT EXISTS load_metrics (
+                                run_id          VARCHAR(32)        NOT NULL,
+                                table_name      VARCHAR(64)        NOT NULL,
+                                source          VARCHAR(1024)      NOT NULL,
+                                status          VARCHAR(16)        NOT NULL,
+                                query_id        BIGINT,
+                                files           INT,
+                                bytes_scanned   BIGINT,
+                                rows_loaded     BIGINT,
+                                rows_rejected   BIGINT,
+                                seconds         DOUBLE PRECISION,
+                                loaded_at       TIMESTAMP          NOT NULL
+                                );
+""")
+
+load_rejects_table_create = ("""CREATE TABLE IF NOT EXISTS load_rejects (
+                                run_id        VARCHAR(32)     NOT NULL,
+                                table_name    VARCHAR(64)     NOT NULL,
+                                filename      VARCHAR(1024),
+                                line_number   BIGINT,
+                                column_name   VARCHAR(128),
+                                reason        VARCHAR(1024),
+                                raw_line      VARCHAR(1024),
+                                rejected_at   TIMESTAMP       NOT NULL
+                                );
+""")
+
+# STAGING COLUMNS
+# column order of the staging tables, used by the Postgres stand-in to map json fields
+staging_events_columns = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName',
+                          'length', 'level', 'location', 'method', 'page', 'registration',
+                          'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+staging_songs_columns  = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude',
+                          'artist_location', 'artist_name', 'song_id', 'title', 'duration', 'year']
+
 # STAGING TABLES
-staging_events_copy = ("""COPY staging_events
+staging_events_copy = ("""COPY staging_events ({4})
                           FROM {0}
                           IAM_ROLE {1}
                           FORMAT JSON AS {2}
-                          REGION {3};
-""").format(log_data, iam_role, log_json_path, s3_region)
+                          REGION {3}
+                          ROUNDEC
+                          {5};
+""").format(log_data, iam_role, log_json_path, s3_region, ', '.join(staging_events_columns), copy_max_error)
 
-staging_songs_copy = ("""COPY staging_songs
+staging_songs_copy = ("""COPY staging_songs ({3})
                          FROM {0}
                          IAM_ROLE {1}
                          FORMAT JSON AS 'auto'
                          REGION {2}
-                         COMPUPDATE OFF;
-""").format(song_data, iam_role, s3_region)
+                         ROUNDEC
+                         COMPUPDATE OFF
+                         {4};
+""").format(song_data, iam_role, s3_region, ', '.join(staging_songs_columns), copy_max_error)
+
+# STAGING TABLES FROM MANIFESTS
+# the manifest url is filled in by staging_loader.py for every group of files
+staging_events_copy_manifest = ("""COPY staging_events ({3})
+                                   FROM '{{}}'
+                                   IAM_ROLE '{0}'
+                                   FORMAT JSON AS {1}
+                                   REGION {2}
+                                   ROUNDEC
+                                   MANIFEST
+                                   {4};
+""").format(iam_role, log_json_path, s3_region, ', '.join(staging_events_columns), copy_max_error)
+
+staging_songs_copy_manifest = ("""COPY staging_songs ({2})
+                                  FROM '{{}}'
+                                  IAM_ROLE '{0}'
+                                  FORMAT JSON AS 'auto'
+                                  REGION {1}
+                                  ROUNDEC
+                                  COMPUPDATE OFF
+                                  MANIFEST
+                                  {3};
+""").format(iam_role, s3_region, ', '.join(staging_songs_columns), copy_max_error)
+
+last_copy_count = "SELECT pg_last_copy_count();"
+
+# LOAD TELEMETRY
+# read in the session of the COPY: the rows it rejected (up to MAXERROR) from stl_load_errors,
+# the lines scanned per file from stl_load_commits, bytes and transfer time per file from stl_s3client
+last_copy_id = "SELECT pg_last_copy_id();"
+
+load_errors_count = "SELECT COUNT(*) FROM stl_load_errors WHERE query=%s;"
+
+load_errors_select = ("""SELECT TRIM(filename), line_number, TRIM(colname), TRIM(err_reason), TRIM(raw_line)
+                        FROM stl_load_errors
+                        WHERE query=%s
+                        ORDER BY filename, line_number
+                        LIMIT 1000;
+""")
+
+# a failed COPY is not returned by pg_last_copy_id, its errors are the latest of the session
+load_errors_failed_select = ("""SELECT TRIM(filename), line_number, TRIM(colname), TRIM(err_reason), TRIM(raw_line)
+                               FROM stl_load_errors
+                               WHERE query=(SELECT MAX(query) FROM stl_load_errors WHERE session=pg_backend_pid())
+                               ORDER BY filename, line_number
+                               LIMIT 1000;
+""")
+
+load_files_select = ("""SELECT 's3://' || TRIM(bucket) || '/' || TRIM(key), SUM(transfer_size),
+                               SUM(transfer_time) / 1000000.0
+                        FROM stl_s3client
+                        WHERE query=%s
+                        AND http_method='GET'
+                        GROUP BY 1;
+""")
+
+load_lines_select = ("""SELECT TRIM(filename), SUM(lines_scanned)
+                        FROM stl_load_commits
+                        WHERE query=%s
+                        GROUP BY 1;
+""")
+
+load_metrics_insert = ("""INSERT INTO load_metrics (run_id, table_name, source, status, query_id, files,
+                                                    bytes_scanned, rows_loaded, rows_rejected, seconds, loaded_at)
+                          VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
+load_rejects_insert = ("""INSERT INTO load_rejects (run_id, table_name, filename, line_number, column_name,
+                                                    reason, raw_line, rejected_at)
+                          VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
+# JOIN KEYS
+# 64 bit hash of normalized title, artist name and duration, computed once after the COPY,
+# so that the songplays join compares one BIGINT instead of two wide text columns
+staging_events_key_update = ("""UPDATE staging_events
+                                SET song_key=FNV_HASH(LOWER(TRIM(song)) || '|' || LOWER(TRIM(artist)) || '|' ||
+                                                      CAST(ROUND(length, 2) AS VARCHAR))
+                                WHERE page='NextSong'
+                                AND song_key IS NULL;
+""")
+
+staging_songs_key_update = ("""UPDATE staging_songs
+                               SET song_key=FNV_HASH(LOWER(TRIM(title)) || '|' || LOWER(TRIM(artist_name)) || '|' ||
+                                                     CAST(ROUND(duration, 2) AS VARCHAR))
+                               WHERE song_key IS NULL;
+""")
+
+# the planner has to see the new keys, stale statistics make it sort both tables for a merge join
+staging_events_key_analyze = "ANALYZE staging_events (song_key);"
+staging_songs_key_analyze = "ANALYZE staging_songs (song_key);"
 
 # FINAL TABLES
+# start time of a songplay, time_dimension.at_grain truncates it to a TIME_GRAIN above one second
+songplay_start_time = "TIMESTAMP 'epoch' + e.ts/1000 *INTERVAL '1 second'"
+songplay_start_time_grain = "TIMESTAMP 'epoch' + e.ts/1000/{0}*{0} *INTERVAL '1 second'"
+
 songplay_table_insert = ("""INSERT INTO fact_songplays (
                             start_time, user_id, level, song_id,
                             artist_id, session_id, location, user_agent)
@@ -145,8 +306,7 @@ songplay_table_insert = ("""INSERT INTO fact_songplays (
                             e.userAgent
                             FROM staging_events AS e
                             JOIN staging_songs AS s
-                            ON e.song=s.title
-                            AND e.artist=s.artist_name
+                            ON e.song_key=s.song_key
                             WHERE e.page='NextSong';
 """)
 
@@ -167,7 +327,7 @@ song_table_insert = ("""INSERT INTO dim_songs (
                         title,
                         artist_id,
                         year,
-                        CONVERT(FLOAT, duration)
+                        duration
                         FROM staging_songs;
 """)
 
@@ -176,8 +336,8 @@ artist_table_insert = ("""INSERT INTO dim_artists (
                           SELECT DISTINCT artist_id,
                           artist_name,
                           artist_location,
-                          CONVERT(FLOAT, artist_latitude),
-                          CONVERT(FLOAT, artist_longitude)
+                          artist_latitude,
+                          artist_longitude
                           FROM staging_songs;
 """)
 
@@ -194,8 +354,312 @@ time_table_insert = ("""INSERT INTO dim_time (
                         WHERE e.page='NextSong';
 """)
 
+# CALENDAR TIME DIMENSION
+# with a TIME_GRAIN above 0 dim_time holds every point of a calendar at that grain. A load only adds the
+# points between the timestamps of its events and the range already covered, which is kept in
+# etl_watermark, instead of extracting the distinct timestamps of all events again
+time_covered_select = ("""SELECT table_name, high_ts
+                          FROM etl_watermark
+                          WHERE table_name IN ('dim_time_low', 'dim_time_high');
+""")
+
+# range of a dim_time filled before the calendar, by time_table_insert
+time_table_range_select = ("""SELECT CAST(EXTRACT(epoch FROM MIN(start_time)) AS BIGINT),
+                                     CAST(EXTRACT(epoch FROM MAX(start_time)) AS BIGINT)
+                              FROM dim_time;
+""")
+
+time_events_range_select = ("""SELECT MIN(ts) / 1000, MAX(ts) / 1000
+                               FROM {}
+                               WHERE page='NextSong';
+""")
+
+time_covered_delete = "DELETE FROM etl_watermark WHERE table_name IN ('dim_time_low', 'dim_time_high');"
+time_covered_insert = ("""INSERT INTO etl_watermark (table_name, high_ts)
+                          VALUES ('dim_time_low', %s), ('dim_time_high', %s);
+""")
+
+# {} is replaced by a numbers subquery returning n = 0, 1, 2, ... (see time_dimension.py)
+time_calendar_insert = ("""INSERT INTO dim_time (
+                           start_time, hour, day, week, month, year, weekday)
+                           SELECT dt,
+                           EXTRACT(hour FROM dt),
+                           EXTRACT(day FROM dt),
+                           EXTRACT(week FROM dt),
+                           EXTRACT(month FROM dt),
+                           EXTRACT(year FROM dt),
+                           EXTRACT(dow FROM dt)
+                           FROM (SELECT TIMESTAMP 'epoch' + (%(low)s + n * %(grain)s) * INTERVAL '1 second' AS dt
+                                 FROM ({}) AS numbers
+                                 WHERE n < %(count)s) AS calendar;
+""")
+
+# fills the gaps of a dim_time filled before the calendar, once, the points already there are kept
+time_calendar_fill = ("""INSERT INTO dim_time (
+                         start_time, hour, day, week, month, year, weekday)
+                         SELECT dt,
+                         EXTRACT(hour FROM dt),
+                         EXTRACT(day FROM dt),
+                         EXTRACT(week FROM dt),
+                         EXTRACT(month FROM dt),
+                         EXTRACT(year FROM dt),
+                         EXTRACT(dow FROM dt)
+                         FROM (SELECT TIMESTAMP 'epoch' + (%(low)s + n * %(grain)s) * INTERVAL '1 second' AS dt
+                               FROM ({}) AS numbers
+                               WHERE n < %(count)s) AS calendar
+                         WHERE NOT EXISTS (SELECT 1 FROM dim_time AS t WHERE t.start_time=calendar.dt);
+""")
+
+# INCREMENTAL LOADS
+# staging_events holds the events of the new log objects, staging_songs keeps the songs of the former
+# runs and gets the new ones appended, their song_key is still NULL until the merge.
+# staging_events_delta holds the NextSong events above the watermark of the last load,
+# every target table is then merged by deleting and re-inserting the keys of the delta or of the new songs
+staging_truncate_queries = {'staging_events': "TRUNCATE staging_events;", 'staging_songs': "TRUNCATE staging_songs;"}
+
+watermark_select = ("""SELECT COALESCE(MAX(high_ts), 0)
+                       FROM etl_watermark
+                       WHERE table_name='staging_events';
+""")
+
+watermark_delete = "DELETE FROM etl_watermark WHERE table_name='staging_events';"
+watermark_insert = "INSERT INTO etl_watermark (table_name, high_ts) VALUES ('staging_events', %s);"
+
+staging_events_delta_create = ("""CREATE TEMP TABLE staging_events_delta AS
+                                  SELECT *
+                                  FROM staging_events
+                                  WHERE page='NextSong'
+                                  AND ts > %s;
+""")
+
+# a backfill (log_discovery.py --backfill) merges the staged events of its days, below the watermark too.
+# Events staged twice, eg. by a reload, are taken once, and songplays merged before are deleted first
+staging_events_backfill_create = ("""CREATE TEMP TABLE staging_events_delta AS
+                                     SELECT DISTINCT *
+                                     FROM staging_events
+                                     WHERE page='NextSong'
+                                     AND ts >= %s
+                                     AND ts < %s;
+""")
+
+staging_events_delta_stats = "SELECT COUNT(*), MAX(ts) FROM staging_events_delta;"
+staging_events_delta_drop  = "DROP TABLE IF EXISTS staging_events_delta;"
+
+# STEP JOURNAL
+# one row per finished step of an etl.py run, a run is complete when its step 'run' is done.
+# COPY steps stay valid across runs until their table is reloaded, then they are marked stale
+journal_last_run = ("""SELECT run_id, SUM(CASE WHEN step='run' AND status='done' THEN 1 ELSE 0 END)
+                       FROM etl_journal
+                       GROUP BY run_id
+                       ORDER BY run_id DESC
+                       LIMIT 1;
+""")
+
+journal_run_steps = "SELECT step, fingerprint FROM etl_journal WHERE run_id=%s AND status='done';"
+journal_copy_steps = "SELECT step, fingerprint FROM etl_journal WHERE step LIKE %s AND status='done';"
+journal_stale_copies = "UPDATE etl_journal SET status='stale' WHERE step LIKE %s AND status='done';"
+
+journal_insert = ("""INSERT INTO etl_journal (run_id, step, fingerprint, status, num_rows, num_bytes,
+                                              seconds, finished_at, error)
+                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
+journal_history = ("""SELECT step, num_bytes, seconds
+                      FROM etl_journal
+                      WHERE status IN ('done', 'stale')
+                      AND seconds IS NOT NULL;
+""")
+
+# TABLE VERSIONS
+# a version stamp per schema.table, bumped after every load step that changes the table, in a short
+# transaction of its own holding the table lock, so concurrent bumps wait instead of failing on a
+# serialization conflict. query_cache.py keys cached results on them. create_tables.py creates the table
+# and does not drop it, so the versions keep growing when the tables are recreated
+table_versions_create = ("""CREATE TABLE IF NOT EXISTS table_versions (
+                            table_name   VARCHAR(256)   NOT NULL   PRIMARY KEY,
+                            version      BIGINT         NOT NULL,
+                            updated_at   TIMESTAMP      NOT NULL
+                            );
+""")
+
+table_versions_lock = "LOCK table_versions;"
+
+table_version_insert = ("""INSERT INTO table_versions (table_name, version, updated_at)
+                           SELECT %s, 0, %s
+                           WHERE NOT EXISTS (SELECT 1 FROM table_versions WHERE table_name=%s);
+""")
+
+table_version_bump = "UPDATE table_versions SET version=version + 1, updated_at=%s WHERE table_name=%s;"
+
+table_versions_select = "SELECT table_name, version FROM table_versions WHERE table_name IN %s;"
+
+# the schema of unqualified table names
+current_schema_select = "SELECT current_schema();"
+
+# LOADED OBJECTS
+# one row per log object copied into staging_events, written in the transaction of its COPY.
+# log_discovery.py lists only the date prefixes from the last loaded day on and skips the
+# objects found here. Dropped with the star schema, so a rebuilt warehouse loads all logs again
+loaded_objects_table_drop = "DROP TABLE IF EXISTS loaded_objects"
+
+loaded_objects_table_create = ("""CREATE TABLE IF NOT EXISTS loaded_objects (
+                                  source        VARCHAR(256)    NOT NULL,
+                                  object_key    VARCHAR(1024)   NOT NULL,
+                                  etag          VARCHAR(64)     NOT NULL,
+                                  size          BIGINT          NOT NULL,
+                                  object_day    DATE            NOT NULL,
+                                  run_id        VARCHAR(32)     NOT NULL,
+                                  loaded_at     TIMESTAMP       NOT NULL
+                                  )
+                                  SORTKEY (object_day);
+""")
+
+# a dry run only reads, without the table nothing is loaded yet
+loaded_objects_exists = "SELECT to_regclass('loaded_objects');"
+
+# the objects of the current run are left out, so a resumed run discovers the same objects again
+loaded_objects_last_day = ("""SELECT MAX(object_day)
+                              FROM loaded_objects
+                              WHERE source=%s AND run_id<>%s;
+""")
+
+loaded_objects_select = ("""SELECT object_key, etag
+                            FROM loaded_objects
+                            WHERE source=%s AND run_id<>%s AND object_day BETWEEN %s AND %s;
+""")
+
+loaded_objects_count = "SELECT COUNT(*) FROM loaded_objects WHERE source=%s;"
+
+loaded_objects_delete = "DELETE FROM loaded_objects WHERE source=%s AND object_key IN %s;"
+
+loaded_objects_insert = ("""INSERT INTO loaded_objects (source, object_key, etag, size, object_day, run_id, loaded_at)
+                            VALUES %s;
+""")
+
+songplay_table_merge = ("""INSERT INTO fact_songplays (
+                           start_time, user_id, level, song_id,
+                           artist_id, session_id, location, user_agent)
+                           SELECT TIMESTAMP 'epoch' + e.ts/1000 *INTERVAL '1 second',
+                           e.userId,
+                           e.level,
+                           s.song_id,
+                           s.artist_id,
+                           e.sessionId,
+                           e.location,
+                           e.userAgent
+                           FROM staging_events_delta AS e
+                           JOIN staging_songs AS s
+                           ON e.song_key=s.song_key;
+""")
+
+songplay_table_merge_delete = ("""DELETE FROM fact_songplays
+                                  USING staging_events_delta AS e
+                                  WHERE fact_songplays.user_id=e.userId
+                                  AND fact_songplays.session_id=e.sessionId
+                                  AND fact_songplays.start_time=TIMESTAMP 'epoch' + e.ts/1000 *INTERVAL '1 second';
+""")
+
+user_table_merge_delete = ("""DELETE FROM dim_users
+                              USING staging_events_delta AS e
+                              WHERE dim_users.user_id=e.userId;
+""")
+
+user_table_merge_insert = ("""INSERT INTO dim_users (
+                              user_id, first_name, last_name, gender, level)
+                              SELECT userId, firstName, lastName, gender, level
+                              FROM (SELECT userId, firstName, lastName, gender, level,
+                                    ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS rn
+                                    FROM staging_events_delta
+                                    WHERE userId IS NOT NULL) AS latest
+                              WHERE rn=1;
+""")
+
+# the events of a backfill are older than the ones the users were loaded from, only missing users are added
+user_table_backfill_insert = ("""INSERT INTO dim_users (
+                                 user_id, first_name, last_name, gender, level)
+                                 SELECT userId, firstName, lastName, gender, level
+                                 FROM (SELECT userId, firstName, lastName, gender, level,
+                                       ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS rn
+                                       FROM staging_events_delta
+                                       WHERE userId IS NOT NULL) AS latest
+                                 WHERE rn=1
+                                 AND NOT EXISTS (SELECT 1 FROM dim_users AS u WHERE u.user_id=latest.userId);
+""")
+
+song_table_merge_delete = ("""DELETE FROM dim_songs
+                              USING staging_songs AS s
+                              WHERE dim_songs.song_id=s.song_id
+                              AND s.song_key IS NULL;
+""")
+
+song_table_merge_insert = ("""INSERT INTO dim_songs (
+                              song_id, title, artist_id, year, duration)
+                              SELECT song_id, title, artist_id, year, duration
+                              FROM (SELECT song_id, title, artist_id, year, duration,
+                                    ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC) AS rn
+                                    FROM staging_songs
+                                    WHERE song_key IS NULL) AS latest
+                              WHERE rn=1;
+""")
+
+artist_table_merge_delete = ("""DELETE FROM dim_artists
+                                USING staging_songs AS s
+                                WHERE dim_artists.artist_id=s.artist_id
+                                AND s.song_key IS NULL;
+""")
+
+artist_table_merge_insert = ("""INSERT INTO dim_artists (
+                                artist_id, name, location, latitude, longitude)
+                                SELECT artist_id, artist_name, artist_location,
+                                artist_latitude,
+                                artist_longitude
+                                FROM (SELECT artist_id, artist_name, artist_location,
+                                      artist_latitude, artist_longitude,
+                                      ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY year DESC) AS rn
+                                      FROM staging_songs
+                                      WHERE song_key IS NULL) AS latest
+                                WHERE rn=1;
+""")
+
+time_table_merge_delete = ("""DELETE FROM dim_time
+                              USING staging_events_delta AS e
+                              WHERE dim_time.start_time=TIMESTAMP 'epoch' + e.ts/1000 *INTERVAL '1 second';
+""")
+
+time_table_merge_insert = ("""INSERT INTO dim_time (
+                              start_time, hour, day, week, month, year, weekday)
+                              SELECT DISTINCT TIMESTAMP 'epoch' + e.ts/1000 *INTERVAL '1 second' AS dt,
+                              EXTRACT(hour FROM dt),
+                              EXTRACT(day FROM dt),
+                              EXTRACT(week FROM dt),
+                              EXTRACT(month FROM dt),
+                              EXTRACT(year FROM dt),
+                              EXTRACT(dow FROM dt)
+                              FROM staging_events_delta AS e;
+""")
+
 # QUERY LISTS
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, artist_table_create, song_table_create, time_table_create, songplay_table_create]
-drop_table_queries   = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, artist_table_create, song_table_create, time_table_create, songplay_table_create, watermark_table_create, journal_table_create, load_metrics_table_create, load_rejects_table_create, table_versions_create, loaded_objects_table_create]
+drop_table_queries   = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, watermark_table_drop, journal_table_drop, loaded_objects_table_drop]
 copy_table_queries   = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
\ No newline at end of file
+key_table_queries    = [staging_events_key_update, staging_songs_key_update,
+                        staging_events_key_analyze, staging_songs_key_analyze]
+insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert]
+copy_manifest_queries = {'staging_events': staging_events_copy_manifest, 'staging_songs': staging_songs_copy_manifest}
+staging_columns       = {'staging_events': staging_events_columns, 'staging_songs': staging_songs_columns}
+merge_table_queries   = [artist_table_merge_delete, artist_table_merge_insert, song_table_merge_delete, song_table_merge_insert,
+                         staging_songs_key_update, user_table_merge_delete, user_table_merge_insert, songplay_table_merge]
+backfill_table_queries = [user_table_backfill_insert, songplay_table_merge_delete, songplay_table_merge]
+
+# INSERT DEPENDENCIES
+# statement per target table and the tables that have to be loaded before it,
+# the dimensions referenced by foreign keys are loaded before the tables referencing them.
+# dim_time is loaded by time_dimension.py, with time_table_insert and the time_table_merge
+# statements or, with a TIME_GRAIN above 0, from the calendar
+star_table_creates        = {'dim_users': user_table_create, 'dim_artists': artist_table_create,
+                             'dim_songs': song_table_create, 'dim_time': time_table_create,
+                             'fact_songplays': songplay_table_create}
+insert_table_statements   = {'dim_users': user_table_insert, 'dim_artists': artist_table_insert,
+                             'dim_songs': song_table_insert, 'fact_songplays': songplay_table_insert}
+insert_table_dependencies = {'dim_users': [], 'dim_artists': [], 'dim_songs': ['dim_artists'], 'dim_time': [],
+                             'fact_songplays': ['dim_users', 'dim_artists', 'dim_songs', 'dim_time']}
@@ -0,0 +1,526 @@
+import csv
+import io
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
+import psycopg2
+from sql_queries import copy_manifest_queries, staging_columns, last_copy_count
+from sql_queries import (last_copy_id, load_errors_count, load_errors_select, load_errors_failed_select,
+                         load_files_select, load_lines_select, load_metrics_insert, load_rejects_insert,
+                         load_metrics_table_create, load_rejects_table_create)
+from query_cache import bump_table_versions
+from tools import read_config, get_connection, get_s3_client, split_s3_url, unquote, print_status
+
+
+class LoadRejected(psycopg2.DataError):
+    """
+    Description: Raised by the COPY emulation of the Postgres stand-in when
+                 more rows are rejected than MAXERROR allows, like the failing
+                 COPY on Redshift. errors holds the rejected rows, file_stats
+                 the rows, rejected rows and bytes of every file.
+    """
+
+    def __init__(self, message, errors, file_stats):
+        super().__init__(message)
+        self.errors = errors
+        self.file_stats = file_stats
+
+
+def list_objects(s3, url, suffix='.json'):
+    """
+    Description: This function lists the objects below an S3 prefix
+
+    Arguments:
+        s3: boto3 S3 client
+        url: S3 url of the prefix
+        suffix: only objects whose key ends with suffix are returned
+
+    Returns:
+        objects: list of dicts with bucket, key, size and etag, sorted by key
+    """
+    bucket, prefix = split_s3_url(url)
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(suffix):
+                objects.append({'bucket': bucket, 'key': obj['Key'],
+                                'size': obj['Size'], 'etag': obj['ETag'].strip('"')})
+
+    return sorted(objects, key=lambda o: o['key'])
+
+
+def slice_aligned_groups(objects, num_slices, files_per_slice):
+    """
+    Description: This function splits the objects into groups of
+                 num_slices * files_per_slice files, so that every COPY keeps
+                 all slices busy with the same number of files. Inside a group
+                 the files are ordered by size, largest first
+
+    Arguments:
+        objects: list of objects returned by list_objects
+        num_slices: number of slices of the cluster
+        files_per_slice: number of files per slice and COPY
+
+    Returns:
+        list of groups (lists of objects)
+    """
+    group_size = max(num_slices * files_per_slice, 1)
+    groups = [objects[i:i + group_size] for i in range(0, len(objects), group_size)]
+
+    return [sorted(group, key=lambda o: o['size'], reverse=True) for group in groups]
+
+
+def write_manifest(s3, objects, manifest_url):
+    """
+    Description: This function writes a COPY manifest listing the objects
+
+    Arguments:
+        s3: boto3 S3 client
+        objects: list of objects of one group
+        manifest_url: S3 url of the manifest
+
+    Returns:
+        manifest_url
+    """
+    manifest = {'entries': [{'url': 's3://{}/{}'.format(o['bucket'], o['key']),
+                             'mandatory': True,
+                             'meta': {'content_length': o['size']}} for o in objects]}
+    bucket, key = split_s3_url(manifest_url)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf8'))
+
+    return manifest_url
+
+
+def get_num_slices(conn, config):
+    """
+    Description: This function returns the number of slices, from the
+                 STAGING section or from stv_slices on Redshift
+
+    Arguments:
+        conn: object of the connection to the database
+        config: the ConfigParser object
+
+    Returns:
+        number of slices
+    """
+    slices = config.get('STAGING', 'SLICES', fallback='')
+    if slices:
+        return int(slices)
+    if config.get('STAGING', 'BACKEND', fallback='redshift') != 'redshift':
+        return 1
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM stv_slices;")
+        return cur.fetchone()[0]
+
+
+def get_field_names(s3, config, table):
+    """
+    Description: This function returns the json field of every staging column.
+                 staging_events is mapped by the LOG_JSONPATH file, like
+                 its COPY, the other tables by column name ('auto')
+
+    Arguments:
+        s3: boto3 S3 client
+        config: the ConfigParser object
+        table: name of the staging table
+
+    Returns:
+        list of json field names in staging column order
+    """
+    if table != 'staging_events':
+        return staging_columns[table]
+
+    bucket, key = split_s3_url(config.get('S3', 'LOG_JSONPATH'))
+    jsonpaths = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())['jsonpaths']
+
+    return [re.sub(r"^\$\[?'?\.?|'?\]?$", '', path) for path in jsonpaths]
+
+
+def read_copy_telemetry(cur):
+    """
+    Description: This function reads the telemetry of the last COPY of the
+                 session from the Redshift system tables: rows loaded, rows
+                 rejected with their details, and lines, bytes and transfer
+                 time of every file
+
+    Arguments:
+        cur: the cursor object of the COPY
+
+    Returns:
+        dict with query_id, rows, rejected, bytes, files, file_stats and errors
+    """
+    cur.execute(last_copy_id)
+    query_id = cur.fetchone()[0]
+    cur.execute(last_copy_count)
+    rows = cur.fetchone()[0]
+    cur.execute(load_errors_count, (query_id,))
+    rejected = cur.fetchone()[0]
+    cur.execute(load_errors_select, (query_id,))
+    errors = [{'file': f, 'line': line, 'column': column, 'reason': reason, 'raw_line': raw}
+              for f, line, column, reason, raw in cur.fetchall()]
+
+    cur.execute(load_lines_select, (query_id,))
+    lines = dict(cur.fetchall())
+    cur.execute(load_files_select, (query_id,))
+    file_stats = [{'file': f, 'bytes': num_bytes, 'seconds': float(seconds), 'rows': lines.get(f),
+                   'rejected': sum(1 for e in errors if e['file'] == f)}
+                  for f, num_bytes, seconds in cur.fetchall()]
+
+    return {'query_id': query_id, 'rows': rows, 'rejected': rejected, 'bytes': sum(f['bytes'] for f in file_stats),
+            'files': len(file_stats), 'file_stats': file_stats, 'errors': errors}
+
+
+def run_copy(cur, sql):
+    """
+    Description: This function runs a COPY on Redshift and reads its telemetry
+
+    Arguments:
+        cur: the cursor object
+        sql: COPY statement
+
+    Returns:
+        telemetry dict returned by read_copy_telemetry
+    """
+    cur.execute(sql)
+
+    return read_copy_telemetry(cur)
+
+
+def copy_manifest(cur, table, manifest_url):
+    """
+    Description: This function runs the manifest COPY of a staging table
+
+    Arguments:
+        cur: the cursor object
+        table: name of the staging table
+        manifest_url: S3 url of the manifest
+
+    Returns:
+        telemetry dict returned by read_copy_telemetry
+    """
+    return run_copy(cur, copy_manifest_queries[table].format(manifest_url))
+
+
+def copy_objects_postgres(cur, s3, table, objects, field_names, max_error=0):
+    """
+    Description: This function emulates the JSON COPY on a Postgres stand-in:
+                 it streams the objects, maps the json fields to the staging
+                 columns and loads them with COPY FROM STDIN. Lines that are
+                 no JSON object are rejected like by Redshift; if there are
+                 more than max_error, LoadRejected is raised and nothing is loaded.
+
+    Arguments:
+        cur: the cursor object
+        s3: boto3 S3 client
+        table: name of the staging table
+        objects: list of objects of one group
+        field_names: json field of every staging column
+        max_error: number of rejected lines tolerated (MAXERROR)
+
+    Returns:
+        telemetry dict like read_copy_telemetry
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    file_stats, errors = [], []
+    for o in objects:
+        t0 = perf_counter()
+        url = 's3://{}/{}'.format(o['bucket'], o['key'])
+        body = s3.get_object(Bucket=o['bucket'], Key=o['key'])['Body']
+        rows, rejected = 0, 0
+        for number, line in enumerate(body.iter_lines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError('not a JSON object')
+            except ValueError as e:
+                rejected += 1
+                errors.append({'file': url, 'line': number, 'column': None, 'reason': str(e),
+                               'raw_line': line[:1024].decode('utf8', 'replace')})
+                continue
+            writer.writerow(['\\N' if record.get(f) in (None, '') else record.get(f) for f in field_names])
+            rows += 1
+        file_stats.append({'file': url, 'bytes': o['size'], 'seconds': perf_counter() - t0,
+                           'rows': rows, 'rejected': rejected})
+
+    if len(errors) > max_error:
+        raise LoadRejected('Load into table {} failed: {} rows rejected, MAXERROR is {}. First: {} line {}: {}'.format(
+            table, len(errors), max_error, errors[0]['file'], errors[0]['line'], errors[0]['reason']), errors, file_stats)
+
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+        table, ', '.join(staging_columns[table])), buffer)
+
+    return {'query_id': None, 'rows': cur.rowcount, 'rejected': len(errors),
+            'bytes': sum(f['bytes'] for f in file_stats), 'files': len(file_stats),
+            'file_stats': file_stats, 'errors': errors}
+
+
+def ensure_load_tables(conn):
+    """
+    Description: This function creates load_metrics and load_rejects if they
+                 are missing, eg. on a cluster created before they existed
+
+    Arguments:
+        conn: object of the connection to the database
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        cur.execute(load_metrics_table_create)
+        cur.execute(load_rejects_table_create)
+    conn.commit()
+
+
+def record_load(cur, run_id, telemetry):
+    """
+    Description: This function writes the metrics of a COPY to load_metrics
+                 and its rejected rows to load_rejects
+
+    Arguments:
+        cur: the cursor object
+        run_id: id of the run
+        telemetry: dict returned by copy_and_record
+
+    Returns:
+        None
+    """
+    now = datetime.utcnow()
+    cur.execute(load_metrics_insert, (run_id, telemetry['table'], telemetry['source'][:1024], telemetry['status'],
+                                      telemetry.get('query_id'), telemetry.get('files'), telemetry.get('bytes'),
+                                      telemetry.get('rows'), telemetry.get('rejected'), telemetry['seconds'], now))
+    for e in telemetry.get('errors', []):
+        cur.execute(load_rejects_insert, (run_id, telemetry['table'], e['file'], e['line'], e['column'],
+                                          (e['reason'] or '')[:1024], (e['raw_line'] or '')[:1024], now))
+
+
+def copy_and_record(cur, run_id, table, source, copy, loads=None):
+    """
+    Description: This function runs a COPY and records its telemetry in the
+                 same transaction. The caller bumps the version stamp of the
+                 table after the commit (see query_cache.py). If the COPY fails,
+                 the transaction is rolled back, the failure is recorded with
+                 the rejected rows in its own transaction and the error is
+                 raised again.
+
+    Arguments:
+        cur: the cursor object
+        run_id: id of the run
+        table: name of the staging table
+        source: S3 url of the prefix or the manifest
+        copy: function (cur) -> telemetry dict, eg. run_copy or copy_objects_postgres
+        loads: list the telemetry is appended to, for the JSON report
+
+    Returns:
+        telemetry dict with table, source, status, seconds, rows, rejected, bytes,
+        files, file_stats and errors
+    """
+    t0 = perf_counter()
+    try:
+        telemetry = dict(copy(cur), table=table, source=source, status='done', seconds=perf_counter() - t0)
+        record_load(cur, run_id, telemetry)
+    except psycopg2.Error as e:
+        seconds = perf_counter() - t0
+        cur.connection.rollback()
+        errors = getattr(e, 'errors', None)
+        if errors is None:
+            try:
+                cur.execute(load_errors_failed_select)
+                errors = [{'file': f, 'line': line, 'column': column, 'reason': reason, 'raw_line': raw}
+                          for f, line, column, reason, raw in cur.fetchall()]
+            except psycopg2.Error:
+                cur.connection.rollback()
+                errors = []
+        file_stats = getattr(e, 'file_stats', [])
+        telemetry = {'table': table, 'source': source, 'status': 'failed', 'seconds': seconds, 'rows': 0,
+                     'rejected': len(errors), 'bytes': sum(f['bytes'] for f in file_stats), 'files': len(file_stats),
+                     'file_stats': file_stats, 'errors': errors, 'error': str(e).strip()}
+        record_load(cur, run_id, telemetry)
+        cur.connection.commit()
+        if loads is not None:
+            loads.append(telemetry)
+        raise
+
+    if loads is not None:
+        loads.append(telemetry)
+    print_status('staging_loader', '{} from {}: {} rows, {} rejected, {:.1f} MB in {:.2f}s'.format(
+        table, source, telemetry['rows'], telemetry['rejected'], (telemetry['bytes'] or 0) / 1e6, telemetry['seconds']))
+
+    return telemetry
+
+
+def write_load_report(config, run_id, loads):
+    """
+    Description: This function writes the telemetry of the COPYs of a run as
+                 JSON to LOAD_REPORT (STAGING section): every COPY, the
+                 throughput of every S3 prefix (slowest first), the files with
+                 rejected rows and the first rejected rows
+
+    Arguments:
+        config: the ConfigParser object
+        run_id: id of the run
+        loads: list of telemetry dicts returned by copy_and_record
+
+    Returns:
+        path of the report, None if LOAD_REPORT is empty
+    """
+    path = config.get('STAGING', 'LOAD_REPORT', fallback='load_report.json')
+    if not path:
+        return None
+
+    prefixes = {}
+    for load in loads:
+        for f in load.get('file_stats', []):
+            prefix = prefixes.setdefault(os.path.dirname(f['file']), {'prefix': os.path.dirname(f['file']), 'files': 0,
+                                                                       'bytes': 0, 'seconds': 0.0, 'rows': 0,
+                                                                       'rejected': 0})
+            prefix['files'] += 1
+            prefix['bytes'] += f['bytes'] or 0
+            prefix['seconds'] += f['seconds'] or 0
+            prefix['rows'] += f['rows'] or 0
+            prefix['rejected'] += f['rejected']
+    for prefix in prefixes.values():
+        prefix['mb_per_second'] = prefix['bytes'] / 1e6 / prefix['seconds'] if prefix['seconds'] else None
+
+    malformed = {}
+    for load in loads:
+        for e in load['errors']:
+            malformed.setdefault(e['file'], {'table': load['table'], 'file': e['file'], 'rejected': 0,
+                                             'first_line': e['line'], 'first_reason': e['reason']})
+            malformed[e['file']]['rejected'] += 1
+
+    report = {'run_id': run_id,
+              'copies': [{k: v for k, v in load.items() if k not in ('file_stats', 'errors')} for load in loads],
+              'prefixes': sorted(prefixes.values(), key=lambda p: (p['mb_per_second'] is None, p['mb_per_second'])),
+              'malformed_files': sorted(malformed.values(), key=lambda f: -f['rejected']),
+              'rejected_rows': [dict(e, table=load['table']) for load in loads for e in load['errors']][:100]}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+
+    return path
+
+
+def load_table(config, table, source_url, run_id, loads=None):
+    """
+    Description: This function loads one staging table on its own connection,
+                 one COPY per slice-aligned group of source objects. The
+                 telemetry of every COPY is written to load_metrics, the
+                 version stamp of the table is bumped once after the COPYs.
+
+    Arguments:
+        config: the ConfigParser object
+        table: name of the staging table
+        source_url: S3 url of the source prefix
+        run_id: id of the run, used to name the manifests
+        loads: list the telemetry of every COPY is appended to
+
+    Returns:
+        results: list of telemetry dicts returned by copy_and_record, with the group
+    """
+    backend = config.get('STAGING', 'BACKEND', fallback='redshift')
+    max_error = config.getint('STAGING', 'MAXERROR', fallback=0)
+    s3 = get_s3_client(config)
+    conn = get_connection(config)
+    results = []
+    try:
+        objects = list_objects(s3, source_url)
+        groups = slice_aligned_groups(objects, get_num_slices(conn, config),
+                                      config.getint('STAGING', 'FILES_PER_SLICE', fallback=64))
+        field_names = get_field_names(s3, config, table) if backend != 'redshift' else None
+        print_status('staging_loader', '{}: {} files in {} groups'.format(table, len(objects), len(groups)))
+
+        for i, group in enumerate(groups):
+            with conn.cursor() as cur:
+                if backend == 'redshift':
+                    source = write_manifest(s3, group, '{}/{}/{}-{:04d}.manifest'.format(
+                        unquote(config.get('STAGING', 'MANIFEST_PREFIX')), table, run_id, i))
+                    telemetry = copy_and_record(cur, run_id, table, source,
+                                                lambda c: copy_manifest(c, table, source), loads)
+                else:
+                    telemetry = copy_and_record(cur, run_id, table, '{} group {}'.format(unquote(source_url), i),
+                                                lambda c: copy_objects_postgres(c, s3, table, group, field_names,
+                                                                                max_error), loads)
+            conn.commit()
+            results.append(dict(telemetry, group=i))
+    finally:
+        if results:
+            bump_table_versions(conn, [table])
+        conn.close()
+
+    return results
+
+
+def load_staging_tables_parallel(config, loaders=None):
+    """
+    Description: This function loads staging_events and staging_songs
+                 concurrently, each over a separate connection, and writes
+                 the load report, also if a COPY failed
+
+    Arguments:
+        config: the ConfigParser object
+        loaders: dict of table -> function replacing load_table for the table,
+                 eg. load_new_objects of log_discovery.py for staging_events
+
+    Returns:
+        results: list of dicts with the stats of every COPY
+    """
+    run_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    sources = {'staging_events': config.get('S3', 'LOG_DATA'),
+               'staging_songs': config.get('S3', 'SONG_DATA')}
+    loads = []
+
+    conn = get_connection(config)
+    ensure_load_tables(conn)
+    conn.close()
+    try:
+        with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            futures = [executor.submit((loaders or {}).get(table, load_table), config, table, url, run_id, loads)
+                       for table, url in sources.items()]
+            return [result for future in futures for result in future.result()]
+    finally:
+        path = write_load_report(config, run_id, loads)
+        if path:
+            print_status('staging_loader', 'load report written to {}'.format(path))
+
+
+def print_report(results):
+    """
+    Description: This function prints the stats of every COPY
+
+    Arguments:
+        results: list of dicts returned by load_staging_tables_parallel
+
+    Returns:
+        None
+    """
+    print('{:<16}{:>6}{:>8}{:>10}{:>12}{:>10}{:>10}{:>8}'.format('table', 'group', 'files', 'MB', 'rows', 'rejected',
+                                                                  'seconds', 'MB/s'))
+    for r in results:
+        print('{:<16}{:>6}{:>8}{:>10.1f}{:>12}{:>10}{:>10.2f}{:>8.1f}'.format(
+            r['table'], r['group'], r['files'], r['bytes'] / 1e6, r['rows'], r['rejected'], r['seconds'],
+            r['bytes'] / 1e6 / r['seconds'] if r['seconds'] else 0))
+
+
+def main():
+    """
+    Description: This main function loads both staging tables in parallel
+                 and prints the stats of every COPY
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    print_report(load_staging_tables_parallel(read_config('dwh.cfg')))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import csv
+import io
+import itertools
+import random
+from sql_queries import staging_events_columns, staging_songs_columns
+
+
+first_names = ['Adler', 'Kaylee', 'Walter', 'Ryan', 'Jacqueline', 'Layla', 'Tegan', 'Chloe', 'Mohammad', 'Lily']
+last_names  = ['Barrera', 'Summers', 'Frye', 'Smith', 'Lynch', 'Griffin', 'Levine', 'Cuevas', 'Rodriguez', 'Koch']
+locations   = ['New York-Newark-Jersey City, NY-NJ-PA', 'San Francisco-Oakland-Hayward, CA',
+               'Phoenix-Mesa-Scottsdale, AZ', 'Atlanta-Sandy Springs-Roswell, GA']
+user_agent  = '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"'
+
+# 2018-11-01 00:00:00 UTC in milliseconds, the start of the original log data
+start_ts = 1541030400000
+
+
+def generate_songs(num_songs, seed=42):
+    """
+    Description: This function generates staging_songs rows
+
+    Arguments:
+        num_songs: number of songs
+        seed: seed of the random generator
+
+    Returns:
+        list of rows in staging_songs column order
+    """
+    rng = random.Random(seed)
+    num_artists = max(num_songs // 4, 1)
+    rows = []
+    for i in range(num_songs):
+        artist = rng.randrange(num_artists)
+        has_location = rng.random() < 0.4
+        rows.append((1,
+                     'AR{:016d}'.format(artist),
+                     round(rng.uniform(-90, 90), 5) if has_location else None,
+                     round(rng.uniform(-180, 180), 5) if has_location else None,
+                     rng.choice(locations) if has_location else '',
+                     'Artist Name {}'.format(artist),
+                     'SO{:016d}'.format(i),
+                     'Song Title {}'.format(i),
+                     round(rng.uniform(60.0, 480.0), 5),
+                     rng.choice([0, rng.randint(1960, 2018)])))
+
+    return rows
+
+
+def generate_events(num_events, songs, num_users=1000, unknown_song_ratio=0.3, start=start_ts, seed=42):
+    """
+    Description: This function generates staging_events rows in increasing ts
+                 order. 80% of the events are NextSong events playing a Zipf
+                 distributed song, a share of them plays songs missing in songs
+
+    Arguments:
+        num_events: number of events
+        songs: rows returned by generate_songs
+        num_users: number of users
+        unknown_song_ratio: share of NextSong events playing an unknown song
+        start: ts of the first event in milliseconds
+        seed: seed of the random generator
+
+    Returns:
+        list of rows in staging_events column order
+    """
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, len(songs) + 1)))
+    users = [(user_id, rng.choice(first_names), rng.choice('MF'), rng.choice(last_names),
+              rng.choice(['free', 'paid']), rng.choice(locations)) for user_id in range(1, num_users + 1)]
+
+    rows = []
+    ts = start
+    for i in range(num_events):
+        ts += rng.randint(0, 20000)
+        user_id, first_name, gender, last_name, level, location = rng.choice(users)
+        if rng.random() < 0.8:
+            if rng.random() < unknown_song_ratio:
+                artist, song, length = 'Unknown Artist {}'.format(i % 997), 'Unknown Song {}'.format(i), 200.0
+            else:
+                song_row = rng.choices(songs, cum_weights=cum_weights)[0]
+                artist, song, length = song_row[5], song_row[7], song_row[8]
+            page, method = 'NextSong', 'PUT'
+        else:
+            artist, song, length = None, None, None
+            page, method = rng.choice(['Home', 'Logout', 'Settings']), 'GET'
+        rows.append((artist, 'Logged In', first_name, gender, i % 50, last_name, length, level,
+                     location, method, page, '1540344794796', user_id, song, 200, ts, user_agent, user_id))
+
+    return rows
+
+
+def load_rows(conn, table, columns, rows):
+    """
+    Description: This function bulk loads rows into a table with COPY FROM STDIN
+
+    Arguments:
+        conn: object of the connection to the database
+        table: name of the table
+        columns: column names in row order
+        rows: list of row tuples
+
+    Returns:
+        None
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if v is None else v for v in row])
+    buffer.seek(0)
+
+    with conn.cursor() as cur:
+        cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table, ', '.join(columns)), buffer)
+    conn.commit()
+
+
+def load_staging(conn, num_events, num_songs, seed=42):
+    """
+    Description: This function loads a synthetic data set into the staging tables
+
+    Arguments:
+        conn: object of the connection to the database
+        num_events: number of staging_events rows
+        num_songs: number of staging_songs rows
+        seed: seed of the random generator
+
+    Returns:
+        None
+    """
+    songs = generate_songs(num_songs, seed)
+    load_rows(conn, 'staging_songs', staging_songs_columns, songs)
+    load_rows(conn, 'staging_events', staging_events_columns, generate_events(num_events, songs, seed=seed))
@@ -0,0 +1,435 @@
+import argparse
+import re
+import statistics
+from time import perf_counter
+from dialect import strip_table_design, to_postgres
+from sql_queries import (star_table_creates, insert_table_statements, staging_events_table_create,
+                         staging_songs_table_create, key_table_queries, time_table_insert)
+from staging_loader import get_num_slices
+from synthetic_data import load_staging
+from tools import read_config, get_connection, print_status
+
+
+# Redshift keeps a table with DISTSTYLE AUTO on every node while it is small
+# and switches it to EVEN when it grows, the model assumes the switch at this size
+auto_all_rows = 1000000
+
+# queries on the star schema, the joins are listed as
+# (fact table, fact column, dimension table, dimension column)
+workload = [
+    {'name': 'top_songs_month',
+     'sql': """SELECT a.name, s.title, COUNT(*) AS plays
+               FROM fact_songplays AS f
+               JOIN dim_songs AS s ON f.song_id=s.song_id
+               JOIN dim_artists AS a ON f.artist_id=a.artist_id
+               JOIN dim_time AS t ON f.start_time=t.start_time
+               WHERE t.year=2018 AND t.month=11
+               GROUP BY a.name, s.title
+               ORDER BY plays DESC
+               LIMIT 10;""",
+     'joins': [('fact_songplays', 'song_id', 'dim_songs', 'song_id'),
+               ('fact_songplays', 'artist_id', 'dim_artists', 'artist_id'),
+               ('fact_songplays', 'start_time', 'dim_time', 'start_time')]},
+    {'name': 'level_by_hour',
+     'sql': """SELECT t.hour, u.level, COUNT(*) AS plays
+               FROM fact_songplays AS f
+               JOIN dim_users AS u ON f.user_id=u.user_id
+               JOIN dim_time AS t ON f.start_time=t.start_time
+               GROUP BY t.hour, u.level;""",
+     'joins': [('fact_songplays', 'user_id', 'dim_users', 'user_id'),
+               ('fact_songplays', 'start_time', 'dim_time', 'start_time')]},
+    {'name': 'plays_by_location',
+     'sql': """SELECT a.location, COUNT(*) AS plays
+               FROM fact_songplays AS f
+               JOIN dim_artists AS a ON f.artist_id=a.artist_id
+               GROUP BY a.location;""",
+     'joins': [('fact_songplays', 'artist_id', 'dim_artists', 'artist_id')]},
+    {'name': 'first_week',
+     'sql': """SELECT level, COUNT(*) AS plays
+               FROM fact_songplays
+               WHERE start_time BETWEEN '2018-11-01' AND '2018-11-07'
+               GROUP BY level;""",
+     'joins': []},
+]
+
+# table -> (diststyle, distkey, sortkey columns), tables not listed keep the design of sql_queries.py
+candidate_designs = {
+    'current': {},
+    'nodist': {'fact_songplays': ('EVEN', None, []), 'dim_users': ('EVEN', None, []),
+               'dim_songs': ('EVEN', None, []), 'dim_artists': ('EVEN', None, []),
+               'dim_time': ('EVEN', None, [])},
+    'dims_all': {'fact_songplays': ('EVEN', None, ['start_time']), 'dim_users': ('ALL', None, ['user_id']),
+                 'dim_songs': ('ALL', None, ['song_id']), 'dim_artists': ('ALL', None, ['artist_id']),
+                 'dim_time': ('ALL', None, ['start_time'])},
+    'song_key': {'fact_songplays': ('KEY', 'song_id', ['start_time']), 'dim_users': ('ALL', None, ['user_id']),
+                 'dim_songs': ('KEY', 'song_id', ['song_id']), 'dim_artists': ('ALL', None, ['artist_id']),
+                 'dim_time': ('ALL', None, ['start_time'])},
+    'user_key': {'fact_songplays': ('KEY', 'user_id', ['start_time']), 'dim_users': ('KEY', 'user_id', ['user_id']),
+                 'dim_songs': ('ALL', None, ['song_id']), 'dim_artists': ('ALL', None, ['artist_id']),
+                 'dim_time': ('ALL', None, ['start_time'])},
+}
+
+
+def parse_design(create_sql):
+    """
+    Description: This function reads the table design of a CREATE TABLE
+                 statement of sql_queries.py
+
+    Arguments:
+        create_sql: CREATE TABLE statement
+
+    Returns:
+        (diststyle, distkey, sortkey columns), diststyle is AUTO without DISTKEY
+    """
+    distkey = re.search(r'^\s*(\w+)\s[^\n]*\bDISTKEY\b', create_sql, flags=re.M | re.I)
+    sortkeys = re.findall(r'^\s*(\w+)\s[^\n]*\bSORTKEY\b', create_sql, flags=re.M | re.I)
+    if distkey:
+        return 'KEY', distkey.group(1), sortkeys
+
+    return 'AUTO', None, sortkeys
+
+
+def table_columns(create_sql):
+    """
+    Description: This function returns the columns of a CREATE TABLE statement
+                 that can be inserted, IDENTITY columns are left out
+
+    Arguments:
+        create_sql: CREATE TABLE statement
+
+    Returns:
+        list of column names
+    """
+    body = create_sql[create_sql.index('(') + 1:]
+    columns = []
+    for line in body.split('\n'):
+        match = re.match(r'\s*(\w+)\s+(\w+)', line)
+        if match and match.group(1).upper() not in ('FOREIGN', 'PRIMARY') and 'IDENTITY' not in line.upper():
+            columns.append(match.group(1))
+
+    return columns
+
+
+def design_ddl(create_sql, design):
+    """
+    Description: This function rewrites a CREATE TABLE statement for a table design
+
+    Arguments:
+        create_sql: CREATE TABLE statement of sql_queries.py
+        design: (diststyle, distkey, sortkey columns)
+
+    Returns:
+        the CREATE TABLE statement with the table level design attributes
+    """
+    diststyle, distkey, sortkeys = design
+    attributes = ' DISTSTYLE {}'.format(diststyle)
+    if diststyle == 'KEY':
+        attributes += ' DISTKEY({})'.format(distkey)
+    if sortkeys:
+        attributes += ' COMPOUND SORTKEY({})'.format(', '.join(sortkeys))
+
+    sql = strip_table_design(create_sql).replace('IF NOT EXISTS ', '')
+    end = sql.rindex(')')
+
+    return sql[:end + 1] + attributes + ';'
+
+
+def effective_style(design, rows):
+    """
+    Description: This function resolves DISTSTYLE AUTO for the model
+
+    Arguments:
+        design: (diststyle, distkey, sortkey columns)
+        rows: number of rows of the table
+
+    Returns:
+        ALL, EVEN or KEY
+    """
+    if design[0] == 'AUTO':
+        return 'ALL' if rows <= auto_all_rows else 'EVEN'
+
+    return design[0]
+
+
+def model_join(left, left_column, right, right_column, slices):
+    """
+    Description: This function models how Redshift moves the rows of a join
+                 between the slices. Both sides are given as dicts with the
+                 style, distkey and rows of the table.
+
+    Arguments:
+        left: the outer (fact) table
+        left_column: join column of the outer table
+        right: the inner (dimension) table
+        right_column: join column of the inner table
+        slices: number of slices
+
+    Returns:
+        label: name of the distribution step as in a Redshift query plan
+        moved_rows: number of rows sent over the network
+    """
+    if left['style'] == 'ALL' or right['style'] == 'ALL':
+        return 'DS_DIST_ALL_NONE', 0
+
+    left_collocated = left['style'] == 'KEY' and left['distkey'] == left_column
+    right_collocated = right['style'] == 'KEY' and right['distkey'] == right_column
+    if left_collocated and right_collocated:
+        return 'DS_DIST_NONE', 0
+    if right_collocated:
+        return 'DS_DIST_OUTER', left['rows']
+    if left_collocated:
+        return 'DS_DIST_INNER', right['rows']
+
+    return min([('DS_BCAST_INNER', right['rows'] * slices), ('DS_DIST_BOTH', left['rows'] + right['rows'])],
+               key=lambda option: option[1])
+
+
+def modeled_skew(cur, table, distkey, slices):
+    """
+    Description: This function hashes the distribution key of every row of a
+                 table to a slice and returns the ratio of the rows of the
+                 fullest to the emptiest slice, like skew_rows of svv_table_info
+
+    Arguments:
+        cur: the cursor object
+        table: name of the table
+        distkey: distribution key column
+        slices: number of slices
+
+    Returns:
+        row skew, None if a slice is empty
+    """
+    cur.execute("""SELECT MOD(ABS(hashtext(CAST({0} AS TEXT))), {1}), COUNT(*)
+                   FROM {2} GROUP BY 1;""".format(distkey, slices, table))
+    counts = [n for _, n in cur.fetchall()]
+    if len(counts) < slices or min(counts) == 0:
+        return None
+
+    return max(counts) / min(counts)
+
+
+def build_source(conn, schema, num_events, num_songs):
+    """
+    Description: This function fills the star schema of a source schema on the
+                 Postgres stand-in from synthetic staging data
+
+    Arguments:
+        conn: object of the connection to the Postgres stand-in
+        schema: name of the source schema
+        num_events: number of staging_events rows
+        num_songs: number of staging_songs rows
+
+    Returns:
+        None
+    """
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};'.format(schema))
+        for query in [staging_events_table_create, staging_songs_table_create] + list(star_table_creates.values()):
+            cur.execute(to_postgres(query))
+
+    load_staging(conn, num_events, num_songs)
+    with conn.cursor() as cur:
+        for query in key_table_queries + list(insert_table_statements.values()) + [time_table_insert]:
+            cur.execute(to_postgres(query))
+        cur.execute('ANALYZE;')
+
+
+def evaluate_design(conn, backend, name, design, source, slices, repeat):
+    """
+    Description: This function creates the star schema with a table design in
+                 the schema design_<name>, loads it from the source schema and
+                 runs the workload. On Redshift the row skew is read from
+                 svv_table_info and the distribution steps from the query plans,
+                 on the Postgres stand-in both are modeled. The moved rows are
+                 always modeled, every join against the stored distribution.
+
+    Arguments:
+        conn: object of the connection to the database, in autocommit mode
+        backend: redshift or postgres
+        name: name of the design
+        design: dict of table -> (diststyle, distkey, sortkey columns)
+        source: schema with the loaded star schema
+        slices: number of slices
+        repeat: number of runs of every query
+
+    Returns:
+        result: dict with the load time, the tables and the queries of the design
+    """
+    schema = 'design_{}'.format(name)
+    result = {'design': name, 'load_seconds': 0.0, 'tables': {}, 'queries': {}}
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};'.format(schema))
+        if backend == 'redshift':
+            cur.execute('SET enable_result_cache_for_session TO off;')
+
+        for table, create_sql in star_table_creates.items():
+            table_design = design.get(table, parse_design(create_sql))
+            ddl = design_ddl(create_sql, table_design)
+            columns = ', '.join(table_columns(create_sql))
+            order_by = ' ORDER BY {}'.format(', '.join(table_design[2])) if table_design[2] else ''
+
+            t0 = perf_counter()
+            cur.execute(ddl if backend == 'redshift' else to_postgres(ddl))
+            cur.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2}.{0}{3};'.format(table, columns, source, order_by))
+            if backend == 'redshift':
+                cur.execute('VACUUM SORT ONLY {};'.format(table))
+            elif table_design[2]:
+                # block range index on the sorted rows, the stand-in for zone maps
+                cur.execute('CREATE INDEX ON {} USING brin ({});'.format(table, ', '.join(table_design[2])))
+            cur.execute('ANALYZE {};'.format(table))
+            load_seconds = perf_counter() - t0
+
+            cur.execute('SELECT COUNT(*) FROM {};'.format(table))
+            rows = cur.fetchone()[0]
+            style = effective_style(table_design, rows)
+            skew = 1.0
+            if style == 'KEY' and backend != 'redshift':
+                skew = modeled_skew(cur, table, table_design[1], slices)
+            result['load_seconds'] += load_seconds
+            result['tables'][table] = {'style': style, 'distkey': table_design[1], 'sortkey': table_design[2],
+                                       'rows': rows, 'load_seconds': load_seconds, 'skew': skew}
+
+        if backend == 'redshift':
+            cur.execute("""SELECT "table", skew_rows FROM svv_table_info WHERE schema=%s;""", (schema,))
+            for table, skew_rows in cur.fetchall():
+                if table in result['tables']:
+                    result['tables'][table]['skew'] = float(skew_rows) if skew_rows is not None else 1.0
+
+        for query in workload:
+            moves = [model_join(result['tables'][lt], lc, result['tables'][rt], rc, slices)
+                     for lt, lc, rt, rc in query['joins']]
+            labels = [label for label, _ in moves]
+            if backend == 'redshift':
+                cur.execute('EXPLAIN ' + query['sql'])
+                labels = [label for (line,) in cur.fetchall() for label in re.findall(r'DS_\w+', line)]
+
+            seconds = []
+            for _ in range(repeat):
+                t0 = perf_counter()
+                cur.execute(query['sql'])
+                cur.fetchall()
+                seconds.append(perf_counter() - t0)
+            result['queries'][query['name']] = {'seconds': statistics.median(seconds), 'dist': labels,
+                                                'moved_rows': sum(moved for _, moved in moves)}
+
+    return result
+
+
+def rank_designs(results, backend):
+    """
+    Description: This function orders the evaluated designs from best to worst.
+                 On Redshift the measured query time decides. A single Postgres
+                 node does not move rows, so there the modeled moved rows decide
+                 first, then the row skew, then the measured query time which
+                 still shows the effect of the sort keys.
+
+    Arguments:
+        results: list of dicts returned by evaluate_design
+        backend: redshift or postgres
+
+    Returns:
+        the results ordered from best to worst
+    """
+    def query_seconds(result):
+        return sum(q['seconds'] for q in result['queries'].values())
+
+    def max_skew(result):
+        skews = [t['skew'] for t in result['tables'].values()]
+        return float('inf') if None in skews else max(skews)
+
+    if backend == 'redshift':
+        return sorted(results, key=query_seconds)
+
+    return sorted(results, key=lambda r: (sum(q['moved_rows'] for q in r['queries'].values()),
+                                          round(max_skew(r), 1), query_seconds(r)))
+
+
+def print_report(results):
+    """
+    Description: This function prints the design of every table, the load time,
+                 query time, moved rows and row skew of every evaluated design
+
+    Arguments:
+        results: list of dicts returned by rank_designs, best first
+
+    Returns:
+        None
+    """
+    for result in results:
+        print('\n=== {} ==='.format(result['design']))
+        print('{:<16}{:<6}{:<12}{:<14}{:>10}{:>10}{:>8}'.format('table', 'style', 'distkey', 'sortkey',
+                                                                 'rows', 'load s', 'skew'))
+        for table, t in result['tables'].items():
+            print('{:<16}{:<6}{:<12}{:<14}{:>10}{:>10.2f}{:>8}'.format(
+                table, t['style'], t['distkey'] or '-', ','.join(t['sortkey']) or '-', t['rows'],
+                t['load_seconds'], '-' if t['skew'] is None else '{:.2f}'.format(t['skew'])))
+        print('{:<20}{:>10}{:>12}  {}'.format('query', 'seconds', 'moved rows', 'distribution'))
+        for name, q in result['queries'].items():
+            print('{:<20}{:>10.3f}{:>12}  {}'.format(name, q['seconds'], q['moved_rows'], ', '.join(q['dist']) or '-'))
+
+    print('\n{:<12}{:>10}{:>10}{:>14}{:>10}'.format('design', 'load s', 'query s', 'moved rows', 'max skew'))
+    for result in results:
+        skews = [t['skew'] for t in result['tables'].values()]
+        print('{:<12}{:>10.2f}{:>10.3f}{:>14}{:>10}'.format(
+            result['design'], result['load_seconds'], sum(q['seconds'] for q in result['queries'].values()),
+            sum(q['moved_rows'] for q in result['queries'].values()),
+            '-' if None in skews else '{:.2f}'.format(max(skews))))
+    print('\nrecommended design: {}'.format(results[0]['design']))
+
+
+def main():
+    """
+    Description: This main function evaluates the candidate table designs of
+                 the star schema against the workload and prints the report
+
+    Arguments:
+        None
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Compare distribution and sort key designs of the star schema')
+    parser.add_argument('--design', action='append', choices=sorted(candidate_designs),
+                        help='design to evaluate, can be repeated (default: all)')
+    parser.add_argument('--source', help='schema with the loaded star schema (default: public, '
+                                             'advisor_source with --events)')
+    parser.add_argument('--events', type=int, default=0,
+                        help='Postgres only: fill the source schema with this many synthetic events first')
+    parser.add_argument('--songs', type=int, default=20000)
+    parser.add_argument('--slices', type=int, help='number of slices of the model (default: from dwh.cfg)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    source = args.source or ('advisor_source' if args.events else 'public')
+    if args.events and source == 'public':
+        raise ValueError('--events rebuilds the source schema, choose another one than public')
+
+    config = read_config('dwh.cfg')
+    backend = config.get('STAGING', 'BACKEND', fallback='redshift')
+    conn = get_connection(config)
+    # VACUUM cannot run in a transaction
+    conn.autocommit = True
+    try:
+        slices = args.slices or get_num_slices(conn, config)
+        if backend != 'redshift' and slices == 1:
+            # two dc2.large nodes
+            slices = 4
+        if args.events:
+            if backend == 'redshift':
+                raise ValueError('--events is only supported on the Postgres stand-in')
+            print_status('table_design_advisor', 'building source schema {}'.format(source))
+            build_source(conn, source, args.events, args.songs)
+
+        results = []
+        for name in args.design or list(candidate_designs):
+            print_status('table_design_advisor', 'evaluating design {}'.format(name))
+            results.append(evaluate_design(conn, backend, name, candidate_designs[name],
+                                           source, slices, args.repeat))
+    finally:
+        conn.close()
+
+    print_report(rank_designs(results, backend))
+
+
+if __name__ == "__main__":
+    main()
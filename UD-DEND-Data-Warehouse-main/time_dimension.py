@@ -0,0 +1,209 @@
+from sql_queries import (time_covered_select, time_table_range_select, time_events_range_select, time_covered_delete,
+                         time_covered_insert, time_calendar_insert, time_calendar_fill, time_table_insert,
+                         time_table_merge_delete, time_table_merge_insert, songplay_start_time,
+                         songplay_start_time_grain)
+from dialect import translate
+
+
+# points of the calendar inserted by one statement, the numbers subquery
+# cross joins at most 6 tables of digits
+max_chunk = 10 ** 6
+
+
+def time_grain(config):
+    """
+    Description: This function reads TIME_GRAIN of the ETL section of the
+                 config, empty or 0 loads dim_time with the DISTINCT of the
+                 event timestamps instead of a calendar
+
+    Arguments:
+        config: the ConfigParser object
+
+    Returns:
+        seconds between two points of the calendar, 0 for the DISTINCT
+    """
+    return int(config.get('ETL', 'TIME_GRAIN', fallback='') or 0)
+
+
+def at_grain(query, grain):
+    """
+    Description: This function truncates the start time of the songplays of
+                 an insert or merge to the grain of the calendar, so that it
+                 joins dim_time.start_time
+
+    Arguments:
+        query: a statement of insert_table_statements or merge_table_queries, only the songplays change
+        grain: seconds between two points of the calendar, 0 or 1 keep the seconds
+
+    Returns:
+        SQL statement
+    """
+    if grain <= 1:
+        return query
+
+    return query.replace(songplay_start_time, songplay_start_time_grain.format(grain))
+
+
+def time_queries(config, source='staging_events'):
+    """
+    Description: This function returns the translated DISTINCT statements of
+                 dim_time for the grain 0: the insert of a full load, or the
+                 delete-insert of the timestamps of an incremental load
+
+    Arguments:
+        config: the ConfigParser object
+        source: staging_events, or staging_events_delta of an incremental load
+
+    Returns:
+        list of SQL statements, empty if dim_time is a calendar
+    """
+    if time_grain(config) > 0:
+        return []
+    queries = [time_table_insert] if source == 'staging_events' else [time_table_merge_delete, time_table_merge_insert]
+
+    return [translate(config, query) for query in queries]
+
+
+def load_time_dimension(cur, config, source='staging_events'):
+    """
+    Description: This function loads dim_time for the events of source, with
+                 the DISTINCT statements of time_queries or, with a TIME_GRAIN
+                 above 0, by extending the calendar. Nothing is committed.
+
+    Arguments:
+        cur: the cursor object
+        config: the ConfigParser object
+        source: staging_events, or staging_events_delta of an incremental load
+
+    Returns:
+        number of inserted rows
+    """
+    queries = time_queries(config, source)
+    if not queries:
+        return extend_time_dimension(cur, time_grain(config), source)
+
+    for query in queries:
+        cur.execute(query)
+
+    return cur.rowcount
+
+
+def numbers_query(num_digits):
+    """
+    Description: This function builds a subquery returning the numbers
+                 0 .. 10^num_digits - 1 from cross joined digits. It needs
+                 no table, so it also runs on the compute nodes of Redshift,
+                 where generate_series is a leader node function.
+
+    Arguments:
+        num_digits: number of decimal digits
+
+    Returns:
+        SQL subquery with the column n
+    """
+    digits = ' UNION ALL '.join('SELECT {} AS d'.format(i) for i in range(10))
+    terms = ' + '.join('{} * d{}.d'.format(10 ** i, i) for i in range(num_digits))
+    tables = ' CROSS JOIN '.join('({}) AS d{}'.format(digits, i) for i in range(num_digits))
+
+    return 'SELECT {} AS n FROM {}'.format(terms, tables)
+
+
+def calendar_ranges(covered, events, grain):
+    """
+    Description: This function finds the ranges of the calendar the events
+                 need beyond the range dim_time already covers
+
+    Arguments:
+        covered: (low, high) epoch seconds covered by dim_time, None if it is empty
+        events: (first, last) epoch seconds of the events, None if there are none
+        grain: seconds between two points of the calendar
+
+    Returns:
+        list of (low, high) ranges, both ends included and aligned to the grain
+    """
+    if events is None:
+        return []
+
+    first, last = (t // grain * grain for t in events)
+    if covered is None:
+        return [(first, last)]
+
+    low, high = covered
+    ranges = []
+    if first < low:
+        ranges.append((first, low - grain))
+    if last > high:
+        ranges.append((high + grain, last))
+
+    return ranges
+
+
+def insert_calendar(cur, low, high, grain, query=time_calendar_insert):
+    """
+    Description: This function inserts the points of the calendar from low
+                 to high into dim_time, at most max_chunk points per statement
+
+    Arguments:
+        cur: the cursor object
+        low: first point in epoch seconds
+        high: last point in epoch seconds
+        grain: seconds between two points
+        query: time_calendar_insert, or time_calendar_fill to keep existing points
+
+    Returns:
+        number of inserted rows
+    """
+    count = (high - low) // grain + 1
+    rows = 0
+    for offset in range(0, count, max_chunk):
+        num_points = min(max_chunk, count - offset)
+        cur.execute(query.format(numbers_query(len(str(num_points - 1)))),
+                    {'low': low + offset * grain, 'grain': grain, 'count': num_points})
+        rows += cur.rowcount
+
+    return rows
+
+
+def extend_time_dimension(cur, grain=1, source='staging_events'):
+    """
+    Description: This function extends dim_time by the calendar points between
+                 the NextSong events of source and the range it already covers,
+                 which is kept in etl_watermark. The distinct timestamps of the
+                 events are not needed. A dim_time filled by time_table_insert
+                 before is completed to the calendar once. Nothing is committed.
+
+    Arguments:
+        cur: the cursor object
+        grain: seconds between two points of the calendar (TIME_GRAIN)
+        source: staging_events, or staging_events_delta of an incremental load
+
+    Returns:
+        number of inserted rows
+    """
+    cur.execute(time_covered_select)
+    covered = dict(cur.fetchall())
+    cur.execute(time_events_range_select.format(source))
+    events = cur.fetchone()
+    events = None if events[0] is None else tuple(events)
+
+    query = time_calendar_insert
+    if len(covered) == 2:
+        covered = (covered['dim_time_low'], covered['dim_time_high'])
+    else:
+        cur.execute(time_table_range_select)
+        table_range = cur.fetchone()
+        covered = None
+        if table_range[0] is not None:
+            events = (min(events[0], table_range[0]), max(events[1], table_range[1])) if events else tuple(table_range)
+            query = time_calendar_fill
+
+    ranges = calendar_ranges(covered, events, grain)
+    rows = sum(insert_calendar(cur, low, high, grain, query) for low, high in ranges)
+
+    if ranges:
+        low = min([r[0] for r in ranges] + ([covered[0]] if covered else []))
+        high = max([r[1] for r in ranges] + ([covered[1]] if covered else []))
+        cur.execute(time_covered_delete)
+        cur.execute(time_covered_insert, (low, high))
+
+    return rows
@@ -0,0 +1,117 @@
+import configparser
+from datetime import datetime
+import boto3
+import psycopg2
+
+
+def read_config(config_path='dwh.cfg'):
+    """
+    Description: Reads the config file
+
+    Arguments:
+        config_path: path to config file
+
+    Returns:
+        config: the ConfigParser object
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+
+    return config
+
+
+def get_dsn(config):
+    """
+    Description: Builds the connection string of the cluster (or of the
+                 Postgres stand-in) configured in the CLUSTER section
+
+    Arguments:
+        config: the ConfigParser object
+
+    Returns:
+        connection string for psycopg2
+    """
+    return "host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values())
+
+
+def get_connection(config):
+    """
+    Description: Opens a new connection to the cluster (or to the Postgres
+                 stand-in) configured in the CLUSTER section
+
+    Arguments:
+        config: the ConfigParser object
+
+    Returns:
+        conn: object of the connection to the database
+    """
+    return psycopg2.connect(get_dsn(config))
+
+
+def unquote(value):
+    """
+    Description: Strips the quotes of a config value that is written
+                 quoted to be pasted into SQL, eg. 's3://udac-dend/log_data'
+
+    Arguments:
+        value: config value
+
+    Returns:
+        the unquoted value
+    """
+    return value.strip().strip("'\"")
+
+
+def split_s3_url(url):
+    """
+    Description: Splits an S3 url into bucket and key prefix
+
+    Arguments:
+        url: S3 url, quoted or not, eg. s3://udac-dend/log_data
+
+    Returns:
+        bucket: name of the bucket
+        prefix: key prefix without leading slash
+    """
+    path = unquote(url)[len('s3://'):]
+    bucket, _, prefix = path.partition('/')
+
+    return bucket, prefix
+
+
+def get_s3_client(config):
+    """
+    Description: Creates an S3 client. S3_ENDPOINT_URL in the STAGING section
+                 points it at an S3-compatible local object store, credentials
+                 are taken from the AWS section if present
+
+    Arguments:
+        config: the ConfigParser object
+
+    Returns:
+        boto3 S3 client
+    """
+    kwargs = {'region_name': unquote(config.get('S3', 'S3_REGION'))}
+    endpoint_url = config.get('STAGING', 'S3_ENDPOINT_URL', fallback='')
+    if endpoint_url:
+        kwargs['endpoint_url'] = endpoint_url
+    if config.has_section('AWS'):
+        kwargs['aws_access_key_id'] = config.get('AWS', 'KEY')
+        kwargs['aws_secret_access_key'] = config.get('AWS', 'SECRET')
+
+    return boto3.client('s3', **kwargs)
+
+
+def print_status(module_name, message):
+    """
+    Description: Prints status with timestamp
+
+    Arguments:
+        module_name: Name of module
+        message: desired message to print
+
+    Returns:
+        None
+    """
+    datetimenow = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print('{} - {} - {}'.format(datetimenow, module_name, message))